@@ -0,0 +1,88 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+#!/usr/bin/python3 -uB
+""" Stand-in for gis-buffer-renderer with the same command line: -u<url> -o<id> -x<lon> -y<lat> -s<scale> -w<w> -h<h> -f<format> -e<error code> -d<shid>.
+It sends a synthetic image to the server after a delay and exits with 200 or with the error code.
+Without -o it works as a renderer pool process: orders are read from stdin one per line and "<id> <status>" lines are written into stdout.
+The image is sent by POST request for -uhttp://host:port and through the result channel for -uunix://path.
+
+Behaviour is configured by environment variables:
+    FAKE_RENDER_DELAY       render time in seconds, default 0.2
+    FAKE_RENDER_DELAY_MPX   additional render time in seconds per megapixel of the image, default 0
+    FAKE_IMAGE_SIZE         image size in bytes, default w * h bytes
+    FAKE_FAIL_RATE          share of failed renders from 0 to 1, default 0
+"""
+import http.client
+import os
+import random
+import socket
+import sys
+import time
+from urllib.parse import urlsplit
+
+def parse_args(args):
+    """Function returns a dictionary of renderer options: option letter -> value."""
+    return {arg[1]: arg[2:] for arg in args if arg.startswith('-') and len(arg) > 1}
+
+def make_image(options):
+    """Function returns synthetic image data of the order."""
+    size = int(os.environ.get('FAKE_IMAGE_SIZE', int(options['w']) * int(options['h'])))
+    pattern = f"{options['o']} {options['x']} {options['y']} {options['s']} ".encode()
+    return (pattern * (size // len(pattern) + 1))[:size]
+
+class Sender():
+    """ A class used to send images to the server, the connection is kept between orders of a pool process. """
+
+    def __init__(self, url):
+        self.url = urlsplit(url)
+        self.conn = None
+
+    def connect(self):
+        if self.url.scheme == 'unix':
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.url.path)
+            self.conn = (sock, sock.makefile('rb'))
+        else:
+            self.conn = http.client.HTTPConnection(self.url.hostname, self.url.port, timeout=30)
+
+    def send(self, id, img_format, data):
+        """ Sends the image, returns True if the server has accepted it. """
+        if self.conn is None:
+            self.connect()
+        if self.url.scheme == 'unix':
+            sock, reader = self.conn
+            sock.sendall(f'{id} image/{img_format} {len(data)}\n'.encode() + data)
+            return int(reader.readline() or 0) == 200
+        self.conn.request('POST', '/', body=data, headers={'orderId': str(id), 'Content-Type': f'image/{img_format}'})
+        response = self.conn.getresponse()
+        response.read()
+        return response.status == 200
+
+def render(sender, options):
+    """Function emulates rendering of the order and returns its exit status."""
+    delay = float(os.environ.get('FAKE_RENDER_DELAY', 0.2))
+    delay += float(os.environ.get('FAKE_RENDER_DELAY_MPX', 0)) * int(options['w']) * int(options['h']) / 1e6
+    time.sleep(delay)
+    if random.random() < float(os.environ.get('FAKE_FAIL_RATE', 0)):
+        return int(options.get('e', 500))
+    try:
+        if sender.send(options['o'], options['f'], make_image(options)):
+            return 200
+    except (OSError, http.client.HTTPException, ValueError):
+        sender.conn = None
+    return int(options.get('e', 500))
+
+if __name__ == '__main__':
+    options = parse_args(sys.argv[1:])
+    sender = Sender(options['u'])
+    if 'o' in options:
+        sys.exit(render(sender, options))
+    # renderer pool mode
+    for line in sys.stdin:
+        order = dict(options)
+        order.update(parse_args(line.split()))
+        status = render(sender, order)
+        sys.stdout.write(f"{order['o']} {status}\n")
+        sys.stdout.flush()
@@ -0,0 +1,223 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+#!/usr/bin/python3 -uB
+""" Load generator for gis-map-server. Client threads drive the full order cycle over kept alive connections:
+an order request, status polling (or server-side waiting) and the image fetch. The report contains latency of the
+whole cycle, requests per second, share of orders which were ready on the first check and Storage hit rate from /metrics.
+"""
+import argparse
+import http.client
+import itertools
+import random
+import re
+import threading
+import time
+
+ORDER_ANSWER = re.compile(rb'orderId=(\d+), pincode=(\w+)')
+
+def percentile(values, p):
+    """Function returns the p-th percentile of the sorted list of values."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def storage_counters(host, port):
+    """Function returns (hits, misses) of Storage obtained from /metrics page, (0, 0) if the page is not available."""
+    counters = {'gis_storage_hits_total': 0.0, 'gis_storage_misses_total': 0.0}
+    try:
+        conn = http.client.HTTPConnection(host, port, timeout=10)
+        conn.request('GET', '/metrics')
+        text = conn.getresponse().read().decode()
+        conn.close()
+    except (OSError, http.client.HTTPException):
+        return 0.0, 0.0
+    for line in text.splitlines():
+        name, _, value = line.partition(' ')
+        if name in counters:
+            counters[name] = float(value)
+    return counters['gis_storage_hits_total'], counters['gis_storage_misses_total']
+
+class Client():
+    """
+    A class used to represent one client thread with its own kept alive connection.
+
+    Attributes:
+    __________
+    conn : http.client.HTTPConnection instance
+        Connection to the server.
+    requests : int
+        Number of sent requests.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.conn = None
+        self.requests = 0
+
+    def get(self, path):
+        """ Sends GET request as a GIS agent, returns (status, body). The connection is reopened once if the server has closed it. """
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=120)
+            try:
+                self.conn.request('GET', path, headers={'agent': 'gis-bench'})
+                response = self.conn.getresponse()
+                body = response.read()
+                self.requests += 1
+                if response.getheader('Connection', '').lower() == 'close':
+                    self.conn.close()
+                    self.conn = None
+                return response.status, body
+            except (OSError, http.client.HTTPException):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+
+    def order_cycle(self, query, mode, poll_interval):
+        """ Executes one order from the request till the image is obtained.
+
+        Returns
+        -------
+        ok
+            True if the image is obtained
+        first_ready
+            True if the image was ready on the first check, without waiting for rendering
+        """
+        if mode == 'tile':
+            status, body = self.get(query)
+            return status == 200, None
+        if mode == 'wait':
+            status, body = self.get(query + '&wait=60')
+            if status == 200:
+                return True, None
+        else:
+            status, body = self.get(query)
+        match = ORDER_ANSWER.search(body)
+        if match is None:
+            return False, False
+        check = f'/?orderId={int(match.group(1))}&pincode={match.group(2).decode()}'
+        if mode == 'wait':
+            check += '&wait=60'
+        first = True
+        while True:
+            status, body = self.get(check)
+            if status == 200:
+                return True, first
+            if status != 202:
+                return False, first
+            first = False
+            if mode != 'wait':
+                time.sleep(poll_interval)
+
+def order_query(region, mode, size, fmt):
+    """Function returns the request path of the region: a map order, or a tile of zoom level 12 in tile mode."""
+    if mode == 'tile':
+        return f'/tiles/12/{2300 + region % 64}/{1200 + region // 64}.{fmt}'
+    lat = 55 + (region % 100) * 0.01
+    lon = 37 + (region // 100) * 0.01
+    return f'/?lat={lat:.4f}&lon={lon:.4f}&scale=100000&w={size}&h={size}&format={fmt}'
+
+def run_load(host, port, clients=8, orders=200, regions=0, mode='poll', size=256, fmt='png', poll_interval=0.05, seed=1):
+    """Function drives orders through the server and returns a dictionary with the report.
+
+    Parameters:
+    __________
+    host : str
+        Server address.
+    port : int
+        Server port.
+    clients : int
+        Number of parallel clients.
+    orders : int
+        Total number of orders.
+    regions : int
+        Number of distinct regions, orders of one region are deduplicated by the server. 0 means every order is unique.
+    mode : str
+        poll - status is polled by the client, wait - server-side waiting with wait= parameter, tile - XYZ tile requests.
+    size : int
+        Width and height of ordered images.
+    fmt : str
+        Format of ordered images.
+    poll_interval : float
+        Time between status checks in poll mode.
+    seed : int
+        Seed of the regions sequence, equal seeds make equal loads.
+    """
+    rng = random.Random(seed)
+    queries = [order_query(rng.randrange(regions) if regions else i, mode, size, fmt) for i in range(orders)]
+    counter = itertools.count()
+    latencies, first_ready, failures = list(), list(), list()
+    workers = [Client(host, port) for i in range(clients)]
+    lock = threading.Lock()
+
+    def work(client):
+        while True:
+            i = next(counter)
+            if i >= orders:
+                return
+            start = time.monotonic()
+            try:
+                ok, ready = client.order_cycle(queries[i], mode, poll_interval)
+            except (OSError, http.client.HTTPException):
+                ok, ready = False, None
+            elapsed = time.monotonic() - start
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    failures.append(queries[i])
+                if ready is not None:
+                    first_ready.append(ready)
+
+    hits_before, misses_before = storage_counters(host, port)
+    start = time.monotonic()
+    threads = [threading.Thread(target=work, args=(client,)) for client in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.monotonic() - start
+    hits, misses = storage_counters(host, port)
+    hits, misses = hits - hits_before, misses - misses_before
+
+    latencies.sort()
+    requests = sum(client.requests for client in workers)
+    return {'orders': orders, 'failed': len(failures), 'duration': duration,
+            'orders_per_sec': len(latencies) / duration, 'requests_per_sec': requests / duration,
+            'p50_ms': percentile(latencies, 50) * 1000, 'p90_ms': percentile(latencies, 90) * 1000, 'p99_ms': percentile(latencies, 99) * 1000,
+            'first_ready': sum(first_ready) / len(first_ready) if first_ready else None,
+            'storage_hit_rate': hits / (hits + misses) if hits + misses else None}
+
+def format_report(name, report):
+    """Function returns one line of the report table."""
+    def share(value):
+        return '-' if value is None else f'{value * 100:.0f}%'
+    return (f"{name:<12} {report['orders']:>6} {report['failed']:>6} {report['orders_per_sec']:>9.1f} {report['requests_per_sec']:>9.1f} "
+            f"{report['p50_ms']:>8.1f} {report['p90_ms']:>8.1f} {report['p99_ms']:>8.1f} {share(report['first_ready']):>7} {share(report['storage_hit_rate']):>7}")
+
+# header of the report table
+REPORT_HEADER = f"{'scenario':<12} {'orders':>6} {'failed':>6} {'orders/s':>9} {'req/s':>9} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'ready1':>7} {'hits':>7}"
+
+def parse_args():
+    """ Function for parsing program arguments """
+    parser = argparse.ArgumentParser(description='gis-map-server load generator')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--clients', type=int, default=8, help='number of parallel clients')
+    parser.add_argument('--orders', type=int, default=200, help='total number of orders')
+    parser.add_argument('--regions', type=int, default=0, help='number of distinct regions, 0 - every order is unique')
+    parser.add_argument('--mode', choices=('poll', 'wait', 'tile'), default='poll')
+    parser.add_argument('--size', type=int, default=256, help='width and height of images')
+    parser.add_argument('--format', default='png')
+    parser.add_argument('--poll-interval', type=float, default=0.05)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = run_load(args.host, args.port, args.clients, args.orders, args.regions, args.mode, args.size, args.format, args.poll_interval)
+    print(REPORT_HEADER)
+    print(format_report(args.mode, report))
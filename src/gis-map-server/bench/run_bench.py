@@ -0,0 +1,165 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+#!/usr/bin/python3 -uB
+""" Benchmark of gis-map-server without gis-buffer-renderer and GIS_SHID dataset. For every scenario the server is started
+in a temporary GIS_ROOT where gis-buffer-renderer is replaced by fake_renderer.py, the load generator drives orders through it
+and one line of the report table is printed. Equal arguments make equal loads, so results of two revisions can be compared.
+"""
+import argparse
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from load_generator import run_load, format_report, REPORT_HEADER
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCH_DIR)
+
+# scenario name -> (config options, load generator arguments)
+SCENARIOS = {
+    'unique': ({}, {'mode': 'poll'}),
+    'hot': ({}, {'mode': 'poll', 'regions': 20}),
+    'wait': ({}, {'mode': 'wait', 'regions': 20}),
+    'tiles': ({}, {'mode': 'tile', 'regions': 50}),
+    'pool': ({'RENDERER_POOL_COMMAND': f'{sys.executable} -B {BENCH_DIR}/fake_renderer.py'}, {'mode': 'poll'}),
+    'socket': ({'RESULT_SOCKET_PATH': '{root}/results.sock'}, {'mode': 'poll'}),
+    'workers': ({'FRONTEND_WORKERS': '4'}, {'mode': 'poll', 'regions': 20}),
+}
+
+# scenarios driven through gis-map-router: name -> (number of nodes, load generator arguments)
+CLUSTER_SCENARIOS = {
+    'cluster': (3, {'mode': 'poll', 'regions': 60}),
+    'cluster-tile': (3, {'mode': 'tile', 'regions': 60}),
+}
+
+def make_root(root):
+    """Function creates GIS_ROOT with fake gis-buffer-renderer and gis-control, html pages of the server and the log folder."""
+    os.makedirs(f'{root}/sbin')
+    os.makedirs(f'{root}/bin')
+    os.makedirs(f'{root}/data/logs')
+    os.makedirs(f'{root}/data/resources/gis-map-server')
+    os.symlink(f'{SERVER_DIR}/html', f'{root}/data/resources/gis-map-server/html')
+    scripts = {f'{root}/sbin/gis-buffer-renderer': f'#!/bin/sh\nexec {sys.executable} -B {BENCH_DIR}/fake_renderer.py "$@"\n',
+               f'{root}/bin/gis-control': '#!/bin/sh\nexit 0\n'}
+    for path, content in scripts.items():
+        with open(path, 'w') as f:
+            f.write(content)
+        os.chmod(path, 0o755)
+
+def write_config(path, port, slots, storage_size, options):
+    """Function writes the server config with required options and scenario options."""
+    lines = [f'SERVER_ADDRESS=localhost', f'SERVER_PORT={port}', f'SLOTS_NUMBER={slots}', f'STORAGE_MAX_SIZE={storage_size}',
+             'HTML_PAGES_PATH=./data/resources/gis-map-server/html/', 'GIS_SHID=0', 'LOG_LEVEL=WARNING']
+    lines += [f'{key}={value}' for key, value in options.items()]
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def wait_port(port, timeout=10):
+    """Function waits until the server accepts connections."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+def free_port():
+    """Function returns a free TCP port."""
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+def start_process(script, config, root, args):
+    """Function starts server.py or router.py with the config in GIS_ROOT, returns Popen instance."""
+    env = dict(os.environ, GIS_ROOT=root, PATH=f"{root}/bin:{os.environ.get('PATH', '')}",
+               FAKE_RENDER_DELAY=str(args.delay), FAKE_IMAGE_SIZE=str(args.image_size))
+    return subprocess.Popen([sys.executable, '-B', f'{SERVER_DIR}/{script}', config], env=env, cwd=root,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+def stop_processes(processes):
+    """Function stops started processes with their children."""
+    for process in processes:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait()
+
+def run_cluster(name, args):
+    """Function starts render nodes and gis-map-router for the cluster scenario, drives the load through the router
+    and returns the report, None if a process has not started. Storage hit rate is not reported, the router has no /metrics."""
+    nodes, load = CLUSTER_SCENARIOS[name]
+    root = tempfile.mkdtemp(prefix='gis-bench-')
+    processes = list()
+    try:
+        make_root(root)
+        ports = [free_port() for i in range(nodes + 1)]
+        router_lines = [f'ROUTER_ADDRESS=localhost', f'ROUTER_PORT={ports[0]}', 'HTML_PAGES_PATH=./data/resources/gis-map-server/html/']
+        for i, port in enumerate(ports[1:]):
+            write_config(f'{root}/node{i}.conf', port, args.slots, args.storage_size, {'LOG_PATH': f'{root}/data/logs/node{i}'})
+            processes.append(start_process('server.py', f'{root}/node{i}.conf', root, args))
+            router_lines.append(f'NODE_{i}=localhost:{port}')
+        with open(f'{root}/router.conf', 'w') as f:
+            f.write('\n'.join(router_lines + [f'LOG_PATH={root}/data/logs/router']) + '\n')
+        processes.append(start_process('router.py', f'{root}/router.conf', root, args))
+        if not all(wait_port(port) for port in ports):
+            return None
+        return run_load('localhost', ports[0], args.clients, args.orders, load.get('regions', 0), load['mode'], args.size)
+    finally:
+        stop_processes(processes)
+        shutil.rmtree(root, ignore_errors=True)
+
+def run_scenario(name, args):
+    """Function starts the server for the scenario, drives the load and returns the report, None if the server has not started."""
+    options, load = SCENARIOS[name]
+    root = tempfile.mkdtemp(prefix='gis-bench-')
+    try:
+        make_root(root)
+        port = free_port()
+        options = {key: value.format(root=root) for key, value in options.items()}
+        write_config(f'{root}/bench.conf', port, args.slots, args.storage_size, options)
+        server = start_process('server.py', f'{root}/bench.conf', root, args)
+        try:
+            if not wait_port(port):
+                return None
+            return run_load('localhost', port, args.clients, args.orders, load.get('regions', 0), load['mode'], args.size)
+        finally:
+            stop_processes([server])
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def parse_args():
+    """ Function for parsing program arguments """
+    parser = argparse.ArgumentParser(description='gis-map-server benchmark with fake renderer')
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS) + list(CLUSTER_SCENARIOS),
+                        help=f'scenarios to run: {", ".join(list(SCENARIOS) + list(CLUSTER_SCENARIOS))}')
+    parser.add_argument('--clients', type=int, default=16, help='number of parallel clients')
+    parser.add_argument('--orders', type=int, default=200, help='number of orders of every scenario')
+    parser.add_argument('--slots', type=int, default=4, help='SLOTS_NUMBER of the server')
+    parser.add_argument('--storage-size', type=int, default=64 * 1024 * 1024, help='STORAGE_MAX_SIZE of the server')
+    parser.add_argument('--delay', type=float, default=0.05, help='render time of fake renderer in seconds')
+    parser.add_argument('--size', type=int, default=256, help='width and height of ordered images')
+    parser.add_argument('--image-size', type=int, default=65536, help='size of rendered images in bytes')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    print(REPORT_HEADER)
+    for name in args.scenarios:
+        if name in CLUSTER_SCENARIOS:
+            report = run_cluster(name, args)
+        elif name in SCENARIOS:
+            report = run_scenario(name, args)
+        else:
+            print(f'Unknown scenario {name}')
+            sys.exit(1)
+        if report is None:
+            print(f'{name:<12} server has not started')
+        else:
+            print(format_report(name, report))
@@ -0,0 +1,195 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+#!/usr/bin/python3 -uB
+import os
+import shutil
+import threading
+import time
+
+from eviction import Lru_Policy
+
+# subfolder of STORAGE_DISK_PATH with buffer files, only it is cleared at start, so the path can be a shared folder
+DISK_TIER_FOLDER = 'gis-map-server-buffers'
+
+class Disk_Buffer():
+    """
+    A class used to represent a buffer stored in a file of Disk_Storage. Data is not read into memory,
+    it is sent to the client socket directly from the file. The file is opened while it is in Disk_Storage,
+    so it stays readable even if it is evicted later, the owner has to close it.
+
+    Attributes:
+    __________
+    file : file object
+        The file with data opened for reading.
+    size : int
+        Data size in bytes.
+    offset : int
+        Offset of data in the file.
+    """
+
+    def __init__(self, file, size):
+        self.file = file
+        self.size = size
+        self.offset = 0
+
+    def __len__(self):
+        return self.size
+
+    def read(self):
+        """ Reads data from the beginning of the file and rewinds it. """
+        self.file.seek(0)
+        content = self.file.read()
+        self.file.seek(0)
+        return content
+
+    def close(self):
+        """ Closes the file. """
+        self.file.close()
+
+class Disk_Storage():
+    """
+    A class used to represent the second tier of Storage: buffers evicted from memory are written into files of a bounded folder.
+
+    Attributes:
+    __________
+    path : str
+        The path to the folder with buffer files, DISK_TIER_FOLDER of the configured folder. It is cleared at start.
+    buf_size : int
+        Maximum size of all files in bytes.
+    current_size : int
+        Current size of all files in bytes.
+    index : dict
+        Stored buffers. Key: id, val: (size, img_format, expires).
+    policy : Eviction_Policy instance
+        Policy which chooses buffers to evict, least recently used buffers are evicted by default.
+    hits : int
+        Number of successful get calls.
+    evictions : int
+        Number of files removed to free space for new buffers.
+    lock : threading.Lock
+        Lock protecting the index from parallel access.
+
+    Methods:
+    ________
+    push(id, data, img_format, expires, cost)
+        Writes data into a file and returns a list of ids evicted from the folder.
+    get(id)
+        Returns (Disk_Buffer, img_format) by id and a list of ids removed because their lifetime is over. Disk_Buffer has to be closed.
+    file_path(id)
+        Returns the path to the file of the buffer.
+    """
+
+    def __init__(self, path, buf_size, policy=None):
+        """
+        Parameters:
+        __________
+        path : str
+            The path to a folder for buffer files. Files are kept in its subfolder DISK_TIER_FOLDER which is cleared at start,
+            other content of the folder is not touched.
+        buf_size : int
+            Maximum size of all files in bytes.
+        policy : Eviction_Policy instance
+            Policy which chooses buffers to evict.
+        """
+        self.path = os.path.join(path, DISK_TIER_FOLDER)
+        self.buf_size = buf_size
+        self.current_size = 0
+        self.index = dict()
+        self.policy = Lru_Policy() if policy is None else policy
+        self.hits = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path)
+
+    def file_path(self, id):
+        """ Returns the path to the file of the buffer. """
+        return os.path.join(self.path, str(id))
+
+    def remove(self, id):
+        """ Removes the buffer file. Has to be called with the lock held. """
+        size, img_format, expires = self.index.pop(id)
+        self.policy.remove(id)
+        self.current_size -= size
+        try:
+            os.unlink(self.file_path(id))
+        except FileNotFoundError:
+            pass
+
+    def push(self, id, data, img_format, expires, cost):
+        """ Writes data into a file.
+
+        Parameters:
+        __________
+        id : int
+            An id of the order, whose data will be stored.
+        data : byte str
+            Data to store.
+        img_format : str
+            A string which specifies a format of data.
+        expires : float
+            time.monotonic() value when the data becomes invalid, None means unlimited lifetime.
+        cost : float
+            Time in seconds which was spent to render the data.
+
+        Returns
+        -------
+        deleted_ids
+            A list of ids removed from the folder, it contains id itself if data could not be written
+        """
+        size = len(data)
+        if size > self.buf_size:
+            return [id]
+        tmp_path = self.file_path(id) + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.file_path(id))
+        except OSError:
+            return [id]
+
+        deleted_ids = list()
+        with self.lock:
+            while self.buf_size < (self.current_size + size):
+                old_id = self.policy.victim()
+                self.remove(old_id)
+                self.evictions += 1
+                deleted_ids.append(old_id)
+            self.index[id] = (size, img_format, expires)
+            self.current_size += size
+            self.policy.insert(id, size, cost)
+        return deleted_ids
+
+    def get(self, id):
+        """ Returns data by id.
+
+        Parameters:
+        __________
+        id : int
+            An id of the order, whose data is stored.
+
+        Returns
+        -------
+        data
+            (Disk_Buffer, img_format) or None if there is no data with such id, Disk_Buffer has to be closed by the caller
+        deleted_ids
+            A list of ids removed because their lifetime is over
+        """
+        with self.lock:
+            entry = self.index.get(id)
+            if entry is None:
+                return None, []
+            size, img_format, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                self.remove(id)
+                return None, [id]
+            try:
+                file = open(self.file_path(id), 'rb')
+            except OSError:
+                self.remove(id)
+                return None, [id]
+            self.policy.access(id)
+            self.hits += 1
+            return (Disk_Buffer(file, size), img_format), []
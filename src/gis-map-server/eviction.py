@@ -0,0 +1,145 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+#!/usr/bin/python3 -uB
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import heapq
+import itertools
+
+class Eviction_Policy(ABC):
+    """
+    A base class for policies that choose which buffer is evicted from Storage when there is not enough space.
+    Storage calls the policy methods holding its lock, so policies do not need their own locking.
+    A policy which does not implement all methods can not be created.
+
+    Methods:
+    ________
+    insert(id, size, cost)
+        Registers a new buffer.
+    access(id)
+        Registers a read of the buffer.
+    remove(id)
+        Forgets the buffer.
+    victim()
+        Returns the id of the buffer which has to be evicted first. Storage evicts the returned buffer right after the call.
+    """
+
+    @abstractmethod
+    def insert(self, id, size, cost):
+        """ Registers a new buffer.
+
+        Parameters:
+        __________
+        id : int
+            An id of the order, whose data is stored.
+        size : int
+            Data size in bytes.
+        cost : float
+            Time in seconds which was spent to render the data.
+        """
+
+    @abstractmethod
+    def access(self, id):
+        """ Registers a read of the buffer. """
+
+    @abstractmethod
+    def remove(self, id):
+        """ Forgets the buffer. """
+
+    @abstractmethod
+    def victim(self):
+        """ Returns the id of the buffer which has to be evicted first. """
+
+class Lru_Policy(Eviction_Policy):
+    """
+    Least recently used buffer is evicted first. All operations are O(1).
+
+    Attributes:
+    __________
+    order : OrderedDict
+        Ids in the order of usage, least recently used first.
+    """
+
+    def __init__(self):
+        self.order = OrderedDict()
+
+    def insert(self, id, size, cost):
+        self.order[id] = None
+
+    def access(self, id):
+        self.order.move_to_end(id)
+
+    def remove(self, id):
+        self.order.pop(id, None)
+
+    def victim(self):
+        return next(iter(self.order))
+
+class Gdsf_Policy(Eviction_Policy):
+    """
+    GreedyDual-Size-Frequency policy. Every buffer gets priority = clock + frequency * cost / size,
+    the buffer with the lowest priority is evicted first and the clock is raised to its priority,
+    so buffers which were expensive to render, small and often requested stay in Storage longer.
+    Operations are O(log n), outdated heap elements are skipped lazily.
+
+    Attributes:
+    __________
+    clock : float
+        Priority of the last evicted buffer, it ages buffers which are not accessed.
+    entries : dict
+        Key: id, val: [priority, frequency, cost, size].
+    heap : list
+        Heap of (priority, sequence number, id).
+    """
+
+    def __init__(self):
+        self.clock = 0.0
+        self.entries = dict()
+        self.heap = list()
+        self.sequence = itertools.count()
+
+    def update(self, id, entry):
+        """ Recalculates the priority of the buffer and pushes it into the heap. """
+        entry[0] = self.clock + entry[1] * entry[2] / max(entry[3], 1)
+        heapq.heappush(self.heap, (entry[0], next(self.sequence), id))
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            # dropping outdated elements to keep the heap size proportional to the number of buffers
+            self.heap = [(p, n, i) for p, n, i in self.heap if i in self.entries and self.entries[i][0] == p]
+            heapq.heapify(self.heap)
+
+    def insert(self, id, size, cost):
+        entry = [0.0, 1, cost, size]
+        self.entries[id] = entry
+        self.update(id, entry)
+
+    def access(self, id):
+        entry = self.entries[id]
+        entry[1] += 1
+        self.update(id, entry)
+
+    def remove(self, id):
+        self.entries.pop(id, None)
+
+    def victim(self):
+        while True:
+            priority, n, id = self.heap[0]
+            entry = self.entries.get(id)
+            if entry is not None and entry[0] == priority:
+                self.clock = priority
+                return id
+            heapq.heappop(self.heap)
+
+# policies which can be chosen by STORAGE_POLICY config option
+EVICTION_POLICIES = {
+    'lru': Lru_Policy,
+    'gdsf': Gdsf_Policy,
+}
+
+def make_policy(name):
+    """ Function returns a new eviction policy instance by its name. """
+    try:
+        return EVICTION_POLICIES[name.lower()]()
+    except KeyError:
+        raise ValueError(f'Unknown eviction policy {name}, available: {", ".join(EVICTION_POLICIES)}')
@@ -0,0 +1,121 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+#!/usr/bin/python3 -uB
+import gzip
+import hashlib
+import threading
+import zlib
+from collections import OrderedDict
+
+from disk_storage import Disk_Buffer
+
+# supported content codings in order of preference
+ENCODINGS = ('gzip', 'deflate')
+
+def choose_encoding(accept_encoding):
+    """Function returns the content coding to use for the Accept-Encoding header value, None if the client accepts only identity."""
+    accepted = dict()
+    for item in (accept_encoding or '').split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        q = 1.0
+        for par in parts[1:]:
+            name, _, val = par.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(val)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    for coding in ENCODINGS:
+        if accepted.get(coding, accepted.get('*', 0.0)) > 0:
+            return coding
+    return None
+
+def read_data(data):
+    """Function returns data of the buffer entry as a bytes-like object, a Disk_Buffer is read by its read()."""
+    if isinstance(data, Disk_Buffer):
+        return data.read()
+    return data
+
+def compress(data, encoding):
+    """Function compresses data with the content coding."""
+    if encoding == 'gzip':
+        return gzip.compress(data, mtime=0)
+    return zlib.compress(data)
+
+class Response_Cache():
+    """
+    A class used to keep ETags and compressed variants of images sent to clients. Data of an order never changes,
+    so both are computed once per order and dropped when the order is evicted from the buffer.
+
+    Attributes:
+    __________
+    etags : dict
+        Quoted content hashes. Key: id, val: str.
+    variants : OrderedDict
+        Compressed images in LRU order. Key: (id, encoding), val: bytes.
+    max_size : int
+        Maximum total size of compressed images in bytes.
+    size : int
+        Current total size of compressed images in bytes.
+    lock : threading.Lock
+        Lock protecting attributes from parallel access of request handler threads.
+
+    Methods:
+    ________
+    etag(id, data)
+        Returns ETag of the order image.
+    compressed(id, data, encoding)
+        Returns the order image compressed with the content coding.
+    forget(ids)
+        Removes ETags and variants of evicted orders.
+    """
+
+    def __init__(self, max_size):
+        self.etags = dict()
+        self.variants = OrderedDict()
+        self.max_size = max_size
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def etag(self, id, data):
+        """ Returns ETag of the order image, the content hash is computed on the first call. """
+        with self.lock:
+            tag = self.etags.get(id)
+        if tag is None:
+            tag = '"' + hashlib.blake2b(read_data(data), digest_size=16).hexdigest() + '"'
+            with self.lock:
+                self.etags[id] = tag
+        return tag
+
+    def compressed(self, id, data, encoding):
+        """ Returns the order image compressed with the content coding, the image is compressed once while the variant is cached. """
+        with self.lock:
+            variant = self.variants.get((id, encoding))
+            if variant is not None:
+                self.variants.move_to_end((id, encoding))
+                return variant
+        variant = compress(read_data(data), encoding)
+        if len(variant) > self.max_size:
+            return variant
+        with self.lock:
+            if (id, encoding) not in self.variants:
+                self.variants[(id, encoding)] = variant
+                self.size += len(variant)
+            while self.size > self.max_size:
+                key, old = self.variants.popitem(last=False)
+                self.size -= len(old)
+        return variant
+
+    def forget(self, ids):
+        """ Removes ETags and compressed variants of evicted orders. """
+        with self.lock:
+            for id in ids:
+                self.etags.pop(id, None)
+                for encoding in ENCODINGS:
+                    variant = self.variants.pop((id, encoding), None)
+                    if variant is not None:
+                        self.size -= len(variant)
@@ -0,0 +1,206 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+#!/usr/bin/python3 -uB
+import bisect
+import multiprocessing
+import threading
+
+# upper bounds of render duration buckets in seconds
+RENDER_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# upper bounds of HTTP request duration buckets in seconds
+REQUEST_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5, 30)
+
+# endpoints of HTTP requests, see Handler.endpoint()
+ENDPOINTS = ('check', 'order', 'page', 'result', 'tile', 'wait', 'metrics', 'admin')
+
+# image size buckets: upper bound of pixels number -> label
+SIZE_BUCKETS = ((256 * 256, 'small'), (1024 * 1024, 'medium'), (float('inf'), 'large'))
+
+def size_bucket(w, h):
+    """Function returns the label of the image size bucket."""
+    for bound, label in SIZE_BUCKETS:
+        if w * h <= bound:
+            return label
+
+class Histogram():
+    """
+    A class used to represent a histogram of observed values with fixed buckets.
+
+    Attributes:
+    __________
+    bounds : tuple
+        Upper bounds of buckets.
+    counts : list
+        Number of observed values in every bucket (not cumulative), the last element counts values above all bounds.
+    sum : float
+        Sum of observed values.
+    count : int
+        Number of observed values.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """ Registers the value. """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def format_labels(labels):
+    """Function returns labels in Prometheus text format."""
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+def format_metric(name, kind, help, samples):
+    """Function returns lines of a counter or a gauge in Prometheus text format, samples is a list of (labels dict, value)."""
+    lines = [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+    for labels, value in samples:
+        lines.append(f'{name}{format_labels(labels)} {value}')
+    return lines
+
+def format_histogram(name, help, samples):
+    """Function returns lines of a histogram in Prometheus text format, samples is a list of (labels dict, Histogram instance)."""
+    lines = [f'# HELP {name} {help}', f'# TYPE {name} histogram']
+    for labels, histogram in samples:
+        cumulative = 0
+        for bound, count in zip(list(histogram.bounds) + ['+Inf'], histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{format_labels(dict(labels, le=bound))} {cumulative}')
+        lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+        lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+    return lines
+
+class Request_Metrics():
+    """
+    A class used to collect durations of HTTP requests handled by Net_Interface threads.
+
+    Attributes:
+    __________
+    latency : dict
+        Request durations. Key: endpoint, val: Histogram instance.
+    lock : threading.Lock
+        Lock protecting attributes from parallel access of request handler threads.
+
+    Methods:
+    ________
+    observe(endpoint, seconds)
+        Registers duration of a request.
+    snapshot()
+        Returns a copy of the histograms.
+    """
+
+    def __init__(self):
+        self.latency = dict()
+        self.lock = threading.Lock()
+
+    def observe(self, endpoint, seconds):
+        """ Registers duration of a request. """
+        with self.lock:
+            if endpoint not in self.latency:
+                self.latency[endpoint] = Histogram(REQUEST_BUCKETS)
+            self.latency[endpoint].observe(seconds)
+
+    def snapshot(self):
+        """ Returns a list of (labels dict, Histogram instance) with copies of the histograms. """
+        samples = list()
+        with self.lock:
+            for endpoint, histogram in sorted(self.latency.items()):
+                copy = Histogram(histogram.bounds)
+                copy.counts, copy.sum, copy.count = list(histogram.counts), histogram.sum, histogram.count
+                samples.append(({'endpoint': endpoint}, copy))
+        return samples
+
+class Shared_Request_Metrics():
+    """
+    A class used to collect durations of HTTP requests handled by threads of several front-end worker processes.
+    It has the interface of Request_Metrics, histograms of ENDPOINTS are kept in shared memory, so it has to be created before fork.
+
+    Attributes:
+    __________
+    values : multiprocessing.Array
+        For every endpoint: bucket counts, sum and count of its histogram.
+    width : int
+        Number of values of one endpoint.
+
+    Methods:
+    ________
+    observe(endpoint, seconds)
+        Registers duration of a request.
+    snapshot()
+        Returns a copy of the histograms.
+    """
+
+    def __init__(self):
+        self.width = len(REQUEST_BUCKETS) + 3
+        self.values = multiprocessing.Array('d', len(ENDPOINTS) * self.width)
+
+    def observe(self, endpoint, seconds):
+        """ Registers duration of a request. """
+        base = ENDPOINTS.index(endpoint) * self.width
+        with self.values.get_lock():
+            self.values[base + bisect.bisect_left(REQUEST_BUCKETS, seconds)] += 1
+            self.values[base + self.width - 2] += seconds
+            self.values[base + self.width - 1] += 1
+
+    def snapshot(self):
+        """ Returns a list of (labels dict, Histogram instance) with copies of the histograms of endpoints which have requests. """
+        with self.values.get_lock():
+            values = self.values[:]
+        samples = list()
+        for endpoint in sorted(ENDPOINTS):
+            base = ENDPOINTS.index(endpoint) * self.width
+            if not values[base + self.width - 1]:
+                continue
+            copy = Histogram(REQUEST_BUCKETS)
+            copy.counts = [int(value) for value in values[base:base + self.width - 2]]
+            copy.sum, copy.count = values[base + self.width - 2], int(values[base + self.width - 1])
+            samples.append(({'endpoint': endpoint}, copy))
+        return samples
+
+def render_metrics(scheduler_stats, storage_stats, request_samples):
+    """Function returns the text of /metrics page in Prometheus text format.
+
+    Parameters:
+    __________
+    scheduler_stats : dict
+        Counters returned by Scheduler for GET_METRICS request, None if Scheduler has not answered.
+    storage_stats : dict
+        Counters returned by Storage.stats().
+    request_samples : list
+        Request durations returned by Request_Metrics.snapshot().
+    """
+    lines = list()
+    if scheduler_stats is not None:
+        lines += format_metric('gis_scheduler_queue_length', 'gauge', 'Orders waiting for a free renderer slot.', [({}, scheduler_stats['queue'])])
+        lines += format_metric('gis_scheduler_slots_busy', 'gauge', 'Renderer slots executing orders.', [({}, scheduler_stats['slots_busy'])])
+        lines += format_metric('gis_scheduler_slots', 'gauge', 'Total number of renderer slots.', [({}, scheduler_stats['slots'])])
+        lines += format_metric('gis_scheduler_orders', 'gauge', 'Orders known to the scheduler.', [({}, scheduler_stats['orders'])])
+        lines += format_metric('gis_render_results_total', 'counter', 'Finished renders by order status.',
+                               [({'status': status}, count) for status, count in sorted(scheduler_stats['results'].items())])
+        lines += format_metric('gis_crop_orders_total', 'counter', 'Orders cropped from rendered images instead of rendering.', [({}, scheduler_stats['crops'])])
+        lines += format_metric('gis_split_orders_total', 'counter', 'Large orders stitched from parts rendered in parallel.', [({}, scheduler_stats['mosaics'])])
+        lines += format_metric('gis_prefetch_orders_total', 'counter', 'Speculative renders of windows adjacent to rendered ones.', [({}, scheduler_stats['prefetches'])])
+        lines += format_metric('gis_prefetch_cancelled_total', 'counter', 'Speculative renders cancelled for client orders.',
+                               [({}, scheduler_stats['prefetches_cancelled'])])
+        lines += format_histogram('gis_render_duration_seconds', 'Render duration by image format and size bucket.',
+                                  [({'format': fmt, 'size': size}, histogram) for (fmt, size), histogram in sorted(scheduler_stats['render_times'].items())])
+    lines += format_metric('gis_storage_bytes', 'gauge', 'Bytes of images in the memory storage.', [({}, storage_stats['size'])])
+    lines += format_metric('gis_storage_max_bytes', 'gauge', 'Capacity of the memory storage in bytes.', [({}, storage_stats['max_size'])])
+    lines += format_metric('gis_storage_entries', 'gauge', 'Images in the memory storage.', [({}, storage_stats['entries'])])
+    for name in ('hits', 'misses', 'evictions', 'expirations'):
+        lines += format_metric(f'gis_storage_{name}_total', 'counter', f'Storage {name}.', [({}, storage_stats[name])])
+    if 'disk_size' in storage_stats:
+        lines += format_metric('gis_storage_disk_bytes', 'gauge', 'Bytes of images in the disk tier.', [({}, storage_stats['disk_size'])])
+        lines += format_metric('gis_storage_disk_entries', 'gauge', 'Images in the disk tier.', [({}, storage_stats['disk_entries'])])
+        lines += format_metric('gis_storage_disk_hits_total', 'counter', 'Disk tier hits.', [({}, storage_stats['disk_hits'])])
+        lines += format_metric('gis_storage_disk_evictions_total', 'counter', 'Disk tier evictions.', [({}, storage_stats['disk_evictions'])])
+    lines += format_histogram('gis_http_request_duration_seconds', 'HTTP request duration by endpoint.', request_samples)
+    return '\n'.join(lines) + '\n'
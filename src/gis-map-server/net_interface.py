@@ -4,12 +4,28 @@
 
 #!/usr/bin/python3 -u
 import http.server, ssl
+import socket
 import logging
+import logging.handlers
+import multiprocessing
+import atexit
 import sys
 import os
 import re
+import json
+import time
+from http import HTTPStatus
+from urllib.parse import urlsplit
 from enum import Enum, unique
-from utils import Request_Status, get_log_path, get_status_desc
+from utils import Request_Status, get_log_path, get_status_desc, is_finite
+from rpc import Rpc_Client, Rpc_Method
+from order_events import Order_Events
+from disk_storage import Disk_Buffer
+from tiles import parse_tile_path, tile_params
+from result_channel import Result_Channel, store_result
+from transcoder import Transcoder, transcode_base_format, crop_enabled, split_enabled
+from http_cache import Response_Cache, choose_encoding
+from metrics import Request_Metrics, Shared_Request_Metrics, render_metrics
 
 @unique
 class Page_Type(Enum):
@@ -19,16 +35,27 @@ class Page_Type(Enum):
 
 class Handler(http.server.BaseHTTPRequestHandler):
     """ 
-    A class for http-requests handling. Instance's lifetime is limited by the time of request processing.  
+    A class for http-requests handling. Instance's lifetime is limited by the connection, HTTP/1.1 connections are kept alive
+    between requests, so every response has Content-Length. An idle connection is closed after KEEPALIVE_TIMEOUT seconds.
     
     Attributes:
     __________
-    pipe_conn : multiprocessing.connection.Connection
-        Pipe connection instance for interacting with Scheduler.
+    rpc : Rpc_Client instance
+        RPC channel for interacting with Scheduler, it is shared by all handler threads.
+    events : Order_Events instance
+        Orders execution events obtained from Scheduler.
     buffer : Storage_Class instance
         Buffer is used to store data from POST-requests obtained by Renderer.
     html_path : str
         The path to a folder with html pages that are used to responde clients.
+    persistent : Persistent_Cache instance
+        Images saved by previous server runs, None if the persistent cache is not used.
+    http_cache : Response_Cache instance
+        ETags and compressed variants of images.
+    request_metrics : Request_Metrics instance
+        Durations of handled requests.
+    settings : dict
+        Values of optional config options.
     
     Methods:
     ________
@@ -40,24 +67,78 @@ class Handler(http.server.BaseHTTPRequestHandler):
         Handles GET requests.
     bad_request(code, exc="")
         Inserts a error message obtained by code and prints an html-page into wfile. Also supports printing an exception string.
-    clear_pipe()
-        Obtains all possible data from Pipe connection if it exists.
+    restore(orderId)
+        Reads the image of the order from the persistent cache and pushes it into the buffer.
+    client_id()
+        Returns client identifier for fair share of orders execution.
+    get_order_data(orderId)
+        Returns data of a ready order.
+    wait_order(orderId, pincode, timeout)
+        Waits until the order is finished and returns its status.
+    send_image(orderId, entry)
+        Sends an image obtained from the buffer to the client and releases it.
+    send_entry(orderId, output_data, img_format)
+        Sends an image obtained from the buffer to the client.
+    send_cache_headers(etag)
+        Sends ETag and Cache-Control headers of an image.
+    parse_range(size, etag)
+        Returns the byte range of an image requested by Range header.
+    send_body(body)
+        Sends Content-Length header and the body of a response.
+    send_order(orderId, pincode, gis_agent, code)
+        Sends id and pincode of the order to the client.
+    send_waited(orderId, pincode, wait, gis_agent)
+        Waits for the order on the server and sends its image, or its id and pincode if it is not ready in time.
+    get_tile(tile)
+        Handles XYZ tile request: renders the tile if it is needed and sends it in the same response.
+    write_data(data, start, length)
+        Writes data obtained from the buffer into wfile.
+    endpoint()
+        Returns the endpoint name of the request for metrics.
+    send_metrics()
+        Sends /metrics page in Prometheus text format.
+    send_traces()
+        Sends traces of orders as JSON.
+    log_message(format, *args)
+        Writes the access log line into the log.
+    log_error(format, *args)
+        Writes the error line of http.server into the log.
     """
     
-    def __init__(self, pipe_conn, buffer, html_path, *args):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, Nagle algorithm would delay the body of kept alive connections till the ACK
+    disable_nagle_algorithm = True
+    
+    def __init__(self, rpc, events, buffer, html_path, persistent, http_cache, request_metrics, settings, *args):
         """ 
         Parameters:
         __________
-        pipe_conn : multiprocessing.connection.Connection
-            Pipe connection instance for interacting with Scheduler.
+        rpc : Rpc_Client instance
+            RPC channel for interacting with Scheduler, it is shared by all handler threads.
+        events : Order_Events instance
+            Orders execution events obtained from Scheduler.
         buffer : Storage_Class instance
             Buffer is used to store data from POST-requests obtained by Renderer.
         html_path : str
             The path to a folder with html pages that are used to responde clients.
+        persistent : Persistent_Cache instance
+            Images saved by previous server runs, None if the persistent cache is not used.
+        http_cache : Response_Cache instance
+            ETags and compressed variants of images.
+        request_metrics : Request_Metrics instance
+            Durations of handled requests.
+        settings : dict
+            Values of optional config options.
         """
-        self.pipe_conn = pipe_conn
+        self.rpc = rpc
+        self.events = events
         self.buffer = buffer
         self.html_path = html_path
+        self.persistent = persistent
+        self.http_cache = http_cache
+        self.request_metrics = request_metrics
+        self.settings = settings
+        self.timeout = settings.get('KEEPALIVE_TIMEOUT')
         http.server.BaseHTTPRequestHandler.__init__(self, *args)
     
     def get_html_content(self, page_type):
@@ -90,6 +171,7 @@ class Handler(http.server.BaseHTTPRequestHandler):
 
     def do_POST(self):
         """ Handles POST requests. """
+        start = time.monotonic()
         try:
             # trying to get payload
             logging.debug('Got POST-request')
@@ -102,33 +184,25 @@ class Handler(http.server.BaseHTTPRequestHandler):
             payload = self.rfile.read(length)
             logging.debug('Got payload')
             
-            status_code, deleted_ids = self.buffer.push(orderId, payload, img_format, length)
-            
-            #sending information to scheduler
-            self.clear_pipe()
-            self.pipe_conn.send((2, deleted_ids))
-            if self.pipe_conn.poll(1):
-                logging.debug('net_interface: got answer from scheduler')
-                answer = self.pipe_conn.recv()
-                if answer == False:
-                    self.bad_request(Request_Status.REQUEST_FAILED.value, "Scheduler could not delete previous ids from table")
-            else:
-                self.bad_request(Request_Status.TIMEOUT.value, "Scheduler did not responde")
+            status_code = store_result(self.buffer, self.events, self.persistent, orderId, payload, img_format)
             
             if status_code == Request_Status.READY.value:
                 logging.debug('Push success')
                 self.send_response(Request_Status.READY.value, "Got payload")
-                self.end_headers()
-                self.wfile.write('Accepted'.encode())
+                self.send_body('Accepted'.encode())
             else:
                 logging.debug('Error while pushing {status_code}')
                 self.bad_request(status_code, "Id is busy")
 
         except Exception as exc:
+            # the body may be unread, the connection can not be used for the next request
+            self.close_connection = True
             try:
                 self.bad_request(Request_Status.INVALID_PARAM.value, exc)
             except Exception as exc:
-                logging.debug(f"Bad connection with client {exc}")
+                logging.debug("Bad connection with client %s", exc)
+        finally:
+            self.request_metrics.observe(self.endpoint(), time.monotonic() - start)
             
     def bad_request(self, code, exc=""):
         """ Prints an html-page with error code into wfile and inserts there an error message obtained by code. Also supports printing an exception string.
@@ -143,25 +217,389 @@ class Handler(http.server.BaseHTTPRequestHandler):
         self.send_response(code)
         self.send_header("Content-type", "text/html")
         self.send_header("Access-Control-Allow-Origin", "*")
-        self.end_headers()
-        self.wfile.write('<html><head><meta charset="utf-8">'.encode())
-        self.wfile.write('<title>Bad request</title></head>'.encode())
-        self.wfile.write(f'<body><p>Bad request: {code}:{get_status_desc(code)} {exc}</p></body></html>'.encode())
+        self.send_body(('<html><head><meta charset="utf-8">'
+                        '<title>Bad request</title></head>'
+                        f'<body><p>Bad request: {code}:{get_status_desc(code)} {exc}</p></body></html>').encode())
         logging.debug('requested')
 
-    def clear_pipe(self):
-        """ Obtains all possible data from Pipe connection if it exists. """
+    def restore(self, orderId):
+        """ Reads the image of the order from the persistent cache and pushes it into the buffer.
+        
+        Parameters:
+        __________
+        orderId : int
+            An id of the order.
+            
+        Returns
+        -------
+        data
+            (data, img_format) or None if the image is not saved
+        """
+        key = self.events.order_key(orderId)
+        if self.persistent is None or key is None:
+            return None
+        entry = self.persistent.get(key)
+        if entry is not None:
+            logging.debug('Order %s is restored from persistent cache', orderId)
+            self.buffer.push(orderId, entry[0], entry[1], len(entry[0]))
+        return entry
+
+    def client_id(self):
+        """ Returns client identifier for fair share of orders execution: client address and agent.
+        The address of a client of gis-map-router is obtained from X-Forwarded-For header. """
+        address = self.headers.get('X-Forwarded-For', self.client_address[0]).split(',')[0].strip()
+        return f"{address}/{self.headers.get('agent', '')}"
+
+    def get_order_data(self, orderId):
+        """ Returns data of a ready order from the buffer or the persistent cache.
+        
+        Parameters:
+        __________
+        orderId : int
+            An id of the order with READY status.
+            
+        Returns
+        -------
+        data
+            (data, img_format) or None if data has been evicted, in that case Scheduler is notified to render the order again
+        """
+        entry = self.buffer.pop_by_id(orderId)
+        if entry is None:
+            entry = self.restore(orderId)
+        if entry is None:
+            self.rpc.notify(Rpc_Method.DELETE_IDS, [orderId])
+        return entry
+
+    def wait_order(self, orderId, pincode, timeout):
+        """ Waits until the order is finished and returns its status. Waiting is woken by ORDER_FINISHED notification, Scheduler is not polled.
+        
+        Parameters:
+        __________
+        orderId : int
+            An id of the order.
+        pincode : str
+            Pincode of the order.
+        timeout : float
+            Maximum waiting time in seconds.
+            
+        Returns
+        -------
+        status
+            Order status, TIMEOUT if the order is not finished in time
+        """
+        deadline = time.monotonic() + timeout
         while True:
-            logging.debug('clear pipe start')
-            if self.pipe_conn.poll():
-                self.pipe_conn.recv()
-                continue
-            logging.debug('clear pipe finish')
-            break
-    
+            event = self.events.watch(orderId)
+            try:
+                status = self.rpc.call(Rpc_Method.CHECK_ORDER, (orderId, pincode), 2)
+                if status is None:
+                    return Request_Status.TIMEOUT.value
+                if status != Request_Status.PROCESSING.value:
+                    return status
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return Request_Status.TIMEOUT.value
+                event.wait(remaining)
+            finally:
+                self.events.unwatch(orderId, event)
+
+    def send_image(self, orderId, entry):
+        """ Sends an image obtained from the buffer to the client. Images of COMPRESS_TYPES are compressed if the client accepts it,
+        the image has ETag of its content, so a request with the same If-None-Match gets 304 response without the image.
+        A part of the image is sent if it is requested by Range header, so an interrupted download can be resumed.
+        
+        Parameters:
+        __________
+        orderId : int
+            An id of the order.
+        entry : tuple
+            (data, img_format) obtained from the buffer.
+        """
+        try:
+            self.send_entry(orderId, *entry)
+        finally:
+            # the image of the disk tier or the shared storage is released even if the client has reset the connection
+            if isinstance(entry[0], Disk_Buffer):
+                entry[0].close()
+
+    def send_entry(self, orderId, output_data, img_format):
+        """ Sends the image, see send_image(). Data obtained from the buffer is closed by the caller. """
+        self.events.trace(orderId, 'fetched')
+        etag = self.http_cache.etag(orderId, output_data)
+        compressible = img_format in self.settings['COMPRESS_TYPES'].split()
+        encoding = None
+        # ranges are served only for the identity coding
+        if compressible and len(output_data) >= self.settings['COMPRESS_MIN_SIZE'] and 'Range' not in self.headers:
+            encoding = choose_encoding(self.headers.get('Accept-Encoding'))
+        if encoding is not None:
+            variant = self.http_cache.compressed(orderId, output_data, encoding)
+            if len(variant) < len(output_data):
+                output_data = variant
+                etag = f'{etag[:-1]}-{encoding}"'
+            else:
+                encoding = None
+        
+        if_none_match = [tag.strip().removeprefix('W/') for tag in self.headers.get('If-None-Match', '').split(',')]
+        if etag in if_none_match or '*' in if_none_match:
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_cache_headers(etag)
+            # the same Vary as the full response, so caches keep variants of different encodings apart
+            if compressible:
+                self.send_header("Vary", "Accept-Encoding")
+            self.end_headers()
+            return
+        
+        size = len(output_data)
+        byte_range = self.parse_range(size, etag) if encoding is None else None
+        if byte_range == (0, 0):
+            self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_body(b'')
+            return
+        
+        start, length = byte_range if byte_range is not None else (0, size)
+        if byte_range is not None:
+            self.send_response(HTTPStatus.PARTIAL_CONTENT)
+            self.send_header("Content-Range", f"bytes {start}-{start + length - 1}/{size}")
+        else:
+            self.send_response(Request_Status.READY.value)
+        self.send_header("Content-type", img_format)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_cache_headers(etag)
+        if compressible:
+            self.send_header("Vary", "Accept-Encoding")
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        self.end_headers()
+        self.write_data(output_data, start, length)
+
+    def parse_range(self, size, etag):
+        """ Returns the byte range of an image requested by Range header. Only one range is supported, other requests get the whole image.
+        
+        Parameters:
+        __________
+        size : int
+            Size of the image in bytes.
+        etag : str
+            ETag of the image, the range is ignored if If-Range header has another value.
+            
+        Returns
+        -------
+        range
+            (start, length) of the range, (0, 0) if the range is not satisfiable (it starts after the image or it is an empty suffix)
+            or None if the whole image has to be sent, invalid ranges are ignored
+        """
+        value = self.headers.get('Range')
+        if value is None or not value.startswith('bytes=') or ',' in value:
+            return None
+        if 'If-Range' in self.headers and self.headers['If-Range'].strip() != etag:
+            return None
+        first, _, last = value[len('bytes='):].strip().partition('-')
+        try:
+            if first:
+                start = int(first)
+                if last and int(last) < start:
+                    # the range is not valid, it is ignored
+                    return None
+                end = min(int(last), size - 1) if last else size - 1
+            else:
+                # suffix range: last bytes of the image, an empty suffix is not satisfiable
+                start = max(size - int(last), 0)
+                end = size - 1 if int(last) > 0 else -1
+        except ValueError:
+            return None
+        if start >= size or end < start:
+            return (0, 0)
+        return (start, end - start + 1)
+
+    def send_cache_headers(self, etag):
+        """ Sends ETag and Cache-Control headers of an image, CACHE_MAX_AGE = 0 makes caches revalidate the image on every request. """
+        self.send_header("ETag", etag)
+        if self.settings['CACHE_MAX_AGE'] > 0:
+            self.send_header("Cache-Control", f"public, max-age={self.settings['CACHE_MAX_AGE']}")
+        else:
+            self.send_header("Cache-Control", "no-cache")
+
+    def send_order(self, orderId, pincode, gis_agent, code=Request_Status.READY.value):
+        """ Sends id and pincode of the order to the client: as a plain string for GIS agents and as an html page for others.
+        
+        Parameters:
+        __________
+        orderId : int
+            An id of the order.
+        pincode : str
+            Pincode of the order.
+        gis_agent : bool
+            True if the client is a GIS agent.
+        code : int
+            Response code.
+        """
+        self.send_response(code)
+        self.send_header("Content-type", "text/html")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        if gis_agent:
+            self.send_body(f'orderId={orderId}, pincode={pincode}'.encode())
+        else:
+            answer = self.get_html_content(Page_Type.ORDER_REQUEST.value)
+            answer = answer.replace('ORDERID', str(orderId))
+            answer = answer.replace('PIN_CODE', pincode)
+            self.send_body(answer.encode())
+
+    def send_waited(self, orderId, pincode, wait, gis_agent):
+        """ Waits for the order on the server and sends its image. If the order is not ready in time,
+        its id and pincode are sent with PROCESSING code, so the client can continue waiting with the next request.
+        
+        Parameters:
+        __________
+        orderId : int
+            An id of the order.
+        pincode : str
+            Pincode of the order.
+        wait : str
+            Waiting time in seconds requested by the client, it is limited by MAX_WAIT_TIMEOUT option.
+        gis_agent : bool
+            True if the client is a GIS agent.
+        """
+        # float() accepts nan, a nan timeout never expires and turns waiting into a busy loop
+        if not is_finite(wait):
+            self.bad_request(Request_Status.INVALID_PARAM.value, "Bad wait value")
+            return
+        timeout = min(max(float(wait), 0), self.settings['MAX_WAIT_TIMEOUT'])
+        status = self.wait_order(orderId, pincode, timeout)
+        entry = None
+        if status == Request_Status.READY.value:
+            entry = self.get_order_data(orderId)
+            if entry is None:
+                status = Request_Status.NOMEM.value
+        if entry is not None:
+            self.send_image(orderId, entry)
+        elif status in (Request_Status.PROCESSING.value, Request_Status.TIMEOUT.value):
+            self.send_order(orderId, pincode, gis_agent, Request_Status.PROCESSING.value)
+        else:
+            self.bad_request(status)
+
+    def get_tile(self, tile):
+        """ Handles XYZ tile request: renders the tile if it is needed and sends it in the same response.
+        Tiles have fixed parameters, so equal tiles are deduplicated and cached as one order.
+        
+        Parameters:
+        __________
+        tile : tuple
+            (z, x, y, fmt) of the tile.
+        """
+        fields = tile_params(*tile, self.settings['TILE_SIZE'])
+        container = self.rpc.call(Rpc_Method.NEW_ORDER, (fields, self.client_id()), 1)
+        if container is None:
+            self.bad_request(Request_Status.TIMEOUT.value)
+            return
+        (orderId, pincode), is_valid = container
+        if not is_valid:
+            self.bad_request(Request_Status.INVALID_PARAM.value)
+            return
+        status = self.wait_order(orderId, pincode, self.settings['TILE_WAIT_TIMEOUT'])
+        entry = None
+        if status == Request_Status.READY.value:
+            entry = self.get_order_data(orderId)
+            if entry is None:
+                status = Request_Status.NOMEM.value
+        if entry is not None:
+            self.send_image(orderId, entry)
+        else:
+            self.bad_request(status)
+
+    def send_body(self, body):
+        """ Sends Content-Length header, ends headers and writes the body, so the connection can be kept alive for the next request. """
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_data(self, data, start=0, length=None):
+        """ Writes data obtained from the buffer into wfile. Data of the disk tier and of the shared storage is sent from its file by sendfile
+        without reading it into memory.
+        
+        Parameters:
+        __________
+        data : byte str, Disk_Buffer or Shared_Buffer instance
+            Data to send.
+        start : int
+            Offset of the first byte to send.
+        length : int
+            Number of bytes to send, None means till the end of data.
+        """
+        if isinstance(data, Disk_Buffer):
+            self.wfile.flush()
+            self.connection.sendfile(data.file, data.offset + start, len(data) - start if length is None else length)
+        elif start == 0 and length is None:
+            self.wfile.write(data)
+        else:
+            end = len(data) if length is None else start + length
+            self.wfile.write(memoryview(data)[start:end])
+
+    def log_message(self, format, *args):
+        """ Writes the access log line into the log instead of stderr. """
+        logging.debug('%s - ' + format, self.address_string(), *args)
+
+    def log_error(self, format, *args):
+        """ Writes the error line of http.server into the log. """
+        logging.warning('%s - ' + format, self.address_string(), *args)
+
+    def endpoint(self):
+        """ Returns the endpoint name of the request for metrics. """
+        if self.command == 'POST':
+            return 'result'
+        path = urlsplit(self.path).path
+        if path.startswith('/tiles/'):
+            return 'tile'
+        if path == '/metrics':
+            return 'metrics'
+        if path.startswith('/admin/'):
+            return 'admin'
+        if 'orderId=' in self.path:
+            return 'wait' if 'wait=' in self.path else 'check'
+        if '&' in self.path:
+            return 'order'
+        return 'page'
+
+    def send_metrics(self):
+        """ Sends /metrics page in Prometheus text format. Scheduler counters are obtained by one request, only when the page is requested. """
+        scheduler_stats = self.rpc.call(Rpc_Method.GET_METRICS, None, 2)
+        body = render_metrics(scheduler_stats, self.buffer.stats(), self.request_metrics.snapshot()).encode()
+        self.send_response(Request_Status.READY.value)
+        self.send_header("Content-type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_body(body)
+
+    def send_traces(self):
+        """ Sends /admin/traces page: a JSON list of traces of sampled orders, finished ones and ones in progress.
+        Every trace has times of passed stages (enqueued, dispatched, exited, stored, fetched) in seconds since the order is enqueued. """
+        traces = self.rpc.call(Rpc_Method.GET_TRACES, None, 2)
+        if traces is None:
+            self.bad_request(Request_Status.TIMEOUT.value)
+            return
+        self.send_response(Request_Status.READY.value)
+        self.send_header("Content-type", "application/json")
+        self.send_body(json.dumps(traces).encode())
+
     def do_GET(self):
         """ Handles POST requests. """  
+        start = time.monotonic()
         try:
+            path = urlsplit(self.path).path
+            if path == '/metrics':
+                self.send_metrics()
+                return
+            if path == '/admin/traces':
+                self.send_traces()
+                return
+            if path.startswith('/tiles/'):
+                tile = parse_tile_path(path)
+                if tile is not None:
+                    self.get_tile(tile)
+                else:
+                    self.bad_request(Request_Status.INVALID_PARAM.value, "Bad tile path")
+                return
+            
             #analyzing agent
             try:
                 if 'gis' in dict(self.headers)['agent']:
@@ -177,10 +615,9 @@ class Handler(http.server.BaseHTTPRequestHandler):
 
             if '&' in param_line:
                 for p in param_line.split('&'):
-                    print(p.split('='))
                     key, val = p.split('=')
                     fields[key] = val
-            logging.debug(f"I've got a GET request, fields = {fields} from {self.path}")
+            logging.debug("I've got a GET request, fields = %s from %s", fields, self.path)
             
             if len(fields) == 0:
                 # start page request
@@ -188,41 +625,26 @@ class Handler(http.server.BaseHTTPRequestHandler):
                 self.send_response(Request_Status.READY.value)
                 self.send_header("Content-type", "text/html")
                 self.send_header("Access-Control-Allow-Origin", "*")
-                self.end_headers()
-                self.wfile.write(answer.encode())
+                self.send_body(answer.encode())
             
             elif 'orderId' not in fields:
                 # first type of GET-request
                 
                 #sending to scheduler new order
-                self.clear_pipe()
-                self.pipe_conn.send((0, fields))
+                container = self.rpc.call(Rpc_Method.NEW_ORDER, (fields, self.client_id()), 1)
                 
                 # obtaining id from scheduler
-                if self.pipe_conn.poll(1):
+                if container is not None:
                     logging.debug('net_interface: got from scheduler')
-                    container = self.pipe_conn.recv()
-                    logging.debug(f'OBTAINED {container}')
+                    logging.debug('OBTAINED %s', container)
                     id_pin, is_valid = container
                     orderId, pincode = id_pin
-                    logging.debug(f'net_interface: got from scheduler {orderId}, {is_valid}, {pincode}')
-                    if is_valid:
-                        self.send_response(Request_Status.READY.value)
-                        logging.debug('net_interface: 0')
-                        self.send_header("Content-type", "text/html")
-                        self.send_header("Access-Control-Allow-Origin", "*")
-                        logging.debug('net_interface: 1')
-                        self.end_headers()
-                        logging.debug('net_interface: 2')
-                        if gis_agent:
-                            logging.debug('net_interface: 3')
-                            self.wfile.write(f'orderId={orderId}, pincode={pincode}'.encode())
-                        else:
-                            logging.debug('net_interface: 4')
-                            answer = self.get_html_content(Page_Type.ORDER_REQUEST.value)
-                            answer = answer.replace('ORDERID', str(orderId))
-                            answer = answer.replace('PIN_CODE', pincode)
-                            self.wfile.write(answer.encode())
+                    logging.debug('net_interface: got from scheduler %s, %s, %s', orderId, is_valid, pincode)
+                    if is_valid and 'wait' in fields:
+                        # synchronous request, image is sent in the same response
+                        self.send_waited(orderId, pincode, fields['wait'], gis_agent)
+                    elif is_valid:
+                        self.send_order(orderId, pincode, gis_agent)
                     else:
                         # internal error, bad request params
                         self.bad_request(Request_Status.INVALID_PARAM.value)
@@ -239,32 +661,48 @@ class Handler(http.server.BaseHTTPRequestHandler):
                     # asking scheduler about status of order
                     orderId = int(fields['orderId'])
                     pincode = fields['pincode']
-                    self.clear_pipe()
-                    self.pipe_conn.send((1, (orderId, pincode)))
+                    if 'wait' in fields:
+                        # long polling, image is sent as soon as it is ready
+                        self.send_waited(orderId, pincode, fields['wait'], gis_agent)
+                        return
+                    status = self.rpc.call(Rpc_Method.CHECK_ORDER, (orderId, pincode), 2)
                     
                     # obtaining id from scheduler
-                    if self.pipe_conn.poll(2):
-                        status = self.pipe_conn.recv()
+                    if status is not None:
+                        entry = None
                         if status == Request_Status.READY.value:
-                            output_data, img_format = self.buffer.pop_by_id(orderId)
-                            self.send_response(Request_Status.READY.value)
-                            self.send_header("Content-type", img_format)
-                            self.send_header("Access-Control-Allow-Origin", "*")
-                            self.end_headers()
-                            self.wfile.write(output_data)
+                            entry = self.get_order_data(orderId)
+                            if entry is None:
+                                # data has been evicted, the order has to be rendered again
+                                status = Request_Status.NOMEM.value
+                        if entry is not None:
+                            self.send_image(orderId, entry)
                         else:
-                            logging.debug(f'status: {status}')
+                            logging.debug('status: %s', status)
                             self.bad_request(status)
                     else:
                         self.bad_request(Request_Status.TIMEOUT.value)
                                 
         except Exception as exc:
-            logging.debug("Error! {0}".format(exc))
+            logging.warning("Error! %s", exc)
+            # a part of the response may be sent already, the connection can not be used for the next request
+            self.close_connection = True
             self.bad_request(Request_Status.REQUEST_FAILED.value, exc)
+        finally:
+            self.request_metrics.observe(self.endpoint(), time.monotonic() - start)
+
+class Reuse_Port_Server(http.server.ThreadingHTTPServer):
+    """ Multithreaded http server whose socket is bound with SO_REUSEPORT, so front-end worker processes listen on the same port
+    and the kernel distributes new connections between them. """
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        http.server.ThreadingHTTPServer.server_bind(self)
 
 class Net_Interface():
     """ 
-    A class to provide net-interface of map-server. For now it start http server.
+    A class to provide net-interface of map-server. It starts multithreaded http server, every request is handled in its own thread.
+    With FRONTEND_WORKERS > 1 the server is started in every worker process on the same port.
     
     Attributes:
     __________
@@ -272,16 +710,22 @@ class Net_Interface():
         IP adress or host name for the net interface module.
     port : int
         Connection port for the net interface module.
+    settings : dict
+        Values of optional config options.
+    log_listener : logging.handlers.QueueListener instance
+        Thread writing log records of all processes into the file.
+    request_metrics : Request_Metrics or Shared_Request_Metrics instance
+        Durations of handled requests, they are counted together by all worker processes.
     
     Methods:
     ________
-    init_logging(page_type)
-        Starts logging to the file, obtained by get_log_path.
-    start_server()
+    init_logging()
+        Starts logging to the file in the folder of LOG_PATH option or get_log_path.
+    start_server(pipe_conn, buffer, html_path, persistent, worker)
         Starts http server using Handler class for requests handling.
     """
     
-    def __init__(self, host, port):
+    def __init__(self, host, port, settings=None):
         """ 
         Parameters:
         __________
@@ -289,23 +733,45 @@ class Net_Interface():
             IP adress or host name for the net interface module.
         port : int
             Connection port for the net interface module.
+        settings : dict
+            Values of optional config options.
         """
         self.port = port
         self.host = host
+        self.settings = dict() if settings is None else settings
         self.init_logging()
+        # worker processes are forked later, shared counters have to be created before
+        if self.settings.get('FRONTEND_WORKERS', 1) > 1:
+            self.request_metrics = Shared_Request_Metrics()
+        else:
+            self.request_metrics = Request_Metrics()
         
     def init_logging(self):
-        """ Starts logging to the file, obtained by get_log_path. """
-        log_path = get_log_path()
+        """ Starts logging to the file in the folder of LOG_PATH option or get_log_path. Logging calls only put records into a queue, the records are written
+        into the file by a listener thread, so requests do not wait for disk I/O. The queue is shared with Scheduler process which is forked later.
+        The file is rotated when it reaches LOG_MAX_SIZE bytes, LOG_BACKUP_COUNT old files are kept. """
+        log_path = self.settings.get('LOG_PATH') or get_log_path()
         if log_path == None:
             logging.debug("Could not find GIS_ROOT environment variable")
             sys.exit(1)
             
         log_path += '/server.log'
-        logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', filename=log_path, encoding='utf-8', level=logging.DEBUG)
+        level = logging.getLevelName(self.settings.get('LOG_LEVEL', 'INFO').strip().upper())
+        if not isinstance(level, int):
+            level = logging.INFO
+        file_handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=self.settings.get('LOG_MAX_SIZE', 0),
+                                                            backupCount=self.settings.get('LOG_BACKUP_COUNT', 0), encoding='utf-8')
+        file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(message)s'))
+        log_queue = multiprocessing.Queue(-1)
+        root = logging.getLogger()
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+        root.setLevel(level)
+        self.log_listener = logging.handlers.QueueListener(log_queue, file_handler)
+        self.log_listener.start()
+        atexit.register(self.log_listener.stop)
 
-    def start_server(self, pipe_conn, buffer, html_path):
-        """ Starts http server using Handler class for requests handling. 
+    def start_server(self, pipe_conn, buffer, html_path, persistent=None, worker=0):
+        """ Starts multithreaded http server using Handler class for requests handling. 
         
         Parameters:
         __________
@@ -315,10 +781,38 @@ class Net_Interface():
             Buffer is used to store data from POST-requests obtained by Renderer.
         html_path : str
             The path to a folder with html pages that are used to responde clients.
+        persistent : Persistent_Cache instance
+            Images saved by previous server runs, None if the persistent cache is not used.
+        worker : int
+            Number of the front-end worker process, the result channel is served by the worker 0.
         """
+        rpc = Rpc_Client(pipe_conn)
+        events = Order_Events(rpc)
+        http_cache = Response_Cache(self.settings.get('COMPRESS_CACHE_MAX_SIZE', 0))
+        request_metrics = self.request_metrics
+        def deleted(ids):
+            events.forget(ids)
+            http_cache.forget(ids)
+        def evicted(ids):
+            deleted(ids)
+            rpc.notify(Rpc_Method.DELETE_IDS, ids)
+        buffer.eviction_callback = evicted
+        # ids evicted by other worker processes
+        rpc.subscribe(Rpc_Method.ORDERS_DELETED, deleted)
         def handler(*args):
-            Handler(pipe_conn, buffer, html_path, *args)
+            Handler(rpc, events, buffer, html_path, persistent, http_cache, request_metrics, self.settings, *args)
+        
+        if transcode_base_format(self.settings) is not None or crop_enabled(self.settings) or split_enabled(self.settings):
+            # derivative, cropped and stitched images are made from images rendered by Renderer
+            Transcoder(rpc, events, buffer, persistent, self.settings.get('TRANSCODE_WORKERS', 2))
+        
+        if self.settings.get('RESULT_SOCKET_PATH') and worker == 0:
+            # renderer delivers images through the local socket, the public port carries only client traffic
+            Result_Channel(self.settings['RESULT_SOCKET_PATH'], buffer, events, persistent).start()
 
-        self.net_server = http.server.HTTPServer((self.host, self.port), handler)
+        if self.settings.get('FRONTEND_WORKERS', 1) > 1:
+            self.net_server = Reuse_Port_Server((self.host, self.port), handler)
+        else:
+            self.net_server = http.server.ThreadingHTTPServer((self.host, self.port), handler)
         logging.debug('net_server Started')
         self.net_server.serve_forever()
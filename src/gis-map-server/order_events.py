@@ -0,0 +1,142 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+#!/usr/bin/python3 -uB
+import threading
+import time
+
+from rpc import Rpc_Method
+from utils import Request_Status
+
+class Order_Events():
+    """
+    A class used to represent the Net_Interface side view of orders execution, it is fed by notifications from Scheduler.
+
+    Attributes:
+    __________
+    dispatched : dict
+        Start times of renderer processes which are executing. Key: id, val: time.monotonic() value.
+    keys : dict
+        Render keys of dispatched and restored orders. Key: id, val: render key.
+    watchers : dict
+        Events of threads waiting for orders to finish. Key: id, val: list of threading.Event.
+    traced : dict
+        Stages of traced orders which are not passed yet. Key: id, val: set of stage names.
+    rpc : Rpc_Client instance
+        RPC channel for interacting with Scheduler.
+    lock : threading.Lock
+        Lock protecting attributes from parallel access of request handler threads and the RPC reader thread.
+
+    Methods:
+    ________
+    on_dispatched(payload)
+        Handles ORDER_DISPATCHED notification.
+    on_finished(payload)
+        Handles ORDER_FINISHED notification.
+    on_restored(payload)
+        Handles ORDER_RESTORED notification.
+    render_cost(id)
+        Returns time in seconds spent to render the order.
+    order_key(id)
+        Returns render key of the order.
+    forget(ids)
+        Removes information about deleted orders.
+    watch(id)
+        Returns an event which is set when the order is finished.
+    unwatch(id, event)
+        Removes the event returned by watch().
+    trace(id, stage)
+        Reports the time of the stage of a traced order to Scheduler.
+    """
+
+    def __init__(self, rpc):
+        """
+        Parameters:
+        __________
+        rpc : Rpc_Client instance
+            RPC channel for interacting with Scheduler.
+        """
+        self.dispatched = dict()
+        self.keys = dict()
+        self.watchers = dict()
+        self.traced = dict()
+        self.rpc = rpc
+        self.lock = threading.Lock()
+        rpc.subscribe(Rpc_Method.ORDER_DISPATCHED, self.on_dispatched)
+        rpc.subscribe(Rpc_Method.ORDER_FINISHED, self.on_finished)
+        rpc.subscribe(Rpc_Method.ORDER_RESTORED, self.on_restored)
+
+    def on_dispatched(self, payload):
+        """ Handles ORDER_DISPATCHED notification, payload is (id, time.monotonic() value of renderer start, render key, True if the order is traced). """
+        id, started, key, traced = payload
+        with self.lock:
+            self.dispatched[id] = started
+            self.keys[id] = key
+            if traced:
+                self.traced[id] = {'stored', 'fetched'}
+
+    def on_finished(self, payload):
+        """ Handles ORDER_FINISHED notification, payload is (id, status). """
+        id, status = payload
+        with self.lock:
+            self.dispatched.pop(id, None)
+            if status != Request_Status.READY.value:
+                self.keys.pop(id, None)
+            for event in self.watchers.pop(id, list()):
+                event.set()
+
+    def on_restored(self, payload):
+        """ Handles ORDER_RESTORED notification, payload is (id, render key) of an order whose image is saved in the persistent cache. """
+        id, key = payload
+        with self.lock:
+            self.keys[id] = key
+
+    def render_cost(self, id):
+        """ Returns time in seconds spent to render the order, from renderer start till now, or None if the start time is unknown. """
+        with self.lock:
+            started = self.dispatched.pop(id, None)
+        if started is None:
+            return None
+        return time.monotonic() - started
+
+    def order_key(self, id):
+        """ Returns render key of the order or None if it is unknown. """
+        with self.lock:
+            return self.keys.get(id)
+
+    def forget(self, ids):
+        """ Removes information about deleted orders. """
+        with self.lock:
+            for id in ids:
+                self.dispatched.pop(id, None)
+                self.keys.pop(id, None)
+                self.traced.pop(id, None)
+
+    def watch(self, id):
+        """ Returns an event which is set when the order is finished. The event has to be created before the order status is checked,
+        otherwise the notification can come between the check and the call, and the event would never be set. """
+        event = threading.Event()
+        with self.lock:
+            self.watchers.setdefault(id, list()).append(event)
+        return event
+
+    def unwatch(self, id, event):
+        """ Removes the event returned by watch(). """
+        with self.lock:
+            events = self.watchers.get(id)
+            if events is not None and event in events:
+                events.remove(event)
+                if not events:
+                    self.watchers.pop(id)
+
+    def trace(self, id, stage):
+        """ Reports time.monotonic() value of the stage of a traced order to Scheduler, every stage is reported once. """
+        with self.lock:
+            stages = self.traced.get(id)
+            if stages is None or stage not in stages:
+                return
+            stages.remove(stage)
+            if not stages:
+                self.traced.pop(id)
+        self.rpc.notify(Rpc_Method.ORDER_TRACE, (id, stage, time.monotonic()))
@@ -0,0 +1,114 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+#!/usr/bin/python3 -uB
+import heapq
+import itertools
+
+class Order_Queue():
+    """
+    A priority queue of orders waiting for execution with fair share between clients (start-time fair queueing).
+    Every client has a virtual finish time which grows by the cost of its orders, so a client which has queued
+    many orders does not delay orders of other clients. Orders with lower priority value are executed first,
+    orders of one priority are ordered by their virtual start time. Orders whose deadline has passed are dropped on pop.
+    push, pop and remove are O(log n), removed orders are skipped lazily.
+
+    Attributes:
+    __________
+    heap : list
+        Heap of (priority, virtual start time, sequence number, id).
+    entries : dict
+        Queued orders. Key: id, val: (heap element, deadline).
+    finish_times : dict
+        Virtual finish time of the last queued order of every client. Key: client, val: virtual time.
+    virtual_time : float
+        Virtual start time of the last popped order.
+
+    Methods:
+    ________
+    push(id, client, cost, priority, deadline)
+        Adds the order into the queue.
+    pop(now)
+        Removes and returns the next order id and a list of ids dropped because their deadline has passed.
+    remove(id)
+        Removes the order from the queue.
+    """
+
+    def __init__(self):
+        self.heap = list()
+        self.entries = dict()
+        self.finish_times = dict()
+        self.virtual_time = 0.0
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, id):
+        return id in self.entries
+
+    def push(self, id, client='', cost=1.0, priority=0, deadline=None):
+        """ Adds the order into the queue.
+
+        Parameters:
+        __________
+        id : int
+            An id of the order.
+        client : str
+            Client identifier, orders of different clients share execution fairly.
+        cost : float
+            Relative cost of the order execution.
+        priority : int
+            Priority class, orders with lower value are executed first.
+        deadline : float
+            time.monotonic() value after which the order is dropped, None means no deadline.
+        """
+        start = max(self.virtual_time, self.finish_times.get(client, 0.0))
+        self.finish_times[client] = start + cost
+        element = (priority, start, next(self.sequence), id)
+        self.entries[id] = (element, deadline)
+        heapq.heappush(self.heap, element)
+
+    def remove(self, id):
+        """ Removes the order from the queue. """
+        self.entries.pop(id, None)
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [element for element, deadline in self.entries.values()]
+            heapq.heapify(self.heap)
+
+    def pop(self, now):
+        """ Removes and returns the next order.
+
+        Parameters:
+        __________
+        now : float
+            Current time.monotonic() value to check deadlines.
+
+        Returns
+        -------
+        id
+            An id of the next order or None if the queue is empty
+        expired_ids
+            A list of ids dropped because their deadline has passed
+        """
+        expired_ids = list()
+        while self.heap:
+            element = heapq.heappop(self.heap)
+            id = element[3]
+            entry = self.entries.get(id)
+            if entry is None or entry[0] is not element:
+                continue
+            del self.entries[id]
+            if entry[1] is not None and entry[1] <= now:
+                expired_ids.append(id)
+                continue
+            self.virtual_time = element[1]
+            self.prune()
+            return id, expired_ids
+        return None, expired_ids
+
+    def prune(self):
+        """ Forgets clients whose virtual finish time has passed, they have no advantage over new clients. """
+        if len(self.finish_times) > 1024:
+            self.finish_times = {client: finish for client, finish in self.finish_times.items() if finish > self.virtual_time}
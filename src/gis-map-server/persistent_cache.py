@@ -0,0 +1,138 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+#!/usr/bin/python3 -uB
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+from utils import key_text
+
+class Persistent_Cache():
+    """
+    A class used to represent rendered images saved into SQLite database, so they survive server restarts.
+    Images are keyed by text form of the render key and map data id (GIS_SHID). Nothing is loaded at start, images are read on demand.
+    Scheduler uses contains() to find out that an order does not need rendering, Net_Interface reads and writes images.
+    Every process has to create its own instance after fork.
+
+    Attributes:
+    __________
+    path : str
+        The path to the database file.
+    max_size : int
+        Maximum size of all images of the map data in bytes, 0 means unlimited size.
+    sharedMemoryId : str
+        Map data id, images of other map data are ignored.
+    connection : sqlite3.Connection
+        Database connection shared by threads of the process.
+    lock : threading.Lock
+        Lock protecting the connection from parallel access.
+    writes : queue.Queue
+        Images waiting to be written by the writer thread.
+
+    Methods:
+    ________
+    contains(key)
+        Checks if the image with such key is saved.
+    get(key)
+        Reads the image.
+    put(key, img_format, data)
+        Schedules writing of the image, it is written by the writer thread.
+    write_images()
+        Writer thread loop: saves images and removes least recently used ones when the size limit is exceeded.
+    """
+
+    def __init__(self, path, max_size, sharedMemoryId, writer=True):
+        """
+        Parameters:
+        __________
+        path : str
+            The path to the database file.
+        max_size : int
+            Maximum size of all images of the map data in bytes, 0 means unlimited size.
+        sharedMemoryId : str
+            Map data id.
+        writer : bool
+            Starts the writer thread if True, instances which only read images do not need it.
+        """
+        self.path = path
+        self.max_size = max_size
+        self.sharedMemoryId = str(sharedMemoryId)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS renders (key TEXT, shid TEXT, img_format TEXT, data BLOB, size INTEGER, last_access REAL, '
+                                    'PRIMARY KEY (key, shid))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS renders_access ON renders (shid, last_access)')
+        self.writes = queue.Queue()
+        if writer:
+            threading.Thread(target=self.write_images, daemon=True).start()
+
+    def contains(self, key):
+        """ Checks if the image with such key is saved. """
+        with self.lock:
+            row = self.connection.execute('SELECT 1 FROM renders WHERE key=? AND shid=?', (key_text(key), self.sharedMemoryId)).fetchone()
+        return row is not None
+
+    def get(self, key):
+        """ Reads the image.
+
+        Parameters:
+        __________
+        key : tuple
+            Render key of the image.
+
+        Returns
+        -------
+        data
+            (data, img_format) or None if there is no image with such key
+        """
+        key = key_text(key)
+        with self.lock:
+            row = self.connection.execute('SELECT data, img_format FROM renders WHERE key=? AND shid=?', (key, self.sharedMemoryId)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute('UPDATE renders SET last_access=? WHERE key=? AND shid=?', (time.time(), key, self.sharedMemoryId))
+        return bytes(row[0]), row[1]
+
+    def put(self, key, img_format, data):
+        """ Schedules writing of the image, it is written by the writer thread.
+
+        Parameters:
+        __________
+        key : tuple
+            Render key of the image.
+        img_format : str
+            A string which specifies a format of data.
+        data : byte str
+            Image data.
+        """
+        self.writes.put((key_text(key), img_format, data))
+
+    def write_images(self):
+        """ Writer thread loop: saves images and removes least recently used ones when the size limit is exceeded. """
+        with self.lock:
+            total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM renders WHERE shid=?', (self.sharedMemoryId,)).fetchone()[0]
+        while True:
+            key, img_format, data = self.writes.get()
+            try:
+                with self.lock:
+                    old = self.connection.execute('SELECT size FROM renders WHERE key=? AND shid=?', (key, self.sharedMemoryId)).fetchone()
+                    self.connection.execute('INSERT OR REPLACE INTO renders VALUES (?, ?, ?, ?, ?, ?)',
+                                            (key, self.sharedMemoryId, img_format, data, len(data), time.time()))
+                    total += len(data) - (old[0] if old else 0)
+                    if self.max_size > 0 and total > self.max_size:
+                        rows = self.connection.execute('SELECT key, size FROM renders WHERE shid=? ORDER BY last_access', (self.sharedMemoryId,)).fetchall()
+                        removed = list()
+                        for old_key, size in rows:
+                            if total <= self.max_size:
+                                break
+                            removed.append((old_key, self.sharedMemoryId))
+                            total -= size
+                        self.connection.executemany('DELETE FROM renders WHERE key=? AND shid=?', removed)
+            except sqlite3.Error as exc:
+                logging.warning('Persistent cache: could not save image %s: %s', key, exc)
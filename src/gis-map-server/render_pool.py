@@ -0,0 +1,194 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+#!/usr/bin/python3 -uB
+import os
+import logging
+import shlex
+import subprocess
+
+from utils import Request_Status
+
+class Render_Job():
+    """
+    An order executed by a pool process. It has the same poll() and returncode interface as subprocess.Popen,
+    so Scheduler handles pool jobs and spawned renderer processes in the same way.
+
+    Attributes:
+    __________
+    id : int
+        An id of the order.
+    returncode : int
+        Status of the finished order, None while the order is executing.
+    """
+
+    def __init__(self, id):
+        self.id = id
+        self.returncode = None
+
+    def poll(self):
+        """ Returns status of the finished order or None while it is executing. """
+        return self.returncode
+
+class Pool_Process():
+    """
+    A long-lived renderer process. Orders are written into its stdin one per line as renderer arguments
+    (-o<id> -x<lon> -y<lat> -s<scale> -w<w> -h<h> -f<format>), the process renders them one by one
+    and writes "<id> <status>" lines into its stdout.
+
+    Attributes:
+    __________
+    job : Render_Job instance
+        The order which is executing, None if the process is idle.
+    process : subprocess.Popen instance
+        The renderer process, None after the process is closed.
+    buffer : bytes
+        Received part of an unfinished stdout line.
+    """
+
+    def __init__(self, command):
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        os.set_blocking(self.process.stdout.fileno(), False)
+        self.job = None
+        self.buffer = b''
+
+    def fileno(self):
+        return self.process.stdout.fileno()
+
+    def send(self, job, args):
+        """ Writes the order into stdin of the process. """
+        self.job = job
+        self.process.stdin.write((' '.join(args) + '\n').encode())
+        self.process.stdin.flush()
+
+    def read_results(self):
+        """ Reads available lines from stdout of the process and finishes its job.
+
+        Returns
+        -------
+        alive
+            False if the process has closed its stdout
+        """
+        while True:
+            try:
+                data = os.read(self.fileno(), 4096)
+            except BlockingIOError:
+                return True
+            if not data:
+                return False
+            lines = (self.buffer + data).split(b'\n')
+            self.buffer = lines.pop()
+            for line in lines:
+                try:
+                    id, status = map(int, line.split())
+                except ValueError:
+                    logging.debug('Renderer pool process sent bad line: %s', line)
+                    continue
+                if self.job is not None and self.job.id == id:
+                    self.job.returncode = status
+                    self.job = None
+
+    def close(self):
+        """ Stops the process. """
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.kill()
+        self.process.wait()
+        self.process.stdout.close()
+        self.process = None
+        self.job = None
+
+class Render_Pool():
+    """
+    A pool of long-lived renderer processes. A process attaches to shared memory once and renders a stream of orders,
+    so orders do not pay for process start-up. The order of a process which exits fails, the process is restarted
+    when the next order is sent to it.
+
+    Attributes:
+    __________
+    command : list
+        Command line of a pool process.
+    processes : list
+        Pool_Process instances.
+
+    Methods:
+    ________
+    start_job(id, args)
+        Sends the order to an idle process and returns Render_Job instance.
+    fds()
+        Returns stdout descriptors of the processes to wait for results.
+    read_results()
+        Reads results from all processes, orders of processes which exited fail.
+    cancel(job)
+        Stops the process executing the job.
+    close()
+        Stops all processes.
+    """
+
+    def __init__(self, command, size, common_args):
+        """
+        Parameters:
+        __________
+        command : str
+            Command line of the renderer which supports pool mode.
+        size : int
+            A number of processes.
+        common_args : list
+            Arguments which are the same for all orders (net interface address, error code, shared memory id).
+        """
+        self.command = shlex.split(command) + list(common_args)
+        self.processes = [Pool_Process(self.command) for i in range(size)]
+
+    def start_job(self, id, args):
+        """ Sends the order to an idle process, returns Render_Job instance or None if all processes are busy. """
+        for num, proc in enumerate(self.processes):
+            if proc.job is not None:
+                continue
+            job = Render_Job(id)
+            try:
+                if proc.process is None or proc.process.poll() is not None:
+                    proc = self.restart(num)
+                proc.send(job, args)
+            except OSError as exc:
+                logging.debug('Renderer pool process does not accept orders: %s', exc)
+                job.returncode = Request_Status.RENDER_FAILED.value
+                if proc.process is not None:
+                    proc.close()
+            return job
+        return None
+
+    def fds(self):
+        """ Returns stdout descriptors of the processes to wait for results. """
+        return [proc.fileno() for proc in self.processes if proc.process is not None]
+
+    def read_results(self):
+        """ Reads results from all processes. Orders of processes which exited fail. """
+        for proc in self.processes:
+            if proc.process is None or proc.read_results():
+                continue
+            logging.warning('Renderer pool process %s exited', proc.process.pid)
+            if proc.job is not None:
+                proc.job.returncode = Request_Status.RENDER_FAILED.value
+            proc.close()
+
+    def cancel(self, job):
+        """ Stops the process executing the job, the process is restarted when the next order is sent to it. """
+        for proc in self.processes:
+            if proc.job is job and proc.process is not None:
+                proc.close()
+
+    def restart(self, num):
+        """ Replaces the process with index = num by a new one. """
+        if self.processes[num].process is not None:
+            self.processes[num].close()
+        self.processes[num] = Pool_Process(self.command)
+        return self.processes[num]
+
+    def close(self):
+        """ Stops all processes. """
+        for proc in self.processes:
+            if proc.process is not None:
+                proc.close()
@@ -0,0 +1,93 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+#!/usr/bin/python3 -uB
+import os
+import logging
+import socketserver
+import threading
+
+from utils import Request_Status
+
+def store_result(buffer, events, persistent, orderId, payload, img_format):
+    """ Function pushes an image obtained from Renderer into the buffer and saves it into the persistent cache,
+    returns new order status. Evicted ids are passed to Scheduler by the storage eviction callback. """
+    status_code, deleted_ids = buffer.push(orderId, payload, img_format, len(payload), cost=events.render_cost(orderId))
+    if status_code == Request_Status.READY.value:
+        events.trace(orderId, 'stored')
+        key = events.order_key(orderId)
+        if persistent is not None and key is not None:
+            persistent.put(key, img_format, payload)
+    return status_code
+
+class Result_Handler(socketserver.StreamRequestHandler):
+    """
+    A class for handling a connection of Renderer to the result channel. A connection carries a stream of frames,
+    so a long-lived renderer process can keep one connection for all its orders.
+    A frame is a header line "<orderId> <img_format> <length>\\n" followed by length bytes of the image,
+    the answer is a line "<status>\\n" where status is READY if the image is stored.
+    """
+
+    def handle(self):
+        while True:
+            header = self.rfile.readline()
+            if not header:
+                return
+            try:
+                orderId, img_format, length = header.split()
+                orderId, length = int(orderId), int(length)
+                img_format = img_format.decode()
+            except ValueError:
+                logging.debug('Result channel got bad header: %s', header)
+                return
+            payload = self.rfile.read(length)
+            if len(payload) < length:
+                logging.debug('Result channel connection is closed while reading data of order %s', orderId)
+                return
+            status_code = store_result(self.server.buffer, self.server.events, self.server.persistent, orderId, payload, img_format)
+            logging.debug('Result channel got order %s, status %s', orderId, status_code)
+            self.wfile.write(f'{status_code}\n'.encode())
+
+class Result_Channel(socketserver.ThreadingUnixStreamServer):
+    """
+    A Unix domain socket which Renderer uses to deliver images instead of POST requests to the public port,
+    so renderer uploads do not compete with client traffic and do not pass HTTP parsing.
+    Renderer gets it as -uunix://<path> argument instead of the server URL, so the renderer has to support such URLs,
+    a renderer which only posts results over HTTP fails every order when the channel is configured.
+
+    Attributes:
+    __________
+    path : str
+        The path of the socket.
+    buffer : Storage_Class instance
+        Buffer is used to store images obtained by Renderer.
+    events : Order_Events instance
+        Orders execution events obtained from Scheduler.
+    persistent : Persistent_Cache instance
+        Images saved by previous server runs, None if the persistent cache is not used.
+
+    Methods:
+    ________
+    start()
+        Starts serving connections in a background thread.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, buffer, events, persistent):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self.path = path
+        self.buffer = buffer
+        self.events = events
+        self.persistent = persistent
+        socketserver.ThreadingUnixStreamServer.__init__(self, path, Result_Handler)
+
+    def start(self):
+        """ Starts serving connections in a background thread. """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        logging.debug('Result channel is listening on %s', self.path)
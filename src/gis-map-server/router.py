@@ -0,0 +1,434 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+#!/usr/bin/python3 -uB
+""" gis-map-router: the front of a cluster of gis-map-server render nodes. An order is routed by its region to a node chosen
+on a consistent hash ring, so every region is rendered and cached on one node, and adding or removing a node moves only
+regions of its part of the ring. Order ids given to clients contain the node number, so status requests go to the node
+which has the order. New orders of an unavailable node are sent to the next node of the ring. SIGHUP reloads the config.
+"""
+import argparse
+import bisect
+import hashlib
+import http
+import http.client
+import http.server
+import logging
+import os
+import re
+import signal
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+from utils import Request_Status, canonical_params, render_key, key_text, get_log_path
+from tiles import parse_tile_path, tile_params
+from net_interface import Handler, Page_Type
+from server import read_config
+
+# node numbers are from 0 to MAX_NODES - 1, they are encoded into order ids
+MAX_NODES = 256
+
+# answer of a node for a new order
+ORDER_ANSWER = re.compile(rb'orderId=(\d+), pincode=(\w+)')
+
+# request headers passed to nodes
+FORWARDED_HEADERS = ('If-None-Match', 'If-Range', 'Range', 'Accept-Encoding')
+
+# response headers which are not passed to clients, Content-Length is sent by send_body
+HOP_HEADERS = ('connection', 'keep-alive', 'transfer-encoding', 'content-length')
+
+# optional config options: name -> (type, default value)
+ROUTER_SETTINGS = {
+    'ROUTER_VNODES': (int, 100),
+    'ROUTER_RETRY_INTERVAL': (float, 5),
+    'ROUTER_TIMEOUT': (float, 90),
+    'KEY_QUANTUM_PIXELS': (float, 0),
+    'TILE_SIZE': (int, 256),
+    'KEEPALIVE_TIMEOUT': (float, 30),
+    'LOG_LEVEL': (str, 'INFO'),
+    'LOG_PATH': (str, ''),
+}
+
+def global_id(node, orderId):
+    """Function returns the order id given to clients for the order id of the node."""
+    return orderId * MAX_NODES + node
+
+def split_id(orderId):
+    """Function returns (node number, order id of the node) for the order id given to clients."""
+    return orderId % MAX_NODES, orderId // MAX_NODES
+
+def ring_hash(text):
+    """Function returns the position of the text on the hash ring."""
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), 'big')
+
+def region_key(fields, quantum=0):
+    """Function returns the routing key of order parameters: the render key without the format and derivative parameters,
+    so all images of a region, including ones transcoded from one base image, are made by one node.
+    Parameters which are not valid are routed by their text, the node rejects them."""
+    try:
+        return key_text(render_key(canonical_params(fields, quantum))[:5])
+    except (KeyError, ValueError, ArithmeticError):
+        return '&'.join(f'{key}={val}' for key, val in sorted(fields.items()))
+
+class Hash_Ring():
+    """
+    A class used to represent a consistent hash ring of nodes. Every node is placed on the ring in vnodes points,
+    a key belongs to the node of the first point after the key position.
+
+    Attributes:
+    __________
+    vnodes : int
+        Number of points of every node.
+    points : list
+        Sorted positions of points.
+    owners : list
+        Node numbers of points in the same order.
+
+    Methods:
+    ________
+    add(node)
+        Places the node on the ring.
+    remove(node)
+        Removes the node from the ring.
+    lookup(key)
+        Returns node numbers in the order of preference for the key.
+    """
+
+    def __init__(self, vnodes=100):
+        self.vnodes = vnodes
+        self.points = list()
+        self.owners = list()
+
+    def add(self, node):
+        """ Places the node on the ring, points are computed from the node number, so they do not depend on the node address. """
+        for i in range(self.vnodes):
+            position = ring_hash(f'node-{node}-{i}')
+            index = bisect.bisect(self.points, position)
+            self.points.insert(index, position)
+            self.owners.insert(index, node)
+
+    def remove(self, node):
+        """ Removes the node from the ring. """
+        kept = [(p, n) for p, n in zip(self.points, self.owners) if n != node]
+        self.points = [p for p, n in kept]
+        self.owners = [n for p, n in kept]
+
+    def lookup(self, key):
+        """ Returns a list of distinct node numbers in the order of points after the key position: the owner of the key first,
+        then nodes which take the key when previous ones are unavailable. """
+        nodes = list()
+        start = bisect.bisect(self.points, ring_hash(key))
+        for i in range(len(self.points)):
+            node = self.owners[(start + i) % len(self.points)]
+            if node not in nodes:
+                nodes.append(node)
+        return nodes
+
+class Backend_Node():
+    """
+    A class used to represent a gis-map-server render node.
+
+    Attributes:
+    __________
+    number : int
+        Node number, it is a part of order ids.
+    host : str
+        Node address.
+    port : int
+        Node port.
+    down_until : float
+        time.monotonic() value until which the node is considered unavailable.
+    """
+
+    def __init__(self, number, host, port):
+        self.number = number
+        self.host = host
+        self.port = port
+        self.down_until = 0.0
+
+    def alive(self):
+        """ Checks if the node is considered available. """
+        return time.monotonic() >= self.down_until
+
+    def fail(self, interval):
+        """ Marks the node unavailable for interval seconds. """
+        self.down_until = time.monotonic() + interval
+        logging.warning('Node %s (%s:%s) is not available', self.number, self.host, self.port)
+
+def parse_router_config(path):
+    """ Function parses router config and returns address, port, html path, a dictionary of nodes by number and optional settings.
+    Nodes are set as NODE_<number>=host:port. """
+    options = read_config(path)
+    nodes = dict()
+    for key, val in options.items():
+        if key.startswith('NODE_'):
+            number = int(key[len('NODE_'):])
+            if not 0 <= number < MAX_NODES:
+                raise ValueError(f'Node number {number} is out of range 0..{MAX_NODES - 1}')
+            host, port = val.rsplit(':', 1)
+            nodes[number] = Backend_Node(number, host, int(port))
+    if not nodes:
+        raise ValueError('No NODE_<number> options')
+    settings = dict()
+    for key, (cast, default) in ROUTER_SETTINGS.items():
+        settings[key] = cast(options[key]) if key in options else default
+    return options['ROUTER_ADDRESS'], int(options['ROUTER_PORT']), options['HTML_PAGES_PATH'], nodes, settings
+
+class Router():
+    """
+    A class used to represent the routing state: nodes and the ring. reload() replaces them while handler threads use them,
+    so nodes of the ring which are not in nodes any more are skipped.
+
+    Attributes:
+    __________
+    config_path : str
+        The path to the router config.
+    nodes : dict
+        Render nodes. Key: node number, val: Backend_Node instance.
+    ring : Hash_Ring instance
+        The ring of node numbers.
+    settings : dict
+        Values of optional config options, see ROUTER_SETTINGS.
+    connections : threading.local
+        Kept alive connections of the handler thread to nodes, a dictionary by node number.
+
+    Methods:
+    ________
+    reload()
+        Reads nodes from the config and rebuilds the ring.
+    on_sighup(signum, frame)
+        Reloads the config, the current nodes are kept if it is not valid.
+    route(key)
+        Returns available nodes in the order of preference for the key.
+    forward(node, path, headers)
+        Sends GET request to the node and returns its response.
+    """
+
+    def __init__(self, config_path):
+        self.config_path = config_path
+        self.connections = threading.local()
+        self.nodes = dict()
+        self.ring = None
+        self.reload()
+
+    def reload(self):
+        """ Reads nodes from the config and rebuilds the ring. Unavailable nodes stay unavailable if their address is not changed. """
+        address, port, html_path, nodes, settings = parse_router_config(self.config_path)
+        ring = Hash_Ring(settings['ROUTER_VNODES'])
+        for number, node in nodes.items():
+            old = self.nodes.get(number)
+            if old is not None and (old.host, old.port) == (node.host, node.port):
+                nodes[number] = old
+            ring.add(number)
+        self.settings = settings
+        self.nodes, self.ring = nodes, ring
+        logging.info('Router nodes: %s', ', '.join(f'{n}={node.host}:{node.port}' for n, node in sorted(nodes.items())))
+
+    def on_sighup(self, signum, frame):
+        """ Reloads the config, the current nodes are kept if it is not valid. """
+        try:
+            self.reload()
+        except Exception as exc:
+            logging.error('Router config is not reloaded: %s', exc)
+
+    def route(self, key):
+        """ Returns available nodes in the order of preference for the key. If all nodes are unavailable, all of them are returned,
+        so requests are not refused while the nodes may be up already. """
+        nodes, ring = self.nodes, self.ring
+        ordered = [nodes[n] for n in ring.lookup(key) if n in nodes]
+        return [node for node in ordered if node.alive()] or ordered
+
+    def forward(self, node, path, headers):
+        """ Sends GET request to the node through the kept alive connection of the thread.
+
+        Returns
+        -------
+        response
+            (status, list of headers, body)
+        """
+        connections = getattr(self.connections, 'nodes', None)
+        if connections is None:
+            connections = self.connections.nodes = dict()
+        conn = connections.get(node.number)
+        if conn is None or (conn.host, conn.port) != (node.host, node.port):
+            conn = connections[node.number] = http.client.HTTPConnection(node.host, node.port, timeout=self.settings['ROUTER_TIMEOUT'])
+        for attempt in range(2):
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                return response.status, response.getheaders(), response.read()
+            except (OSError, http.client.HTTPException):
+                # the node may have closed the kept alive connection, a new one is tried once
+                conn.close()
+                if attempt:
+                    raise
+
+class Router_Handler(Handler):
+    """
+    A class for handling requests of router clients. Pages and answers for orders are made like gis-map-server does,
+    images are passed from nodes as they are.
+
+    Attributes:
+    __________
+    router : Router instance
+        Nodes and the ring.
+
+    Methods:
+    ________
+    node_headers()
+        Returns request headers for a node.
+    send_answer(node, response, gis_agent)
+        Sends the response of the node to the client.
+    new_order(key, gis_agent)
+        Sends the request to the node of the key, the next nodes are tried if it is unavailable.
+    existing_order(fields, gis_agent)
+        Sends the request for an order to the node which has the order.
+    """
+
+    def __init__(self, router, html_path, *args):
+        self.router = router
+        self.html_path = html_path
+        self.settings = router.settings
+        self.timeout = router.settings['KEEPALIVE_TIMEOUT']
+        http.server.BaseHTTPRequestHandler.__init__(self, *args)
+
+    def node_headers(self):
+        """ Returns request headers for a node: conditional, range and encoding headers of the client, the client address,
+        and an agent containing 'gis', so the node answers for new orders as for a GIS agent. """
+        headers = {name: self.headers[name] for name in FORWARDED_HEADERS if name in self.headers}
+        headers['agent'] = f"gis-map-router/{self.headers.get('agent', '')}"
+        headers['X-Forwarded-For'] = self.client_address[0]
+        return headers
+
+    def send_answer(self, node, response, gis_agent):
+        """ Sends the response of the node to the client. An answer for an order gets the order id with the node number
+        and is made for the client agent, other responses are passed as they are. """
+        status, headers, body = response
+        match = ORDER_ANSWER.fullmatch(body)
+        if match is not None:
+            self.send_order(global_id(node.number, int(match.group(1))), match.group(2).decode(), gis_agent, status)
+            return
+        self.send_response(status)
+        for name, value in headers:
+            if name.lower() not in HOP_HEADERS:
+                self.send_header(name, value)
+        if status == http.HTTPStatus.NOT_MODIFIED:
+            self.end_headers()
+        else:
+            self.send_body(body)
+
+    def new_order(self, key, gis_agent):
+        """ Sends the request to the node of the key, the next nodes of the ring are tried if it is unavailable. """
+        for node in self.router.route(key):
+            try:
+                response = self.router.forward(node, self.path, self.node_headers())
+            except (OSError, http.client.HTTPException):
+                node.fail(self.settings['ROUTER_RETRY_INTERVAL'])
+                continue
+            self.send_answer(node, response, gis_agent)
+            return
+        self.bad_request(Request_Status.REQUEST_FAILED.value, "No render node is available")
+
+    def existing_order(self, fields, gis_agent):
+        """ Sends the request for an order to the node which has the order. If the node is unavailable the order is reported
+        as evicted, so the client orders the image again and the new order goes to an available node. """
+        try:
+            number, orderId = split_id(int(fields['orderId']))
+        except ValueError:
+            self.bad_request(Request_Status.INVALID_PARAM.value)
+            return
+        node = self.router.nodes.get(number)
+        if node is None:
+            self.bad_request(Request_Status.INVALID_PARAM.value, "Unknown node")
+            return
+        if not node.alive():
+            self.bad_request(Request_Status.NOMEM.value, "Render node is not available")
+            return
+        path = re.sub(r'orderId=\d+', f'orderId={orderId}', self.path, count=1)
+        try:
+            response = self.router.forward(node, path, self.node_headers())
+        except (OSError, http.client.HTTPException):
+            node.fail(self.settings['ROUTER_RETRY_INTERVAL'])
+            self.bad_request(Request_Status.NOMEM.value, "Render node is not available")
+            return
+        self.send_answer(node, response, gis_agent)
+
+    def do_GET(self):
+        """ Handles GET requests. """
+        try:
+            path = urlsplit(self.path).path
+            if path.startswith('/tiles/'):
+                tile = parse_tile_path(path)
+                if tile is None:
+                    self.bad_request(Request_Status.INVALID_PARAM.value, "Bad tile path")
+                else:
+                    self.new_order(region_key(tile_params(*tile, self.settings['TILE_SIZE'])), True)
+                return
+
+            gis_agent = 'gis' in self.headers.get('agent', '')
+            fields = dict()
+            param_line = re.sub('/[?]*[&]*', '', self.path)
+            if '&' in param_line:
+                for p in param_line.split('&'):
+                    key, val = p.split('=')
+                    fields[key] = val
+
+            if len(fields) == 0:
+                answer = self.get_html_content(Page_Type.START.value)
+                self.send_response(Request_Status.READY.value)
+                self.send_header("Content-type", "text/html")
+                self.send_header("Access-Control-Allow-Origin", "*")
+                self.send_body(answer.encode())
+            elif 'orderId' in fields:
+                self.existing_order(fields, gis_agent)
+            else:
+                self.new_order(region_key(fields, self.settings['KEY_QUANTUM_PIXELS']), gis_agent)
+        except Exception as exc:
+            logging.warning("Error! %s", exc)
+            self.close_connection = True
+            self.bad_request(Request_Status.REQUEST_FAILED.value, exc)
+
+    def do_POST(self):
+        """ Renderers deliver images to their nodes, POST requests are not accepted by the router. """
+        self.close_connection = True
+        self.bad_request(Request_Status.INVALID_PARAM.value, "Images are accepted by render nodes")
+
+def parse_args():
+    """ Function for parsing program arguments """
+    parser = argparse.ArgumentParser(description='gis-map-router description:')
+    parser.add_argument('config_path', type=str,
+                help='a required string positional argument, path to gis-map-router config')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    try:
+        address, port, html_path, nodes, settings = parse_router_config(args.config_path)
+    except Exception as exc:
+        print(f"Config parsing error {exc}")
+        sys.exit(1)
+
+    log_path = settings['LOG_PATH'] or get_log_path()
+    gis_root = os.environ.get('GIS_ROOT')
+    if log_path == None or gis_root == None:
+        # html pages are under GIS_ROOT even if LOG_PATH is set
+        print("Could not find GIS_ROOT environment variable")
+        sys.exit(1)
+    html_path = gis_root + '/' + html_path
+    os.makedirs(log_path, exist_ok=True)
+    level = logging.getLevelName(settings['LOG_LEVEL'].strip().upper())
+    logging.basicConfig(filename=log_path + '/router.log', level=level if isinstance(level, int) else logging.INFO,
+                        format='%(asctime)s %(levelname)-8s %(message)s')
+
+    router = Router(args.config_path)
+    signal.signal(signal.SIGHUP, router.on_sighup)
+    def handler(*args):
+        Router_Handler(router, html_path, *args)
+    try:
+        http.server.ThreadingHTTPServer((address, port), handler).serve_forever()
+    except KeyboardInterrupt:
+        print('Router is closed')
+        sys.exit(0)
@@ -0,0 +1,271 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+#!/usr/bin/python3 -uB
+from enum import Enum, unique
+import itertools
+import logging
+import threading
+
+@unique
+class Rpc_Method(Enum):
+    # requests and notifications from Net_Interface to Scheduler
+    NEW_ORDER = 0
+    CHECK_ORDER = 1
+    DELETE_IDS = 2
+    GET_METRICS = 8
+    GET_TRACES = 10
+    
+    # notifications from Scheduler to Net_Interface
+    ORDER_DISPATCHED = 3
+    ORDER_FINISHED = 4
+    ORDER_RESTORED = 5
+    TRANSCODE_ORDER = 6
+    ORDERS_DELETED = 11
+    STITCH_ORDER = 12
+    
+    # notifications from Net_Interface to Scheduler
+    ORDER_TRANSCODED = 7
+    ORDER_TRACE = 9
+
+class Rpc_Call():
+    """
+    A class used to represent a call which waits for its answer.
+
+    Attributes:
+    __________
+    event : threading.Event
+        Event is set when the answer is obtained.
+    answer : any type
+        The answer of the remote side.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.answer = None
+
+class Rpc_Client():
+    """
+    A class for request/response interaction with Scheduler over a pipe connection.
+    Every message is sent as (call_id, method, payload) and every answer comes back as (call_id, answer),
+    so answers are routed to the thread which waits for them and several calls can be in flight at once.
+    Notifications are sent in both directions as (None, method, payload), they are not answered.
+    Notifications from Scheduler are passed to handlers registered with subscribe().
+
+    Attributes:
+    __________
+    pipe_conn : multiprocessing.connection.Connection
+        Pipe connection instance for interacting with Scheduler.
+    calls : dict
+        A dictionary of calls waiting for the answer. Key: call_id, val: Rpc_Call instance.
+    handlers : dict
+        A dictionary of notification handlers. Key: method value, val: list of functions.
+
+    Methods:
+    ________
+    call(method, payload, timeout)
+        Sends a request to Scheduler and waits for its answer.
+    notify(method, payload)
+        Sends a notification to Scheduler without waiting for an answer.
+    subscribe(method, handler)
+        Registers a handler for notifications from Scheduler.
+    read_answers()
+        Reads answers from the pipe connection and passes them to waiting calls.
+    """
+
+    def __init__(self, pipe_conn):
+        """
+        Parameters:
+        __________
+        pipe_conn : multiprocessing.connection.Connection
+            Pipe connection instance for interacting with Scheduler.
+        """
+        self.pipe_conn = pipe_conn
+        self.calls = dict()
+        self.handlers = dict()
+        self.calls_lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.call_ids = itertools.count(1)
+        self.reader = threading.Thread(target=self.read_answers, daemon=True)
+        self.reader.start()
+
+    def call(self, method, payload, timeout):
+        """ Sends a request to Scheduler and waits for its answer.
+
+        Parameters:
+        __________
+        method : Rpc_Method Enum instance
+            Type of the request.
+        payload : any type
+            Request data, it has to be picklable.
+        timeout : float
+            Time in seconds to wait for the answer.
+
+        Returns
+        -------
+        answer
+            The answer of Scheduler or None if it did not responde in time
+        """
+        call_id = next(self.call_ids)
+        call = Rpc_Call()
+        with self.calls_lock:
+            self.calls[call_id] = call
+        try:
+            with self.send_lock:
+                self.pipe_conn.send((call_id, method.value, payload))
+            if call.event.wait(timeout):
+                return call.answer
+            logging.debug('rpc: call %s %s timeout', call_id, method.name)
+            return None
+        finally:
+            with self.calls_lock:
+                self.calls.pop(call_id, None)
+
+    def notify(self, method, payload):
+        """ Sends a notification to Scheduler without waiting for an answer.
+
+        Parameters:
+        __________
+        method : Rpc_Method Enum instance
+            Type of the notification.
+        payload : any type
+            Notification data, it has to be picklable.
+        """
+        with self.send_lock:
+            self.pipe_conn.send((None, method.value, payload))
+
+    def subscribe(self, method, handler):
+        """ Registers a handler for notifications from Scheduler. Handlers are called from the reader thread, so they have to be fast.
+
+        Parameters:
+        __________
+        method : Rpc_Method Enum instance
+            Type of the notification.
+        handler : function
+            Function called with the notification payload.
+        """
+        self.handlers.setdefault(method.value, list()).append(handler)
+
+    def read_answers(self):
+        """ Reads answers from the pipe connection and passes them to waiting calls. Answers for calls which are already timed out are dropped. """
+        while True:
+            try:
+                message = self.pipe_conn.recv()
+            except (EOFError, OSError):
+                logging.debug('rpc: pipe connection is closed')
+                return
+            if message[0] is None:
+                # notification from Scheduler
+                for handler in self.handlers.get(message[1], list()):
+                    try:
+                        handler(message[2])
+                    except Exception as exc:
+                        logging.error('rpc: notification handler error %s', exc)
+                continue
+            call_id, answer = message
+            with self.calls_lock:
+                call = self.calls.get(call_id)
+            if call is None:
+                logging.debug('rpc: late answer for call %s is dropped', call_id)
+                continue
+            call.answer = answer
+            call.event.set()
+
+class Rpc_Hub():
+    """
+    A class used by Scheduler to serve RPC channels of several front-end worker processes as one connection.
+    An answer (call_id, answer) is sent to the worker whose request is being handled, a notification (None, method, payload)
+    is sent to every worker, except methods of UNICAST_METHODS which are sent to one worker in turn.
+    A connection of a worker which exited is dropped, so other workers are still served.
+
+    Attributes:
+    __________
+    connections : list
+        Pipe connection instances for interacting with worker processes.
+    current : multiprocessing.connection.Connection
+        The connection of the last received request.
+    turn : itertools.cycle
+        Connections which get UNICAST_METHODS notifications in turn.
+
+    Methods:
+    ________
+    poll()
+        Checks if there is a request in any connection.
+    recv()
+        Receives a request from a connection which has one.
+    send(message)
+        Sends an answer or a notification.
+    try_send(conn, message)
+        Sends the message into the connection, returns False if the connection is dropped.
+    drop(conn, exc)
+        Drops the connection of a worker which exited.
+    """
+
+    # notifications which are handled by any worker: derivative and stitched images are made once
+    UNICAST_METHODS = (Rpc_Method.TRANSCODE_ORDER.value, Rpc_Method.STITCH_ORDER.value)
+
+    def __init__(self, connections):
+        self.connections = list(connections)
+        self.current = self.connections[0]
+        self.turn = itertools.cycle(self.connections)
+        self.next_poll = 0
+
+    def poll(self):
+        """ Checks if there is a request in any connection. """
+        return any(conn.poll() for conn in self.connections)
+
+    def recv(self):
+        """ Receives a request from a connection which has one, connections are polled in turn, so a busy worker does not block others.
+        Closed connections are dropped, EOFError is raised if no connection has a request. """
+        i = 0
+        while i < len(self.connections):
+            conn = self.connections[(self.next_poll + i) % len(self.connections)]
+            try:
+                if conn.poll():
+                    message = conn.recv()
+                    self.next_poll = (self.next_poll + i + 1) % len(self.connections)
+                    self.current = conn
+                    return message
+            except (EOFError, OSError) as exc:
+                # the next connection takes the place of the dropped one
+                self.drop(conn, exc)
+                continue
+            i += 1
+        raise EOFError('No request in connections')
+
+    def send(self, message):
+        """ Sends an answer to the worker of the current request or a notification to workers.
+        A connection which can not be written is dropped, a unicast notification is sent to the next worker then. """
+        if message[0] is not None:
+            if self.current in self.connections:
+                self.try_send(self.current, message)
+        elif message[1] in self.UNICAST_METHODS:
+            while self.connections and not self.try_send(next(self.turn), message):
+                pass
+        else:
+            for conn in list(self.connections):
+                self.try_send(conn, message)
+
+    def try_send(self, conn, message):
+        """ Sends the message into the connection, returns False if the connection is dropped. """
+        try:
+            conn.send(message)
+            return True
+        except (EOFError, OSError) as exc:
+            self.drop(conn, exc)
+            return False
+
+    def drop(self, conn, exc):
+        """ Drops the connection of a worker which exited. """
+        logging.error('rpc: connection of a front-end worker is closed, it is dropped: %r', exc)
+        index = self.connections.index(conn)
+        self.connections.remove(conn)
+        if index < self.next_poll:
+            self.next_poll -= 1
+        if self.connections:
+            self.next_poll %= len(self.connections)
+        else:
+            self.next_poll = 0
+        self.turn = itertools.cycle(list(self.connections))
+        conn.close()
@@ -3,14 +3,35 @@
 ###############################################################################
 
 #!/usr/bin/python3 -u -B
-import time
 import os
+import json
 import logging
+import signal
 import subprocess
 import string
 import random
+import time
+from collections import deque
+from multiprocessing.connection import wait
+
+from utils import Request_Status, get_log_path, canonical_params, render_key, base_params, is_derivative, is_decimal, is_finite, DERIVATIVE_PARAMS
+from rpc import Rpc_Method
+from persistent_cache import Persistent_Cache
+from order_queue import Order_Queue
+from render_pool import Render_Pool
+from transcoder import transcode_base_format, crop_enabled, split_enabled, TRANSCODE_FORMATS
+from spatial_index import Spatial_Index, CROP_SOURCE_FORMATS, split_params, neighbour_params
+from metrics import Histogram, RENDER_BUCKETS, size_bucket
+
+# answers to requests which could not be handled, they have the form of usual answers: an invalid order and a failed check
+ERROR_ANSWERS = {Rpc_Method.NEW_ORDER.value: ((0, 0), 0), Rpc_Method.CHECK_ORDER.value: Request_Status.REQUEST_FAILED.value}
 
-from utils import Request_Status, get_log_path
+# prefetch orders are queued after client orders and share execution as one client
+PREFETCH_PRIORITY = 1
+PREFETCH_CLIENT = 'prefetch'
+
+# number of windows kept for prefetching, the oldest ones are dropped
+PREFETCH_CANDIDATES = 64
 
 
 class Worker():
@@ -60,7 +81,7 @@ class Worker():
         element : any type
             New element to be add into the processes array.
         """
-        logging.debug(f'{self.slots}')
+        logging.debug('%s', self.slots)
         for i in range(self.slots_num):
             if self.slots[i] == 0:
                 self.slots[i] = element
@@ -102,11 +123,54 @@ class Scheduler():
     Attributes:
     __________
     orders : dict
-        A dictionary of all oders. Key: id, value: [parameters, return codes, pincode]
-    queue : list
-        A queue with new orders that have not been executed.
+        A dictionary of all oders. Key: id, value: [canonical parameters, return codes, pincode, trace]
+        where trace is a dictionary of time.monotonic() values of passed stages for sampled orders and None for others.
+    cached : dict
+        A dictionary for orders deduplication. Key: render key of canonical parameters, value: id
+    queue : Order_Queue instance
+        A priority queue with new orders that have not been executed, it shares execution fairly between clients.
     counter : int
         Total number of orders.
+    settings : dict
+        Values of optional config options.
+    persistent : Persistent_Cache instance
+        Images saved by previous server runs, None if the persistent cache is not used.
+    pool : Render_Pool instance
+        Long-lived renderer processes, None if a renderer process is started for every order.
+    base_format : str
+        Format of images which derivative images are made from by Net_Interface, None if transcoding is disabled.
+    sources : dict
+        Derivative orders which are not finished. Key: id, value: id of the base order.
+    derivatives : dict
+        Derivative orders waiting for their base order to be rendered. Key: id of the base order, value: list of ids.
+    started : dict
+        Start times of executing renders. Key: id, value: time.monotonic() value.
+    render_times : dict
+        Durations of finished renders. Key: (format, size bucket), value: Histogram instance.
+    results : dict
+        Number of finished renders. Key: status name, value: int.
+    worker : Worker instance
+        Slots of executing renderer processes.
+    traces : deque
+        Records of the latest finished traces, see trace_record().
+    spatial : Spatial_Index instance
+        Extents of rendered images which new orders are cropped from, None if cropping is disabled.
+    crops : dict
+        Cropped orders which are not finished. Key: id, value: (crop box, client).
+    split_pixels : int
+        Orders of at least this number of pixels are stitched from parts, 0 if splitting is disabled.
+    mosaics : dict
+        Orders stitched from parts which are not finished. Key: id, value: list of (id of the part, left, upper).
+    stitches : dict
+        Orders waiting for the part to be rendered. Key: id of the part, value: list of ids.
+    prefetch_budget : int
+        Maximum number of prefetch renders started per minute, 0 if prefetching is disabled.
+    candidates : deque
+        Canonical parameters of windows to prefetch, the latest ones are prefetched first.
+    prefetching : set
+        Ids of prefetch orders which are executing. An order stops being a prefetch one when a client requests it.
+    prefetch_starts : deque
+        Start times of prefetch renders of the last minute.
     
     Methods:
     ________
@@ -114,20 +178,82 @@ class Scheduler():
         Validates parameters of an order.
     generate_pincode(dictionary, size)
         Generates new pincode of length = size, using characters from dictionary string.
-    add_order(params)
+    add_order(params, status, client, priority, deadline, source, parts)
         Adds new order with parameters = params to orders and queue.
+    add_derivative(pipe_conn, params, client, deadline)
+        Adds new order whose image is made from the image rendered in the base format.
+    add_crop(pipe_conn, params, found, client)
+        Adds new order whose image is cropped from a rendered image which contains it.
+    add_mosaic(pipe_conn, params, client, deadline)
+        Adds new large order whose image is stitched from parts rendered in parallel.
+    update_mosaic(pipe_conn, id)
+        Starts stitching of the order if all its parts are ready, fails it if a part has failed.
     check_order(id)
         Checks if order with id exists.
+    handle_request(pipe_conn, data)
+        Handles a request obtained from Net_Interface and sends the answer back.
+    serve_requests(pipe_conn)
+        Handles all requests obtained from Net_Interface, bad requests are answered with errors.
+    notify(pipe_conn, method, payload)
+        Sends a notification to Net_Interface.
+    start_transcoding(pipe_conn, id)
+        Asks Net_Interface to make the image of the derivative order.
+    start_stitching(pipe_conn, id)
+        Asks Net_Interface to stitch the image of the order from its parts.
+    finish_order(pipe_conn, id, status)
+        Saves the final status of the order and finishes derivative orders waiting for it.
+    get_metrics()
+        Returns counters for /metrics page.
+    prefetch_orders(pipe_conn, worker)
+        Starts renders of windows adjacent to recently rendered ones while slots are idle.
+    cancel_prefetch(pipe_conn, worker)
+        Stops prefetch renders whose slots are needed by queued orders.
+    count_render(id, status)
+        Registers duration and result of the finished render.
+    trace_stage(id, stage, timestamp)
+        Saves the time of the stage if the order is traced.
+    trace_record(id)
+        Returns the trace of the order as a dictionary.
+    complete_trace(id)
+        Saves the finished trace and writes it into the log.
+    dispatch_orders(pipe_conn, worker)
+        Starts rendering of queued orders while there are free slots.
+    collect_finished(pipe_conn, worker)
+        Checks renderer processes of busy slots, saves return codes of finished ones and frees their slots.
     start_scheduler(pipe_conn, host, port, slots_num)
         Executes scheduler, starts an infinite loop for listening pipe connection = pipe_conn and organizing orders execution.
         
     """
     
-    def __init__(self):
+    def __init__(self, settings=None):
         self.orders = dict()
         self.cached = dict()
-        self.queue = list()
+        self.queue = Order_Queue()
         self.counter = 0
+        self.settings = dict() if settings is None else settings
+        self.persistent = None
+        self.pool = None
+        self.base_format = transcode_base_format(self.settings)
+        self.sources = dict()
+        self.derivatives = dict()
+        self.started = dict()
+        self.render_times = dict()
+        self.results = dict()
+        self.worker = None
+        self.traces = deque(maxlen=self.settings.get('TRACE_HISTORY', 1000))
+        self.spatial = Spatial_Index(self.settings.get('CROP_MAX_SHIFT', 0.25)) if crop_enabled(self.settings) else None
+        self.crops = dict()
+        self.crop_count = 0
+        self.split_pixels = self.settings.get('SPLIT_MIN_PIXELS', 0) if split_enabled(self.settings) else 0
+        self.mosaics = dict()
+        self.stitches = dict()
+        self.mosaic_count = 0
+        self.prefetch_budget = self.settings.get('PREFETCH_BUDGET', 0)
+        self.candidates = deque(maxlen=PREFETCH_CANDIDATES)
+        self.prefetching = set()
+        self.prefetch_starts = deque()
+        self.prefetch_count = 0
+        self.prefetch_cancelled = 0
         
     def validator(self, params):
         """ Validates parameters of an order.
@@ -140,18 +266,31 @@ class Scheduler():
         params_list = ['lat', 'lon', 'scale', 'w', 'h', 'format']
         for par in params_list:
             if par not in params:
-                logging.debug(f'Bad params: no {par} in {params}')
+                logging.debug('Bad params: no %s in %s', par, params)
                 return False
-        try:
-            float(params['lon'])
-            float(params['lat'])
-        except ValueError:
-            logging.debug(f'Bad params: lat, lan, w, h or scale is not float in {params}')
+        if not is_finite(params['lon']) or not is_finite(params['lat']):
+            logging.debug('Bad params: lat or lon is not a finite float in %s', params)
             return False
         
-        if not params['scale'].isdigit() or not params['w'].isdigit() or not params['h'].isdigit():
+        if not is_decimal(params['scale']) or not is_decimal(params['w']) or not is_decimal(params['h']):
+            return False
+        if int(params['scale']) <= 0 or int(params['w']) <= 0 or int(params['h']) <= 0:
+            logging.debug('Bad params: scale, w or h is 0 in %s', params)
             return False
         
+        if 'deadline' in params and not is_finite(params['deadline']):
+            logging.debug('Bad params: deadline is not a finite float in %s', params)
+            return False
+        
+        for par in DERIVATIVE_PARAMS:
+            if par not in params:
+                continue
+            if self.base_format is None or params['format'].strip().lower() not in TRANSCODE_FORMATS:
+                logging.debug('Bad params: %s is used without transcoding in %s', par, params)
+                return False
+            if not is_decimal(params[par]) or (par == 'quality' and int(params[par]) > 100):
+                return False
+        
         return True
     
     def generate_pincode(self, dictionary, size):
@@ -172,13 +311,25 @@ class Scheduler():
         pincode = ''.join(random.choice(dictionary) for x in range(size))
         return pincode
 
-    def add_order(self, params):
+    def add_order(self, params, status=Request_Status.PROCESSING.value, client='', priority=0, deadline=None, source=None, parts=None):
         """ Adds new order with parameters = params to orders and queue.
         
         Parameters:
         __________
-        params : list
-            A list of parameters of a new order.
+        params : dict
+            Canonical parameters of a new order.
+        status : int
+            Initial status of the order, only orders with PROCESSING status are queued.
+        client : str
+            Client identifier for fair share of execution.
+        priority : int
+            Priority class of the order, orders with lower value are executed first.
+        deadline : float
+            time.monotonic() value after which the order is dropped if it has not been started, None means no deadline.
+        source : int
+            Id of the base order for derivative orders, they are not queued but made from the base image.
+        parts : list
+            (id of the part order, left, upper) of orders stitched from parts, they are not queued but wait for parts.
             
                     
         Returns
@@ -190,24 +341,525 @@ class Scheduler():
         """
         self.counter += 1
         pincode = self.generate_pincode(string.digits + string.ascii_letters, 6)
-        self.orders[self.counter] = [params, Request_Status.PROCESSING.value, pincode]
+        trace = None
+        if status == Request_Status.PROCESSING.value and random.random() < self.settings.get('TRACE_SAMPLE_RATE', 0):
+            trace = {'enqueued': time.monotonic()}
+        self.orders[self.counter] = [params, status, pincode, trace]
         
-        self.cached[tuple(params.values())] = self.counter
-        self.queue.append(self.counter)
+        self.cached[render_key(params)] = self.counter
+        if source is not None:
+            self.sources[self.counter] = source
+            self.derivatives.setdefault(source, list()).append(self.counter)
+        elif parts is not None:
+            self.mosaics[self.counter] = parts
+            for part_id, left, upper in parts:
+                if self.orders[part_id][1] == Request_Status.PROCESSING.value:
+                    self.stitches.setdefault(part_id, list()).append(self.counter)
+        elif status == Request_Status.PROCESSING.value:
+            # cost of an order is its size in 256x256 tiles
+            cost = int(params['w']) * int(params['h']) / 65536
+            self.queue.push(self.counter, client, cost, priority, deadline)
         return self.counter, pincode
 
+    def add_derivative(self, pipe_conn, params, client='', deadline=None):
+        """ Adds new order whose image is made from the image rendered in the base format, the base order is added if it does not exist.
+        
+        Parameters:
+        __________
+        pipe_conn : Rpc_Hub instance
+            Pipe connections for interacting with Net_Interface.
+        params : dict
+            Canonical parameters of a new order.
+        client : str
+            Client identifier for fair share of execution.
+        deadline : float
+            time.monotonic() value after which the base order is dropped if it has not been started, None means no deadline.
+            
+        Returns
+        -------
+        id
+            Id for new order
+        pincode
+            Generated pincode for new order
+        """
+        base = base_params(params, self.base_format)
+        base_key = render_key(base)
+        source = self.cached.get(base_key)
+        self.prefetching.discard(source)
+        if source is None:
+            if self.persistent is not None and self.persistent.contains(base_key):
+                source, _ = self.add_order(base, Request_Status.READY.value)
+                self.notify(pipe_conn, Rpc_Method.ORDER_RESTORED, (source, base_key))
+            else:
+                source, _ = self.add_order(base, client=client, deadline=deadline)
+        
+        id, pincode = self.add_order(params, source=source)
+        status = self.orders[source][1]
+        if status == Request_Status.READY.value:
+            self.derivatives.pop(source)
+            self.start_transcoding(pipe_conn, id)
+        elif status != Request_Status.PROCESSING.value:
+            # the base order has failed, the derivative order gets its status
+            self.derivatives.pop(source)
+            self.sources.pop(id)
+            self.cached.pop(render_key(params), None)
+            self.finish_order(pipe_conn, id, status)
+        return id, pincode
+
+    def add_crop(self, pipe_conn, params, found, client=''):
+        """ Adds new order whose image is cropped from a rendered image which contains its window, so it is not rendered.
+        
+        Parameters:
+        __________
+        pipe_conn : Rpc_Hub instance
+            Pipe connections for interacting with Net_Interface.
+        params : dict
+            Canonical parameters of a new order.
+        found : tuple
+            (id of the rendered order, crop box) returned by Spatial_Index.find().
+        client : str
+            Client identifier, it is used if cropping fails and the order is rendered.
+            
+        Returns
+        -------
+        id
+            Id for new order
+        pincode
+            Generated pincode for new order
+        """
+        source, box = found
+        logging.debug('Order %s is cropped from order %s, box %s', params, source, box)
+        id, pincode = self.add_order(params, source=source)
+        # the source is ready, so its list of waiting derivatives contains only the new order
+        self.derivatives.pop(source)
+        self.crops[id] = (box, client)
+        self.crop_count += 1
+        self.start_transcoding(pipe_conn, id)
+        return id, pincode
+
+    def add_mosaic(self, pipe_conn, params, client='', deadline=None):
+        """ Adds new large order whose image is stitched from parts rendered in parallel slots. Parts are separate orders,
+        so they are deduplicated and cached like other orders, missing ones are added.
+        
+        Parameters:
+        __________
+        pipe_conn : Rpc_Hub instance
+            Pipe connections for interacting with Net_Interface.
+        params : dict
+            Canonical parameters of a new order.
+        client : str
+            Client identifier for fair share of execution.
+        deadline : float
+            time.monotonic() value after which parts are dropped if they have not been started, None means no deadline.
+            
+        Returns
+        -------
+        id
+            Id for new order
+        pincode
+            Generated pincode for new order
+        """
+        parts = list()
+        for part, left, upper in split_params(params, self.settings.get('SPLIT_PART_SIZE', 1024)):
+            key = render_key(part)
+            part_id = self.cached.get(key)
+            self.prefetching.discard(part_id)
+            if part_id is None:
+                if self.persistent is not None and self.persistent.contains(key):
+                    part_id, _ = self.add_order(part, Request_Status.READY.value)
+                    self.notify(pipe_conn, Rpc_Method.ORDER_RESTORED, (part_id, key))
+                else:
+                    part_id, _ = self.add_order(part, client=client, deadline=deadline)
+            parts.append((part_id, left, upper))
+        logging.debug('Order %s is split into %s parts', params, len(parts))
+        id, pincode = self.add_order(params, parts=parts)
+        self.mosaic_count += 1
+        self.update_mosaic(pipe_conn, id)
+        return id, pincode
+
+    def update_mosaic(self, pipe_conn, id):
+        """ Starts stitching of the order if all its parts are ready, fails the order with the status of a failed part. """
+        # parts deleted from the table have been evicted
+        statuses = [self.orders[part_id][1] if part_id in self.orders else Request_Status.NOMEM.value for part_id, left, upper in self.mosaics[id]]
+        failed = [status for status in statuses if status not in (Request_Status.READY.value, Request_Status.PROCESSING.value)]
+        if failed:
+            self.mosaics.pop(id)
+            self.cached.pop(render_key(self.orders[id][0]), None)
+            self.finish_order(pipe_conn, id, failed[0])
+        elif all(status == Request_Status.READY.value for status in statuses):
+            self.start_stitching(pipe_conn, id)
+
     def check_order(self, id):
         """ Checks if order with id exists. """
         return id in self.orders
 
 
+    def handle_request(self, pipe_conn, data):
+        """ Handles a request obtained from Net_Interface and sends the answer back.
+        
+        Parameters:
+        __________
+        pipe_conn : Rpc_Hub instance
+            Pipe connections for interacting with Net_Interface.
+        data : tuple
+            A request (call_id, method, payload).
+        """
+        logging.debug('Scheduler got: %s', data)
+        call_id, method, payload = data
+        
+        if method == Rpc_Method.NEW_ORDER.value:
+            # request for new order
+            fields, client = payload
+            logging.debug('Scheduler new order %s from %s', fields, client)
+            code = 0
+            orderId = 0
+            pincode = 0
+            
+            if self.validator(fields):
+                params = canonical_params(fields, self.settings.get('KEY_QUANTUM_PIXELS', 0))
+                key = render_key(params)
+                if key in self.cached:
+                    logging.debug('Order exist, cached data is used')
+                    orderId = self.cached[key]
+                    pincode = self.orders[orderId][2]
+                    # the prefetch order is requested by the client, so it is not cancelled any more
+                    self.prefetching.discard(orderId)
+                elif self.persistent is not None and self.persistent.contains(key):
+                    logging.debug('Image is saved in persistent cache, order is ready')
+                    orderId, pincode = self.add_order(params, Request_Status.READY.value)
+                    self.notify(pipe_conn, Rpc_Method.ORDER_RESTORED, (orderId, key))
+                else:
+                    deadline = None
+                    if 'deadline' in fields:
+                        deadline = time.monotonic() + float(fields['deadline'])
+                    found = self.spatial.find(params) if self.spatial is not None and params['format'] in TRANSCODE_FORMATS else None
+                    if found is not None:
+                        orderId, pincode = self.add_crop(pipe_conn, params, found, client)
+                    elif (self.split_pixels and params['format'] in TRANSCODE_FORMATS and int(params['w']) * int(params['h']) >= self.split_pixels
+                          and max(int(params['w']), int(params['h'])) > self.settings.get('SPLIT_PART_SIZE', 1024)):
+                        orderId, pincode = self.add_mosaic(pipe_conn, params, client, deadline)
+                    elif self.base_format is not None and params['format'] in TRANSCODE_FORMATS and is_derivative(params, self.base_format):
+                        orderId, pincode = self.add_derivative(pipe_conn, params, client, deadline)
+                    else:
+                        orderId, pincode = self.add_order(params, client=client, deadline=deadline)
+                code = 1
+            pipe_conn.send((call_id, ((orderId, pincode), code)))
+        elif method == Rpc_Method.CHECK_ORDER.value:
+            # request to check order
+            orderId, pincode = payload
+            logging.debug('Scheduler checking order id=%s', orderId)
+            if self.check_order(orderId):
+                logging.debug('Status: %s', self.orders[orderId][1])
+                if self.orders[orderId][2] == pincode:
+                    pipe_conn.send((call_id, self.orders[orderId][1]))
+                    if self.orders[orderId][1] == Request_Status.READY.value:
+                        #self.orders[orderId][1] = Request_Status.DONE.value
+                        pass
+                else:
+                    logging.debug('Bad pincode %s (not %s) for order with id=%s', pincode, self.orders[orderId][2], orderId)
+                    pipe_conn.send((call_id, Request_Status.INVALID_PARAM.value))
+            else:
+                logging.debug('No order in scheduler with ID %s', orderId)
+                pipe_conn.send((call_id, Request_Status.INVALID_PARAM.value))
+        elif method == Rpc_Method.DELETE_IDS.value:
+            # notification about ids evicted from Storage
+            deleted_ids = [i for i in payload if i in self.orders]
+            logging.debug('Scheduler deletes ids=%s', deleted_ids)
+            # other front-end workers forget the ids too
+            self.notify(pipe_conn, Rpc_Method.ORDERS_DELETED, deleted_ids)
+            for i in deleted_ids:
+                self.complete_trace(i)
+                self.cached.pop(render_key(self.orders[i][0]), None)
+                self.orders.pop(i)
+                self.queue.remove(i)
+                self.crops.pop(i, None)
+                self.mosaics.pop(i, None)
+                self.stitches.pop(i, None)
+                if self.spatial is not None:
+                    self.spatial.remove(i)
+                source = self.sources.pop(i, None)
+                if source in self.derivatives and i in self.derivatives[source]:
+                    self.derivatives[source].remove(i)
+                for d in self.derivatives.pop(i, list()):
+                    self.sources.pop(d, None)
+                    self.cached.pop(render_key(self.orders[d][0]), None)
+                    self.finish_order(pipe_conn, d, Request_Status.NOMEM.value)
+        elif method == Rpc_Method.ORDER_TRACE.value:
+            # notification about a stage of a traced order passed in Net_Interface
+            orderId, stage, timestamp = payload
+            self.trace_stage(orderId, stage, timestamp)
+            if stage == 'fetched':
+                self.complete_trace(orderId)
+        elif method == Rpc_Method.GET_TRACES.value:
+            # request for traces of admin page: finished ones and ones in progress
+            active = [self.trace_record(id) for id, order in self.orders.items() if order[3] is not None]
+            pipe_conn.send((call_id, list(self.traces) + active))
+        elif method == Rpc_Method.GET_METRICS.value:
+            # request for counters, it is sent only when /metrics page is requested
+            pipe_conn.send((call_id, self.get_metrics()))
+        elif method == Rpc_Method.ORDER_TRANSCODED.value:
+            # notification about a derivative image made by Net_Interface
+            orderId, status = payload
+            source = self.sources.pop(orderId, None)
+            if source is not None:
+                crop = self.crops.pop(orderId, None)
+                if crop is not None and status != Request_Status.READY.value:
+                    # the source image has been evicted or could not be cropped, the order stays PROCESSING and is rendered as usual
+                    self.spatial.remove(source)
+                    params = self.orders[orderId][0]
+                    self.queue.push(orderId, crop[1], int(params['w']) * int(params['h']) / 65536, 0, None)
+                    return
+                if status != Request_Status.READY.value:
+                    # the order is not used for deduplication any more, the next request makes it again
+                    self.cached.pop(render_key(self.orders[orderId][0]), None)
+                self.finish_order(pipe_conn, orderId, status)
+            elif self.mosaics.pop(orderId, None) is not None:
+                if status != Request_Status.READY.value:
+                    self.cached.pop(render_key(self.orders[orderId][0]), None)
+                self.finish_order(pipe_conn, orderId, status)
+
+    def serve_requests(self, pipe_conn):
+        """ Handles all requests obtained from Net_Interface. A request which could not be handled is answered with ERROR_ANSWERS,
+        so a bad request does not stop the scheduler. """
+        while pipe_conn.poll():
+            try:
+                data = pipe_conn.recv()
+            except EOFError:
+                # the connection which was polled is closed, Rpc_Hub has dropped it
+                break
+            try:
+                self.handle_request(pipe_conn, data)
+            except Exception as exc:
+                logging.error('Scheduler could not handle request %s: %r', data, exc)
+                if data[0] is not None:
+                    pipe_conn.send((data[0], ERROR_ANSWERS.get(data[1])))
+
+    def notify(self, pipe_conn, method, payload):
+        """ Sends a notification to Net_Interface, notifications are not answered. """
+        pipe_conn.send((None, method.value, payload))
+
+    def start_transcoding(self, pipe_conn, id):
+        """ Asks Net_Interface to make the image of the derivative order from the image of its base order. """
+        params = self.orders[id][0]
+        started = time.monotonic()
+        self.trace_stage(id, 'dispatched', started)
+        self.notify(pipe_conn, Rpc_Method.ORDER_DISPATCHED, (id, started, render_key(params), self.orders[id][3] is not None))
+        box = self.crops[id][0] if id in self.crops else None
+        self.notify(pipe_conn, Rpc_Method.TRANSCODE_ORDER, (id, self.sources[id], params, box))
+
+    def start_stitching(self, pipe_conn, id):
+        """ Asks Net_Interface to stitch the image of the order from images of its parts. """
+        params = self.orders[id][0]
+        started = time.monotonic()
+        self.trace_stage(id, 'dispatched', started)
+        self.notify(pipe_conn, Rpc_Method.ORDER_DISPATCHED, (id, started, render_key(params), self.orders[id][3] is not None))
+        self.notify(pipe_conn, Rpc_Method.STITCH_ORDER, (id, params, self.mosaics[id]))
+
+    def finish_order(self, pipe_conn, id, status):
+        """ Saves the final status of the order, notifies Net_Interface and finishes derivative orders waiting for it:
+        they are transcoded if the order is ready and get the same status otherwise. Orders stitched from the order are updated.
+        
+        Parameters:
+        __________
+        pipe_conn : Rpc_Hub instance
+            Pipe connections for interacting with Net_Interface.
+        id : int
+            An id of the order.
+        status : int
+            Final status of the order.
+        """
+        self.orders[id][1] = status
+        self.prefetching.discard(id)
+        self.notify(pipe_conn, Rpc_Method.ORDER_FINISHED, (id, status))
+        if status != Request_Status.READY.value:
+            self.complete_trace(id)
+        for d in self.derivatives.pop(id, list()):
+            if status == Request_Status.READY.value:
+                self.start_transcoding(pipe_conn, d)
+            else:
+                self.sources.pop(d, None)
+                self.cached.pop(render_key(self.orders[d][0]), None)
+                self.finish_order(pipe_conn, d, status)
+        for m in self.stitches.pop(id, list()):
+            if m in self.mosaics:
+                self.update_mosaic(pipe_conn, m)
+
+    def get_metrics(self):
+        """ Returns counters for /metrics page: queue length, slots occupancy, render durations and results. """
+        return {'queue': len(self.queue), 'slots_busy': self.worker.size, 'slots': self.worker.slots_num, 'orders': len(self.orders),
+                'render_times': self.render_times, 'results': self.results, 'crops': self.crop_count,
+                'mosaics': self.mosaic_count, 'prefetches': self.prefetch_count, 'prefetches_cancelled': self.prefetch_cancelled}
+
+    def dispatch_orders(self, pipe_conn, worker):
+        """ Starts rendering of queued orders while there are free slots, orders are sent to the renderer pool if it is used,
+        otherwise a renderer process is started for every order.
+        
+        Parameters:
+        __________
+        pipe_conn : Rpc_Hub instance
+            Pipe connections for interacting with Net_Interface.
+        worker : Worker instance
+            Slots of executing renderer processes.
+        """
+        while worker.check_free_slot() and self.queue:
+            current_order_id, expired_ids = self.queue.pop(time.monotonic())
+            for i in expired_ids:
+                # the order stays in the table to report its status, but it is not used for deduplication any more
+                logging.debug('Order %s is dropped, deadline has passed', i)
+                self.cached.pop(render_key(self.orders[i][0]), None)
+                self.finish_order(pipe_conn, i, Request_Status.EXPIRED.value)
+            if current_order_id is None:
+                break
+            logging.debug('Current order id %s', current_order_id)
+            params = self.orders[current_order_id][0]
+            logging.debug('%s', params)
+            args = [f'-o{current_order_id}', f"-x{params['lon']}", f"-y{params['lat']}", f"-s{params['scale']}", f"-w{params['w']}", f"-h{params['h']}", f"-f{params['format']}"]
+            if self.pool is not None:
+                child = self.pool.start_job(current_order_id, args)
+            else:
+                child = subprocess.Popen([self.util_path] + args + self.common_args)
+            
+            worker.fill_slot((current_order_id, child))
+            self.started[current_order_id] = time.monotonic()
+            self.trace_stage(current_order_id, 'dispatched', self.started[current_order_id])
+            self.notify(pipe_conn, Rpc_Method.ORDER_DISPATCHED, (current_order_id, self.started[current_order_id], render_key(params),
+                                                                 self.orders[current_order_id][3] is not None))
+            
+            logging.debug('popen')
+
+    def collect_finished(self, pipe_conn, worker):
+        """ Checks renderer processes of busy slots, saves return codes of finished ones and frees their slots.
+        
+        Parameters:
+        __________
+        pipe_conn : Rpc_Hub instance
+            Pipe connections for interacting with Net_Interface.
+        worker : Worker instance
+            Slots of executing renderer processes.
+        """
+        for slot, id in worker.active_slots():
+            if slot[1].poll() != None:
+                logging.debug('Scheduler detects process as ready, return code: %s, order status ready %s', slot[1].returncode, Request_Status.READY.value)
+                if slot[1].returncode == 200:
+                    status = Request_Status.READY.value
+                elif slot[1].returncode == Request_Status.NOMEM.value:
+                    status = Request_Status.NOMEM.value
+                else:
+                    status = Request_Status.RENDER_FAILED.value
+                self.count_render(slot[0], status)
+                self.trace_stage(slot[0], 'exited')
+                if self.spatial is not None and status == Request_Status.READY.value and self.orders[slot[0]][0]['format'] in CROP_SOURCE_FORMATS:
+                    # later orders inside the rendered window are cropped from the image
+                    self.spatial.add(slot[0], self.orders[slot[0]][0])
+                if self.prefetch_budget and status == Request_Status.READY.value and slot[0] not in self.prefetching:
+                    # the most probable window is the first one, it is prefetched first
+                    self.candidates.extend(reversed(neighbour_params(self.orders[slot[0]][0], self.settings.get('KEY_QUANTUM_PIXELS', 0))))
+                self.finish_order(pipe_conn, slot[0], status)
+                worker.free_slot(id)
+
+    def prefetch_orders(self, pipe_conn, worker):
+        """ Starts renders of windows adjacent to recently rendered ones while the queue is empty and slots are idle.
+        Prefetch renders are limited by PREFETCH_SLOTS executing at once and by the budget of prefetch_budget renders per minute.
+        
+        Parameters:
+        __________
+        pipe_conn : Rpc_Hub instance
+            Pipe connections for interacting with Net_Interface.
+        worker : Worker instance
+            Slots of executing renderer processes.
+        """
+        now = time.monotonic()
+        while self.prefetch_starts and self.prefetch_starts[0] <= now - 60:
+            self.prefetch_starts.popleft()
+        while (self.candidates and not self.queue and worker.check_free_slot() and len(self.prefetch_starts) < self.prefetch_budget
+               and len(self.prefetching) < self.settings.get('PREFETCH_SLOTS', 1)):
+            params = self.candidates.pop()
+            key = render_key(params)
+            if key in self.cached or (self.persistent is not None and self.persistent.contains(key)):
+                continue
+            id, _ = self.add_order(params, client=PREFETCH_CLIENT, priority=PREFETCH_PRIORITY)
+            logging.debug('Order %s is prefetched', id)
+            self.prefetching.add(id)
+            self.prefetch_starts.append(now)
+            self.prefetch_count += 1
+            self.dispatch_orders(pipe_conn, worker)
+
+    def cancel_prefetch(self, pipe_conn, worker):
+        """ Stops prefetch renders whose slots are needed by queued orders, so prefetching never delays client orders.
+        A cancelled order gets EXPIRED status and is not used for deduplication.
+        
+        Parameters:
+        __________
+        pipe_conn : Rpc_Hub instance
+            Pipe connections for interacting with Net_Interface.
+        worker : Worker instance
+            Slots of executing renderer processes.
+        """
+        for slot, num in worker.active_slots():
+            if len(self.queue) <= worker.slots_num - worker.size:
+                break
+            id, child = slot
+            if id not in self.prefetching:
+                continue
+            logging.debug('Prefetch order %s is cancelled', id)
+            if self.pool is not None:
+                self.pool.cancel(child)
+            else:
+                child.kill()
+                child.wait()
+            worker.free_slot(num)
+            self.started.pop(id, None)
+            self.prefetch_cancelled += 1
+            self.cached.pop(render_key(self.orders[id][0]), None)
+            self.finish_order(pipe_conn, id, Request_Status.EXPIRED.value)
+
+    def count_render(self, id, status):
+        """ Registers duration and result of the finished render. """
+        name = Request_Status(status).name
+        self.results[name] = self.results.get(name, 0) + 1
+        started = self.started.pop(id, None)
+        if started is None:
+            return
+        params = self.orders[id][0]
+        bucket = (params['format'], size_bucket(int(params['w']), int(params['h'])))
+        if bucket not in self.render_times:
+            self.render_times[bucket] = Histogram(RENDER_BUCKETS)
+        self.render_times[bucket].observe(time.monotonic() - started)
+
+    def trace_stage(self, id, stage, timestamp=None):
+        """ Saves time.monotonic() value of the stage if the order is traced, current time is used if timestamp is None. """
+        order = self.orders.get(id)
+        if order is not None and order[3] is not None:
+            order[3][stage] = time.monotonic() if timestamp is None else timestamp
+
+    def trace_record(self, id):
+        """ Returns the trace of the order as a dictionary: order parameters, status and times of passed stages
+        (enqueued, dispatched, exited, stored, fetched) in seconds since the order is enqueued. """
+        params, status, pincode, trace = self.orders[id]
+        record = {'id': id, 'format': params['format'], 'w': int(params['w']), 'h': int(params['h']), 'status': status}
+        record.update({stage: round(timestamp - trace['enqueued'], 6) for stage, timestamp in trace.items()})
+        return record
+
+    def complete_trace(self, id):
+        """ Saves the finished trace of the order and writes it into the log as a JSON line. """
+        order = self.orders.get(id)
+        if order is None or order[3] is None:
+            return
+        record = self.trace_record(id)
+        order[3] = None
+        self.traces.append(record)
+        logging.info('trace %s', json.dumps(record))
+
     def start_scheduler(self, pipe_conn, host, port, slots_num, sharedMemoryId):
         """ Executes scheduler, starts an infinite loop for listening pipe connection = pipe_conn and organizing orders execution. 
+        The loop sleeps until a request comes from the pipe, a renderer process exits (SIGCHLD is delivered through a wakeup pipe)
+        or a renderer pool process reports a result, so requests and finished renders are handled without delay.
         
         Parameters:
         __________
-        pipe_conn : multiprocessing.connection.Connection
-            Pipe connection instance for interacting with Net_Interface.
+        pipe_conn : Rpc_Hub instance
+            Pipe connections for interacting with Net_Interface worker processes. Requests are obtained as (call_id, method, payload),
+            answers are sent back as (call_id, answer) to the worker of the request, notifications are sent to all workers.
         host : str
             IP adress or host name for net interface.
         port : int
@@ -218,100 +870,61 @@ class Scheduler():
         logging.debug('start')
         try:
             gis_path = os.environ['GIS_ROOT']
-            util_path = gis_path + '/sbin/gis-buffer-renderer'
-            logging.debug(f'Renderer path ={util_path}')
+            self.util_path = gis_path + '/sbin/gis-buffer-renderer'
+            logging.debug('Renderer path =%s', self.util_path)
         except Exception as exc:
-            logging.debug('Could not find GIS_ROOT')
+            logging.error('Could not find GIS_ROOT')
+        self.host = host
+        self.port = port
+        self.sharedMemoryId = sharedMemoryId
+        result_url = f'http://{host}:{port}'
+        if self.settings.get('RESULT_SOCKET_PATH'):
+            result_url = f"unix://{self.settings['RESULT_SOCKET_PATH']}"
+        self.common_args = [f'-u{result_url}', f'-e{Request_Status.RENDER_FAILED.value}', f'-d{sharedMemoryId}']
+        if self.settings.get('RENDERER_POOL_COMMAND'):
+            try:
+                self.pool = Render_Pool(os.path.expandvars(self.settings['RENDERER_POOL_COMMAND']), slots_num, self.common_args)
+            except OSError as exc:
+                logging.warning('Could not start renderer pool, a renderer process is started for every order: %s', exc)
+        if self.settings.get('PERSISTENT_CACHE_PATH'):
+            self.persistent = Persistent_Cache(self.settings['PERSISTENT_CACHE_PATH'], self.settings['PERSISTENT_CACHE_MAX_SIZE'], sharedMemoryId, writer=False)
         
         worker = Worker(slots_num)
+        self.worker = worker
+        
+        # SIGCHLD handler does nothing, the signal only writes a byte into the wakeup pipe
+        wakeup_r, wakeup_w = os.pipe()
+        os.set_blocking(wakeup_r, False)
+        os.set_blocking(wakeup_w, False)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.set_wakeup_fd(wakeup_w, warn_on_full_buffer=False)
         
         while True:
-            # checking new data in Pipe
-            if pipe_conn.poll():
-                data = pipe_conn.recv()
-                logging.debug(f'Scheduler got: {data}')
-                
-                if data[0] == 0:
-                    # request for new order
-                    logging.debug(f'Scheduler new order {data[1]}')
-                    code = 0
-                    orderId = 0
-                    pincode = 0
-                    
-                    if self.validator(data[1]):
-                        param_tuple = tuple(data[1].values())
-                        if param_tuple in self.cached:
-                            logging.debug(f'Order exist, cached data is used')
-                            orderId = self.cached[param_tuple]
-                            pincode = self.orders[self.cached[param_tuple]][2]
-                        else:
-                            orderId, pincode = self.add_order(data[1])
-                        code = 1
-                    pipe_conn.send(((orderId, pincode), code))
-                elif data[0] == 1:
-                    # request to check order
-                    orderId, pincode = data[1]
-                    logging.debug(f'Scheduler checking order id={orderId}')
-                    if self.check_order(orderId):
-                        logging.debug(f'Status: {self.orders[orderId][1]}')
-                        if self.orders[orderId][2] == pincode:
-                            pipe_conn.send(self.orders[orderId][1])
-                            if self.orders[orderId][1] == Request_Status.READY.value:
-                                #self.orders[orderId][1] = Request_Status.DONE.value
-                                pass
-                        else:
-                            logging.debug(f'Bad pincode {pincode} (not {self.orders[orderId][2]}) for order with id={orderId}')
-                            pipe_conn.send(Request_Status.INVALID_PARAM.value)
-                    else:
-                        logging.debug(f'No order in scheduler with ID {orderId}')
-                        pipe_conn.send(Request_Status.INVALID_PARAM.value)
-                elif data[0] == 2:
-                    deleted_ids = data[1]
-                    logging.debug(f'Scheduler deletes ids={deleted_ids}')
-                    for i in deleted_ids:
-                        self.cached.pop(tuple(self.orders[i][0].values()))
-                        self.orders.pop(i)
-                        try:
-                            self.queue.remove(i)
-                        except:
-                            pass
-                    pipe_conn.send(True)
-                continue
-            else:
-                #print('No data for scheduler')
-                pass
+            ready = wait(pipe_conn.connections + [wakeup_r] + (self.pool.fds() if self.pool is not None else []))
             
-            # checking queue
+            if wakeup_r in ready:
+                try:
+                    while os.read(wakeup_r, 512):
+                        pass
+                except BlockingIOError:
+                    pass
+                
+            # obtaining all requests from Pipe
+            self.serve_requests(pipe_conn)
+            if not pipe_conn.connections:
+                logging.error('All front-end workers exited, the scheduler is stopped')
+                return 1
             
-            #if any of slots are free
-            if worker.check_free_slot():
-            #if current_order == False:
-                if self.queue:
-                    current_order_id = self.queue.pop(0)
-                    logging.debug(f'Current order id {current_order_id}')
-                    params = self.orders[current_order_id][0]
-                    logging.debug(f'{params}')
-                    child = subprocess.Popen([util_path, f'-uhttp://{host}:{port}', f'-o{current_order_id}',f"-x{params['lon']}", f"-y{params['lat']}",
-                                              f"-s{params['scale']}", f"-w{params['w']}", f"-h{params['h']}", f"-f{params['format']}", f"-e{Request_Status.RENDER_FAILED.value}", f"-d{sharedMemoryId}"])
-                                        
-                    worker.fill_slot((current_order_id, child))
-                    
-                    logging.debug('popen')
-                    
-            # if some slots are busy
-            # checking if order is ready
+            # checking if orders are ready
+            if self.pool is not None:
+                self.pool.read_results()
             if worker.is_busy():
-            #if child.poll() != None:
-                for slot, id in worker.active_slots():
-                    if slot[1].poll() != None:
-                        print('order status ready', Request_Status.READY.value, type(Request_Status.READY.value))
-                        logging.debug(f'Scheduler detects process as ready, return code: {slot[1].returncode}, order status ready {Request_Status.READY.value}')
-                        if slot[1].returncode == 200:
-                            self.orders[slot[0]][1] = Request_Status.READY.value
-                        elif slot[1].returncode == Request_Status.NOMEM.value:
-                            self.orders[slot[0]][1] = Request_Status.NOMEM.value
-                        else:
-                            self.orders[slot[0]][1] = Request_Status.RENDER_FAILED.value
-                        worker.free_slot(id)
-            time.sleep(0.1)
+                self.collect_finished(pipe_conn, worker)
+            
+            # starting queued orders in free slots, prefetch renders give their slots to queued orders
+            if self.prefetching:
+                self.cancel_prefetch(pipe_conn, worker)
+            self.dispatch_orders(pipe_conn, worker)
+            if self.prefetch_budget:
+                self.prefetch_orders(pipe_conn, worker)
         return 2
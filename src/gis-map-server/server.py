@@ -6,14 +6,23 @@
 from net_interface import Net_Interface
 from scheduler import Scheduler
 from storage import Storage
+from shared_storage import Shared_Storage
+from rpc import Rpc_Hub
 from utils import get_log_path
+from eviction import make_policy
+from disk_storage import Disk_Storage
+from persistent_cache import Persistent_Cache
 
 import argparse
 import shutil
 import os
 import sys
 import time
+import logging
+import threading
+import _thread
 from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
 import subprocess
 
 class Server:    
@@ -32,6 +41,10 @@ class Server:
         A total number of available slots.
     html_path : str
         The path to a folder with html pages that are used to responde clients.
+    settings : dict
+        Values of optional config options, see OPTIONAL_SETTINGS.
+    exited : str
+        The name of the scheduler or front-end worker process whose exit stopped the server, None while the server runs.
 
     Methods:
     ________
@@ -39,9 +52,13 @@ class Server:
         Initializes server with instances of Interface_Class, Storage_Class and Scheduler_Class classes.
     start()
         Starts server execution: executes scheduler as a subprocess, executes Interface_Class listening. 
+    run_interface(pipe_conn, worker)
+        Executes Interface_Class listening in a front-end worker process.
+    watch_processes(processes)
+        Stops the server when the scheduler or a front-end worker process exits.
     """
     
-    def __init__(self, host, port, slots_num, buf_size, html_path, sharedMemoryId):
+    def __init__(self, host, port, slots_num, buf_size, html_path, sharedMemoryId, settings=None):
         """ 
         Parameters:
         __________
@@ -55,6 +72,8 @@ class Server:
             A total number of available slots.
         html_path : str
             The path to a folder with html pages that are used to responde clients.
+        settings : dict
+            Values of optional config options, default values are used for missing ones.
         """
         self.port = port
         self.host = host
@@ -62,6 +81,8 @@ class Server:
         self.slots_num = slots_num
         self.html_path = html_path
         self.sharedMemoryId = sharedMemoryId
+        self.settings = parse_settings(dict()) if settings is None else settings
+        self.exited = None
         
     def server_init(self, Interface_Class, Storage_Class,  Scheduler_Class):
         """ Initializes server with instances of Interface_Class, Storage_Class and Scheduler_Class classes. 
@@ -75,18 +96,64 @@ class Server:
         Scheduler_Class : class
             A class link to create scheduler.
         """
-        self.net_interface = Interface_Class(self.host, self.port)
-        self.buf_storage = Storage_Class(self.buf_size)
-        self.scheduler = Scheduler_Class()
+        self.net_interface = Interface_Class(self.host, self.port, self.settings)
+        if self.settings['FRONTEND_WORKERS'] > 1:
+            # worker processes share one image store, it is created before fork
+            if self.settings['STORAGE_DISK_PATH']:
+                logging.warning('Disk tier of Storage is not used with several front-end workers')
+            self.buf_storage = Shared_Storage(self.buf_size, self.settings['STORAGE_TTL'], self.settings['STORAGE_POLICY'], self.settings['STORAGE_INDEX_SIZE'])
+        else:
+            disk = None
+            if self.settings['STORAGE_DISK_PATH'] and self.settings['STORAGE_DISK_MAX_SIZE'] > 0:
+                disk = Disk_Storage(self.settings['STORAGE_DISK_PATH'], self.settings['STORAGE_DISK_MAX_SIZE'], make_policy(self.settings['STORAGE_POLICY']))
+            self.buf_storage = Storage_Class(self.buf_size, self.settings['STORAGE_TTL'], make_policy(self.settings['STORAGE_POLICY']), disk)
+        self.scheduler = Scheduler_Class(self.settings)
     
     def start(self):
-        """ Starts server execution: executes scheduler as a subprocess, executes Interface_Class listening. Creates Pipe between two processes."""
-        sched_conn, serv_conn = Pipe()
-        sched = Process(target=self.scheduler.start_scheduler, args=(sched_conn, self.host, self.port, self.slots_num, self.sharedMemoryId))
+        """ Starts server execution: executes scheduler as a subprocess, executes Interface_Class listening. Creates Pipe between scheduler
+        and every front-end worker process, FRONTEND_WORKERS - 1 workers are forked, the current process is the worker 0. """
+        pipes = [Pipe() for i in range(max(self.settings['FRONTEND_WORKERS'], 1))]
+        sched = Process(target=self.scheduler.start_scheduler, args=(Rpc_Hub(sched_conn for sched_conn, serv_conn in pipes), self.host, self.port, self.slots_num, self.sharedMemoryId), name='scheduler')
         sched.start()
         
+        processes = [sched]
+        for worker, (sched_conn, serv_conn) in enumerate(pipes[1:], 1):
+            processes.append(Process(target=self.run_interface, args=(serv_conn, worker), daemon=True, name=f'worker {worker}'))
+            processes[-1].start()
+        # the watcher thread is started after fork, so worker processes do not inherit it
+        threading.Thread(target=self.watch_processes, args=(processes,), daemon=True).start()
+        self.run_interface(pipes[0][1], 0)
+    
+    def watch_processes(self, processes):
+        """ Stops the server when the scheduler or a front-end worker process exits. Pipes of the scheduler are created before fork,
+        so a worker can not be restarted with a new one: other processes are terminated and the main thread gets KeyboardInterrupt.
+        
+        Parameters:
+        __________
+        processes : list
+            Process instances of the scheduler and forked front-end workers.
+        """
+        ready = wait([process.sentinel for process in processes])
+        for process in processes:
+            if process.sentinel in ready:
+                process.join()
+                logging.error('%s process exited with code %s, the server is stopped', process.name, process.exitcode)
+                self.exited = process.name
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        _thread.interrupt_main()
+    
+    def run_interface(self, pipe_conn, worker):
+        """ Executes Interface_Class listening in a front-end worker process. """
+        # database connection is created after fork, every process opens its own one
+        persistent = None
+        if self.settings['PERSISTENT_CACHE_PATH']:
+            persistent = Persistent_Cache(self.settings['PERSISTENT_CACHE_PATH'], self.settings['PERSISTENT_CACHE_MAX_SIZE'], self.sharedMemoryId)
+        
         # Net_Interface start with access to Buf_Storage and Scheduler
-        self.net_interface.start_server(serv_conn, self.buf_storage, self.html_path)
+        self.net_interface.start_server(pipe_conn, self.buf_storage, self.html_path, persistent, worker)
 
 def parse_args():
     """ Function for parsing program arguments """
@@ -96,15 +163,66 @@ def parse_args():
     args = parser.parse_args()
     return args
 
-def parse_config(path):
-    """ Function parses config and return values of required options """
+# optional config options: name -> (type, default value)
+OPTIONAL_SETTINGS = {
+    'STORAGE_TTL': (float, 0),
+    'STORAGE_POLICY': (str, 'lru'),
+    'STORAGE_DISK_PATH': (str, ''),
+    'STORAGE_DISK_MAX_SIZE': (int, 0),
+    'PERSISTENT_CACHE_PATH': (str, ''),
+    'PERSISTENT_CACHE_MAX_SIZE': (int, 1073741824),
+    'KEY_QUANTUM_PIXELS': (float, 0),
+    'TILE_SIZE': (int, 256),
+    'TILE_WAIT_TIMEOUT': (float, 30),
+    'MAX_WAIT_TIMEOUT': (float, 60),
+    'RENDERER_POOL_COMMAND': (str, ''),
+    'RESULT_SOCKET_PATH': (str, ''),
+    'TRANSCODE_BASE_FORMAT': (str, ''),
+    'TRANSCODE_WORKERS': (int, 2),
+    'CACHE_MAX_AGE': (int, 3600),
+    'COMPRESS_TYPES': (str, 'image/bmp image/x-ms-bmp image/tiff'),
+    'COMPRESS_MIN_SIZE': (int, 1024),
+    'COMPRESS_CACHE_MAX_SIZE': (int, 67108864),
+    'KEEPALIVE_TIMEOUT': (float, 30),
+    'TRACE_SAMPLE_RATE': (float, 0.1),
+    'TRACE_HISTORY': (int, 1000),
+    'LOG_LEVEL': (str, 'INFO'),
+    'LOG_MAX_SIZE': (int, 10485760),
+    'LOG_BACKUP_COUNT': (int, 5),
+    'LOG_PATH': (str, ''),
+    'FRONTEND_WORKERS': (int, 1),
+    'STORAGE_INDEX_SIZE': (int, 4096),
+    'CROP_REUSE': (int, 0),
+    'CROP_MAX_SHIFT': (float, 0.25),
+    'SPLIT_MIN_PIXELS': (int, 0),
+    'SPLIT_PART_SIZE': (int, 1024),
+    'PREFETCH_BUDGET': (int, 0),
+    'PREFETCH_SLOTS': (int, 1),
+}
+
+def parse_settings(options):
+    """ Function returns values of optional options, default values are used for missing ones """
+    settings = dict()
+    for key, (cast, default) in OPTIONAL_SETTINGS.items():
+        settings[key] = cast(options[key]) if key in options else default
+    return settings
+
+def read_config(path):
+    """ Function reads config lines KEY=value and returns a dictionary of options """
     with open(path) as f:
         content = f.readlines()
     options = dict()
     for line in content:
-        key, val = line.split('=')
-        options[key] = val.strip()
-    return options['SERVER_ADDRESS'], int(options['SERVER_PORT']), int(options['SLOTS_NUMBER']), int(options['STORAGE_MAX_SIZE']), options['HTML_PAGES_PATH'], options['GIS_SHID']
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        key, val = line.split('=', 1)
+        options[key.strip()] = val.strip()
+    return options
+
+def parse_config(path):
+    """ Function parses config and return values of required options and a dictionary of optional ones """
+    options = read_config(path)
+    return options['SERVER_ADDRESS'], int(options['SERVER_PORT']), int(options['SLOTS_NUMBER']), int(options['STORAGE_MAX_SIZE']), options['HTML_PAGES_PATH'], options['GIS_SHID'], parse_settings(options)
 
 
 if __name__ == '__main__':
@@ -115,27 +233,30 @@ if __name__ == '__main__':
         sys.exit(1)
     
     try:
-        address, port, slots_num, buf_size, html_path, sharedMemoryId = parse_config(args.config_path)
+        address, port, slots_num, buf_size, html_path, sharedMemoryId, settings = parse_config(args.config_path)
     except Exception as exp:
         print(f"Config parsing error {exp}")
         sys.exit(1)
     
-    # log folder (re)creating
-    log_path = get_log_path()
+    # log folder (re)creating, instances running on one host need their own LOG_PATH
+    log_path = settings['LOG_PATH'] or get_log_path()
     if log_path == None:
         print("Could not find GIS_ROOT environment variable")
         sys.exit(1)
         
-    try:
-        shutil.rmtree(log_path)
-    except FileNotFoundError:
-        pass
-    except Exception as exc:
-        print("Could not get an access to log folder", log_path, exc)
-        sys.exit(1)
+    if not settings['LOG_PATH']:
+        # the default folder belongs to the server, logs of the previous run are removed
+        try:
+            shutil.rmtree(log_path)
+        except FileNotFoundError:
+            pass
+        except Exception as exc:
+            print("Could not get an access to log folder", log_path, exc)
+            sys.exit(1)
         
     try:
-        os.mkdir(log_path)
+        # LOG_PATH is set by the operator and may hold other files, it is only created if missing
+        os.makedirs(log_path, exist_ok=True)
     except Exception as exc:
         print("Could not create log folder", log_path, exc)
         sys.exit(1)
@@ -147,10 +268,14 @@ if __name__ == '__main__':
         sys.exit(1)
     
     # starting the server
+    new_server = None
     try:
-        new_server = Server(address, port, slots_num, buf_size, os.environ['GIS_ROOT'] + '/' + html_path, sharedMemoryId) 
+        new_server = Server(address, port, slots_num, buf_size, os.environ['GIS_ROOT'] + '/' + html_path, sharedMemoryId, settings) 
         new_server.server_init(Net_Interface, Storage, Scheduler)
         new_server.start()
     except KeyboardInterrupt:
+        if new_server is not None and new_server.exited is not None:
+            print(f'Server is stopped, {new_server.exited} process exited')
+            sys.exit(1)
         print('Server is closed')
         sys.exit(0)
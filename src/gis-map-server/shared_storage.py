@@ -0,0 +1,385 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+#!/usr/bin/python3 -uB
+import ctypes
+import mmap
+from collections import deque
+import multiprocessing
+import os
+import tempfile
+import time
+
+from utils import Request_Status
+from disk_storage import Disk_Buffer
+
+# states of index slots
+SLOT_EMPTY = 0
+SLOT_USED = 1
+SLOT_DELETED = 2
+
+# eviction policies of Shared_Storage, see Shared_Storage.touch()
+SHARED_POLICIES = ('lru', 'gdsf')
+
+class Index_Header(ctypes.Structure):
+    """ Counters of Shared_Storage placed at the beginning of the index memory. """
+    _fields_ = [('current_size', ctypes.c_int64), ('entries', ctypes.c_int64), ('tombstones', ctypes.c_int64),
+                ('hits', ctypes.c_int64), ('misses', ctypes.c_int64), ('evictions', ctypes.c_int64), ('expirations', ctypes.c_int64),
+                ('sequence', ctypes.c_int64), ('clock', ctypes.c_double), ('next_expiry', ctypes.c_double)]
+
+class Index_Slot(ctypes.Structure):
+    """ An element of the hash table of Shared_Storage, it describes one image of the arena. expires is 0 for unlimited lifetime. """
+    _fields_ = [('state', ctypes.c_int64), ('id', ctypes.c_int64), ('offset', ctypes.c_int64), ('size', ctypes.c_int64),
+                ('pins', ctypes.c_int64), ('frequency', ctypes.c_int64), ('expires', ctypes.c_double), ('cost', ctypes.c_double),
+                ('priority', ctypes.c_double), ('img_format', ctypes.c_char * 32)]
+
+def arena_file(size):
+    """Function returns a file of the given size in memory, it is a memfd on Linux and a temporary file elsewhere."""
+    if hasattr(os, 'memfd_create'):
+        file = os.fdopen(os.memfd_create('gis-map-server-storage'), 'r+b', buffering=0)
+    else:
+        file = tempfile.TemporaryFile(buffering=0)
+    file.truncate(size)
+    return file
+
+class Shared_Buffer(Disk_Buffer):
+    """
+    A class used to represent an image of Shared_Storage. Data is not copied, it is sent to the client socket by sendfile
+    from the arena file and read through the arena memory. The image is pinned, it can not be evicted until the buffer is closed.
+    A buffer which is collected without closing is unpinned by the next storage call.
+
+    Attributes:
+    __________
+    storage : Shared_Storage instance
+        The storage which the image belongs to.
+    id : int
+        An id of the order.
+    offset : int
+        Offset of the image in the arena file.
+    """
+
+    def __init__(self, storage, id, offset, size):
+        Disk_Buffer.__init__(self, storage.file, size)
+        self.storage = storage
+        self.id = id
+        self.offset = offset
+
+    def read(self):
+        """ Returns a memoryview of the image in the arena, it is valid until the buffer is closed. """
+        return self.storage.view[self.offset:self.offset + self.size]
+
+    def close(self):
+        """ Unpins the image, the arena file stays open. """
+        if self.storage is not None:
+            self.storage.unpin(self.id)
+            self.storage = None
+
+    def __del__(self):
+        # the lock is not taken here, the garbage collector can run while the lock is held by the same thread
+        if self.storage is not None:
+            self.storage.leaked.append(self.id)
+            self.storage = None
+
+class Shared_Storage():
+    """
+    A class used to represent data storage shared by front-end worker processes. Images are kept in an arena file mapped into
+    memory of all processes, the arena is described by an open addressing hash table in shared memory. An image pushed by any
+    process is visible to all of them, readers get Shared_Buffer views of the arena instead of copies.
+    The storage has to be created before fork. It has the interface of Storage, the disk tier is not supported.
+
+    Attributes:
+    __________
+    file : file object
+        The arena file, images are sent from it by sendfile.
+    view : memoryview
+        The arena mapped into memory.
+    header : Index_Header instance
+        Counters in shared memory.
+    slots : Index_Slot array
+        The hash table in shared memory, an image id is looked up by linear probing from slot id % capacity.
+    capacity : int
+        Number of slots, at most 3/4 of them are used by images.
+    buf_size : int
+        Maximum buffer size in bytes.
+    ttl : float
+        Default lifetime of buffers in seconds, 0 or None means unlimited lifetime.
+    policy : str
+        Eviction policy, one of SHARED_POLICIES.
+    eviction_callback : function
+        Function called with a list of removed ids after every eviction or expiration, it is called without holding the lock.
+    lock : multiprocessing.Lock
+        Lock protecting the index from parallel access of processes and their threads.
+    leaked : deque
+        Ids of images of Shared_Buffer instances of this process which were collected without closing, they are unpinned under the lock.
+
+    Methods:
+    ________
+    push(id, data, img_format, img_length, ttl=None, cost=None)
+        Copies data into the arena.
+    pop_by_id(id)
+        Returns a pinned view of data by id.
+    unpin(id)
+        Releases the image pinned by pop_by_id.
+    release_leaked()
+        Unpins images of buffers which were collected without closing.
+    stats()
+        Returns a dictionary with storage counters.
+    notify_removed(ids)
+        Passes a list of removed ids to eviction_callback.
+    """
+
+    def __init__(self, buf_size, ttl=None, policy='lru', index_size=4096):
+        """
+        Parameters:
+        __________
+        buf_size : int
+            Maximum buffer size in bytes.
+        ttl : float
+            Default lifetime of buffers in seconds, 0 or None means unlimited lifetime.
+        policy : str
+            Eviction policy name: lru or gdsf.
+        index_size : int
+            Number of slots of the hash table.
+        """
+        policy = policy.lower()
+        if policy not in SHARED_POLICIES:
+            raise ValueError(f'Unknown eviction policy {policy}, available: {", ".join(SHARED_POLICIES)}')
+        self.policy = policy
+        self.buf_size = buf_size
+        self.ttl = ttl
+        self.capacity = max(index_size, 16)
+        self.file = arena_file(max(buf_size, 1))
+        self.arena = mmap.mmap(self.file.fileno(), max(buf_size, 1))
+        self.view = memoryview(self.arena)
+        self.index = mmap.mmap(-1, ctypes.sizeof(Index_Header) + ctypes.sizeof(Index_Slot) * self.capacity)
+        self.header = Index_Header.from_buffer(self.index)
+        self.slots = (Index_Slot * self.capacity).from_buffer(self.index, ctypes.sizeof(Index_Header))
+        self.header.next_expiry = float('inf')
+        self.eviction_callback = None
+        self.lock = multiprocessing.Lock()
+        self.leaked = deque()
+
+    def find(self, id):
+        """ Returns the slot of the image or None if there is no image with such id. Has to be called with the lock held. """
+        i = id % self.capacity
+        for _ in range(self.capacity):
+            slot = self.slots[i]
+            if slot.state == SLOT_EMPTY:
+                return None
+            if slot.state == SLOT_USED and slot.id == id:
+                return slot
+            i = (i + 1) % self.capacity
+        return None
+
+    def insert(self, id):
+        """ Returns a free slot for the new image id. Has to be called with the lock held, there has to be a free slot. """
+        i = id % self.capacity
+        while self.slots[i].state == SLOT_USED:
+            i = (i + 1) % self.capacity
+        slot = self.slots[i]
+        if slot.state == SLOT_DELETED:
+            self.header.tombstones -= 1
+        slot.state = SLOT_USED
+        slot.id = id
+        self.header.entries += 1
+        return slot
+
+    def remove(self, slot):
+        """ Removes the image of the slot, its place in the arena becomes free. Has to be called with the lock held. """
+        slot.state = SLOT_DELETED
+        self.header.entries -= 1
+        self.header.tombstones += 1
+        self.header.current_size -= slot.size
+
+    def rehash(self):
+        """ Rebuilds the hash table without deleted slots when there are many of them, so lookups of absent ids stay short.
+        Slots are moved, so it is not called while slots are iterated. Has to be called with the lock held. """
+        if self.header.tombstones <= self.capacity // 4:
+            return
+        used = [Index_Slot.from_buffer_copy(slot) for slot in self.slots if slot.state == SLOT_USED]
+        ctypes.memset(ctypes.addressof(self.slots), 0, ctypes.sizeof(self.slots))
+        self.header.entries = 0
+        self.header.tombstones = 0
+        for old in used:
+            slot = self.insert(old.id)
+            ctypes.pointer(slot)[0] = old
+
+    def touch(self, slot):
+        """ Updates the eviction priority of the image, the image with the lowest priority is evicted first.
+        lru: priority is the sequence number of the last access. gdsf: priority = clock + frequency * cost / size,
+        the clock is raised to the priority of every evicted image. Has to be called with the lock held. """
+        if self.policy == 'lru':
+            self.header.sequence += 1
+            slot.priority = self.header.sequence
+        else:
+            slot.priority = self.header.clock + slot.frequency * slot.cost / max(slot.size, 1)
+
+    def release_leaked(self):
+        """ Unpins images of buffers which were collected without closing. Has to be called with the lock held. """
+        while self.leaked:
+            slot = self.find(self.leaked.popleft())
+            if slot is not None and slot.pins > 0:
+                slot.pins -= 1
+
+    def victim(self):
+        """ Returns the slot of the image which has to be evicted first, pinned images are skipped. Has to be called with the lock held. """
+        victim = None
+        for slot in self.slots:
+            if slot.state == SLOT_USED and slot.pins == 0 and (victim is None or slot.priority < victim.priority):
+                victim = slot
+        if victim is not None and self.policy == 'gdsf':
+            self.header.clock = victim.priority
+        return victim
+
+    def find_gap(self, size):
+        """ Returns the offset of the first free place of the arena where size bytes fit, None if there is no such place.
+        Has to be called with the lock held. """
+        position = 0
+        for offset, length in sorted((slot.offset, slot.size) for slot in self.slots if slot.state == SLOT_USED):
+            if offset - position >= size:
+                return position
+            position = max(position, offset + length)
+        if self.buf_size - position >= size:
+            return position
+        return None
+
+    def remove_expired(self, now):
+        """ Removes unpinned images whose lifetime is over and returns a list of their ids. Has to be called with the lock held. """
+        expired_ids = list()
+        if self.header.next_expiry > now:
+            return expired_ids
+        next_expiry = float('inf')
+        for slot in self.slots:
+            if slot.state != SLOT_USED or not slot.expires:
+                continue
+            if slot.expires <= now and slot.pins == 0:
+                expired_ids.append(slot.id)
+                self.remove(slot)
+                self.header.expirations += 1
+            else:
+                next_expiry = min(next_expiry, slot.expires)
+        self.header.next_expiry = next_expiry
+        self.rehash()
+        return expired_ids
+
+    def notify_removed(self, ids):
+        """ Passes a list of removed ids to eviction_callback. """
+        if ids and self.eviction_callback is not None:
+            self.eviction_callback(ids)
+
+    def push(self, id, data, img_format, img_length, ttl=None, cost=None):
+        """Copies data into the arena, images chosen by the eviction policy are removed until the data fits into a free place.
+
+        Parameters:
+        __________
+        id : int
+            An id of the order, whose data will be stored.
+        data : byte str
+            Data to store in the storage.
+        img_format : str
+            A string which specifies a format of data, it is at most 31 bytes long.
+        img_length : int
+            Data size in bytes declared by the sender, the real size of data is used for accounting.
+        ttl : float
+            Lifetime of the data in seconds, default lifetime of the storage is used if it is None.
+        cost : float
+            Time in seconds which was spent to render the data, it is used by gdsf policy. 1 second is assumed if it is None.
+
+        Returns
+        -------
+        status
+            New order status after pushing the data
+        deleted_ids
+            A list of ids removed from the storage to free space for the data
+        """
+        img_length = len(data)
+        img_format = img_format.encode()
+        if ttl is None:
+            ttl = self.ttl
+        if cost is None:
+            cost = 1.0
+        now = time.monotonic()
+        with self.lock:
+            self.release_leaked()
+            deleted_ids = self.remove_expired(now)
+            if self.find(id) is not None or len(img_format) >= Index_Slot.img_format.size:
+                status = Request_Status.INVALID_PARAM.value
+            elif img_length > self.buf_size:
+                status = Request_Status.NOMEM.value
+            else:
+                offset = None
+                while True:
+                    if self.header.entries < self.capacity * 3 // 4 and self.buf_size >= self.header.current_size + img_length:
+                        offset = self.find_gap(img_length)
+                        if offset is not None:
+                            break
+                    victim = self.victim()
+                    if victim is None:
+                        break
+                    deleted_ids.append(victim.id)
+                    self.remove(victim)
+                    self.header.evictions += 1
+
+                if offset is None:
+                    # all images are pinned by readers
+                    status = Request_Status.NOMEM.value
+                else:
+                    self.rehash()
+                    self.view[offset:offset + img_length] = data
+                    slot = self.insert(id)
+                    slot.offset, slot.size, slot.pins, slot.frequency, slot.cost = offset, img_length, 0, 1, cost
+                    slot.expires = now + ttl if ttl else 0
+                    slot.img_format = img_format
+                    self.touch(slot)
+                    self.header.current_size += img_length
+                    if slot.expires:
+                        self.header.next_expiry = min(self.header.next_expiry, slot.expires)
+                    status = Request_Status.READY.value
+        self.notify_removed(deleted_ids)
+        return status, deleted_ids
+
+    def pop_by_id(self, id):
+        """
+        Returns data by id. Data stays in the storage, the read is registered by the eviction policy.
+
+        Parameters:
+        __________
+        id : int
+            An id of the order, whose data is stored.
+
+        Returns
+        -------
+        data
+            (Shared_Buffer, img_format) or None if there is no data with such id, Shared_Buffer has to be closed by the caller
+        """
+        with self.lock:
+            self.release_leaked()
+            now = time.monotonic()
+            deleted_ids = self.remove_expired(now)
+            slot = self.find(id)
+            if slot is None or (slot.expires and slot.expires <= now):
+                self.header.misses += 1
+                entry = None
+            else:
+                self.header.hits += 1
+                slot.pins += 1
+                slot.frequency += 1
+                self.touch(slot)
+                entry = (Shared_Buffer(self, id, slot.offset, slot.size), slot.img_format.decode())
+        self.notify_removed(deleted_ids)
+        return entry
+
+    def unpin(self, id):
+        """ Releases the image pinned by pop_by_id. """
+        with self.lock:
+            slot = self.find(id)
+            if slot is not None and slot.pins > 0:
+                slot.pins -= 1
+
+    def stats(self):
+        """ Returns a dictionary with storage counters. """
+        with self.lock:
+            return {'size': self.header.current_size, 'max_size': self.buf_size, 'entries': self.header.entries,
+                    'hits': self.header.hits, 'misses': self.header.misses, 'evictions': self.header.evictions,
+                    'expirations': self.header.expirations}
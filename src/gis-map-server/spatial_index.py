@@ -0,0 +1,152 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+#!/usr/bin/python3 -uB
+import math
+
+from utils import PIXEL_SIZE, DEGREE_LENGTH, canonical_params
+
+# formats of rendered images which are cropped: lossless ones, so a crop is equal to the rendered window
+CROP_SOURCE_FORMATS = ('png', 'bmp', 'tiff')
+
+# size of grid cells in pixels of the map scale
+CELL_PIXELS = 1024
+
+# ratio of adjacent map scales which clients zoom between
+ZOOM_FACTOR = 2
+
+# windows with the center farther from the equator are not prefetched
+MAX_PREFETCH_LAT = 85.0
+
+def pixel_degrees(scale, lat):
+    """Function returns (latitude, longitude) size of a pixel in degrees. A pixel is assumed to be a square of scale * PIXEL_SIZE metres
+    on the ground, as tile_params() assumes, so its longitude size grows with the latitude. The projection of gis-buffer-renderer is not
+    known to the server, so windows computed with this size match rendered pixels only if the renderer uses the same local projection,
+    that is why CROP_REUSE is disabled by default."""
+    dlat = scale * PIXEL_SIZE / DEGREE_LENGTH
+    return dlat, dlat / max(math.cos(math.radians(lat)), 1e-6)
+
+def split_params(params, part_size):
+    """Function splits the window of the order into a grid of parts whose sides are at most part_size pixels.
+    Parts are rendered in a lossless format, so they can be stitched and cropped without quality loss.
+    Centers of parts are computed with pixel_degrees(), so parts join without seams only for the projection it assumes.
+
+    Returns
+    -------
+    parts
+        List of (canonical parameters of the part, left, upper), left and upper are the position of the part in the window in pixels
+    """
+    scale, lat, lon, w, h = int(params['scale']), float(params['lat']), float(params['lon']), int(params['w']), int(params['h'])
+    dlat, dlon = pixel_degrees(scale, lat)
+    fmt = params['format'] if params['format'] in CROP_SOURCE_FORMATS else 'png'
+    def edges(size):
+        n = math.ceil(size / part_size)
+        return [size * i // n for i in range(n + 1)]
+    rows, columns = edges(h), edges(w)
+    parts = list()
+    for upper, lower in zip(rows, rows[1:]):
+        for left, right in zip(columns, columns[1:]):
+            fields = {'lat': lat - ((upper + lower) / 2 - h / 2) * dlat, 'lon': lon + ((left + right) / 2 - w / 2) * dlon,
+                      'scale': scale, 'w': right - left, 'h': lower - upper, 'format': fmt}
+            parts.append((canonical_params(fields), left, upper))
+    return parts
+
+def neighbour_params(params, quantum=0):
+    """Function returns canonical parameters of windows which interactive clients usually request after the window of the order,
+    the most probable first: the same window at the adjacent scales and the adjacent windows of the same size at the same scale.
+    Coordinates are snapped to the grid like coordinates of client orders, see canonical_params()."""
+    scale, lat, lon, w, h = int(params['scale']), float(params['lat']), float(params['lon']), int(params['w']), int(params['h'])
+    dlat, dlon = pixel_degrees(scale, lat)
+    windows = [(lat, lon, scale // ZOOM_FACTOR), (lat, lon, scale * ZOOM_FACTOR),
+               (lat, lon + w * dlon, scale), (lat, lon - w * dlon, scale), (lat + h * dlat, lon, scale), (lat - h * dlat, lon, scale)]
+    return [canonical_params({'lat': y, 'lon': (x + 180) % 360 - 180, 'scale': zoom, 'w': w, 'h': h, 'format': params['format']}, quantum)
+            for y, x, zoom in windows if zoom > 0 and abs(y) <= MAX_PREFETCH_LAT]
+
+class Spatial_Index():
+    """
+    A class used to find rendered images which contain the window of a new order, so the order can be cropped from them.
+    Extents of images are kept in a grid of cells of CELL_PIXELS pixels for every scale, an image is registered in all cells
+    which it overlaps, so images containing a window are found among images of the cell of its center.
+
+    Attributes:
+    __________
+    cells : dict
+        Key: (scale, row, column), val: set of ids of images which overlap the cell.
+    extents : dict
+        Key: id, val: (scale, lat, lon, w, h, cells) of the image.
+    max_shift : float
+        Maximum distance in pixels between the window and the pixel grid of the image, farther windows are not cropped.
+
+    Methods:
+    ________
+    add(id, params)
+        Registers the rendered image of the order.
+    remove(id)
+        Forgets the image.
+    find(params)
+        Returns the image which contains the window of the order and the crop box.
+    """
+
+    def __init__(self, max_shift=0.25):
+        self.cells = dict()
+        self.extents = dict()
+        self.max_shift = max_shift
+
+    def cell_size(self, scale):
+        """ Returns the size of a grid cell in degrees for the scale, the same for latitude and longitude. """
+        return CELL_PIXELS * scale * PIXEL_SIZE / DEGREE_LENGTH
+
+    def add(self, id, params):
+        """ Registers the rendered image of the order with canonical parameters params. """
+        scale, lat, lon, w, h = int(params['scale']), float(params['lat']), float(params['lon']), int(params['w']), int(params['h'])
+        if scale <= 0:
+            return
+        dlat, dlon = pixel_degrees(scale, lat)
+        size = self.cell_size(scale)
+        rows = range(math.floor((lat - h / 2 * dlat) / size), math.floor((lat + h / 2 * dlat) / size) + 1)
+        columns = range(math.floor((lon - w / 2 * dlon) / size), math.floor((lon + w / 2 * dlon) / size) + 1)
+        cells = [(scale, row, column) for row in rows for column in columns]
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(id)
+        self.extents[id] = (scale, lat, lon, w, h, cells)
+
+    def remove(self, id):
+        """ Forgets the image. """
+        extent = self.extents.pop(id, None)
+        if extent is None:
+            return
+        for cell in extent[5]:
+            ids = self.cells[cell]
+            ids.discard(id)
+            if not ids:
+                self.cells.pop(cell)
+
+    def find(self, params):
+        """ Returns the image which contains the window of the order with canonical parameters params.
+
+        Returns
+        -------
+        crop
+            (id, (left, upper, right, lower) box of the window in pixels of the image) for the smallest image containing the window,
+            or None if there is no such image
+        """
+        scale, lat, lon, w, h = int(params['scale']), float(params['lat']), float(params['lon']), int(params['w']), int(params['h'])
+        if scale <= 0:
+            return None
+        size = self.cell_size(scale)
+        best = None
+        for id in self.cells.get((scale, math.floor(lat / size), math.floor(lon / size)), ()):
+            src_scale, src_lat, src_lon, src_w, src_h, cells = self.extents[id]
+            if src_w * src_h < w * h or (best is not None and src_w * src_h >= best[2]):
+                continue
+            dlat, dlon = pixel_degrees(scale, src_lat)
+            left = (lon - src_lon) / dlon + (src_w - w) / 2
+            upper = (src_lat - lat) / dlat + (src_h - h) / 2
+            x, y = round(left), round(upper)
+            if abs(left - x) > self.max_shift or abs(upper - y) > self.max_shift:
+                continue
+            if x < 0 or y < 0 or x + w > src_w or y + h > src_h:
+                continue
+            best = (id, (x, y, x + w, y + h), src_w * src_h)
+        return None if best is None else best[:2]
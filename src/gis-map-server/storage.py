@@ -4,36 +4,106 @@
 
 #!/usr/bin/python3 -uB
 from utils import Request_Status
+from eviction import Lru_Policy
+import heapq
+import threading
+import time
 
 class Storage():
-    """ 
-    A class used to represent data storage for buffers obtained from Renderer. 
+    """
+    A class used to represent data storage for buffers obtained from Renderer.
     From the storage data is popped from Iterface class when it is requested by the client.
-    
+    When there is not enough space for new data, buffers chosen by the eviction policy are evicted.
+    If the disk tier is used, evicted buffers are moved into it and they are read from files on request.
+
     Attributes:
     __________
     storage : dict
-        A dictionary used to store buffers. Key: id, val: (data, img_format).
+        A dictionary used to store buffers. Key: id, val: (data, img_format, expires, cost).
+    policy : Eviction_Policy instance
+        Policy which chooses buffers to evict, least recently used buffers are evicted by default.
+    disk : Disk_Storage instance
+        The second tier for evicted buffers, None if buffers are dropped on eviction.
+    spilling : dict
+        Buffers which are being written into the disk tier, they are still available for reading. Key: id, val: entry of storage.
     current_size : int
         Current size of buffer in bytes. It counts only size of data, not the dictionary element.
     buf_size : int
         Maximum buffer size in bytes.
+    ttl : float
+        Default lifetime of buffers in seconds, 0 or None means unlimited lifetime.
+    hits : int
+        Number of successful pop_by_id calls, including reads from the disk tier.
+    misses : int
+        Number of pop_by_id calls for absent or expired ids.
+    evictions : int
+        Number of buffers evicted from memory to free space for new data.
+    expirations : int
+        Number of buffers removed because their lifetime is over.
+    eviction_callback : function
+        Function called with a list of removed ids after every eviction or expiration, it is called without holding the lock.
+    lock : threading.Lock
+        Lock protecting storage from parallel access of request handler threads.
 
     Methods:
     ________
-    push(id, data, img_format, img_length)
+    push(id, data, img_format, img_length, ttl=None, cost=None)
         Pushes data to the storage.
     pop_by_id(id)
         Pops data by id.
+    stats()
+        Returns a dictionary with storage counters.
+    remove(id)
+        Removes data by id and returns the removed entry.
+    remove_expired(now)
+        Removes all buffers whose lifetime is over and returns a list of their ids.
+    notify_removed(ids)
+        Passes a list of removed ids to eviction_callback.
     """
-    def __init__(self, buf_size):
+    def __init__(self, buf_size, ttl=None, policy=None, disk=None):
         self.storage = dict()
+        self.policy = Lru_Policy() if policy is None else policy
+        self.disk = disk
+        self.spilling = dict()
         self.current_size = 0
         self.buf_size = buf_size
+        self.ttl = ttl
+        self.expiry_heap = list()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.eviction_callback = None
+        self.lock = threading.Lock()
+
+    def remove(self, id):
+        """ Removes data by id and returns the removed entry. Has to be called with the lock held. """
+        entry = self.storage.pop(id)
+        self.policy.remove(id)
+        self.current_size -= len(entry[0])
+        return entry
+
+    def remove_expired(self, now):
+        """ Removes all buffers whose lifetime is over and returns a list of their ids. Has to be called with the lock held. """
+        expired_ids = list()
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expires, id = heapq.heappop(self.expiry_heap)
+            entry = self.storage.get(id)
+            # the heap element is outdated if the id was removed or pushed again
+            if entry is not None and entry[2] == expires:
+                self.remove(id)
+                self.expirations += 1
+                expired_ids.append(id)
+        return expired_ids
 
-    def push(self, id, data, img_format, img_length):
+    def notify_removed(self, ids):
+        """ Passes a list of removed ids to eviction_callback. """
+        if ids and self.eviction_callback is not None:
+            self.eviction_callback(ids)
+
+    def push(self, id, data, img_format, img_length, ttl=None, cost=None):
         """Pushes data to the storage.
-        
+
         Parameters:
         __________
         id : int
@@ -43,47 +113,102 @@ class Storage():
         img_format : str
             A string which specifies a format of data.
         img_length : int
-            Data size in bytes.
-        
+            Data size in bytes declared by the sender, the real size of data is used for accounting.
+        ttl : float
+            Lifetime of the data in seconds, default lifetime of the storage is used if it is None.
+        cost : float
+            Time in seconds which was spent to render the data, it is used by cost-aware eviction policies. 1 second is assumed if it is None.
+
         Returns
         -------
         status
             New order status after pushing the data
+        deleted_ids
+            A list of ids removed from the storage to free space for the data
         """
-        if id in self.storage:
-            return Request_Status.INVALID_PARAM.value
-        
-        if img_length > self.buf_size:
-            return Request_Status.NOMEM.value
-        
-        deleted_ids = list()
-        if self.buf_size < (self.current_size + img_length):
-            keys = list(self.storage.keys())
-            for i in keys:
-                d = self.storage.pop(i)
-                deleted_ids.append(i)
-                self.current_size -= len(d[0])
-                if self.buf_size >= (self.current_size + img_length):
-                    break
-        
-        self.storage[id] = (data, img_format)
-        self.current_size += img_length
-        return Request_Status.READY.value, deleted_ids
+        img_length = len(data)
+        if ttl is None:
+            ttl = self.ttl
+        if cost is None:
+            cost = 1.0
+        now = time.monotonic()
+        spilled_ids = list()
+        with self.lock:
+            deleted_ids = self.remove_expired(now)
+            if id in self.storage:
+                status = Request_Status.INVALID_PARAM.value
+            elif img_length > self.buf_size:
+                status = Request_Status.NOMEM.value
+            else:
+                while self.buf_size < (self.current_size + img_length):
+                    old_id = self.policy.victim()
+                    entry = self.remove(old_id)
+                    self.evictions += 1
+                    if self.disk is None:
+                        deleted_ids.append(old_id)
+                    else:
+                        self.spilling[old_id] = entry
+                        spilled_ids.append(old_id)
+
+                expires = now + ttl if ttl else None
+                self.storage[id] = (data, img_format, expires, cost)
+                self.current_size += img_length
+                self.policy.insert(id, img_length, cost)
+                if expires is not None:
+                    heapq.heappush(self.expiry_heap, (expires, id))
+                status = Request_Status.READY.value
+
+        # writing evicted buffers into files without holding the lock
+        for old_id in spilled_ids:
+            data, img_format, expires, cost = self.spilling[old_id]
+            deleted_ids += self.disk.push(old_id, data, img_format, expires, cost)
+            with self.lock:
+                self.spilling.pop(old_id)
+        self.notify_removed(deleted_ids)
+        return status, deleted_ids
 
     def pop_by_id(self, id):
         """
-        Pops data by id.
-        
+        Pops data by id. Data stays in the storage, the read is registered by the eviction policy.
+
         Parameters:
         __________
         id : int
             An id of the order, whose data is stored.
-            
+
         Returns
         -------
         data
-            Data popped by id
+            Data popped by id as (data, img_format) or None if there is no data with such id.
+            Data read from the disk tier is returned as Disk_Buffer instance instead of byte str, the caller has to close it
         """
-        data = self.storage[id]
-        #self.current_size -= len(data[0])
-        return data
+        with self.lock:
+            deleted_ids = self.remove_expired(time.monotonic())
+            entry = self.storage.get(id)
+            if entry is not None:
+                self.policy.access(id)
+            else:
+                entry = self.spilling.get(id)
+        if entry is None and self.disk is not None:
+            entry, expired_ids = self.disk.get(id)
+            deleted_ids += expired_ids
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        self.notify_removed(deleted_ids)
+        if entry is None:
+            return None
+        return entry[0], entry[1]
+
+    def stats(self):
+        """ Returns a dictionary with storage counters. """
+        with self.lock:
+            stats = {'size': self.current_size, 'max_size': self.buf_size, 'entries': len(self.storage),
+                     'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'expirations': self.expirations}
+        if self.disk is not None:
+            with self.disk.lock:
+                stats.update({'disk_size': self.disk.current_size, 'disk_max_size': self.disk.buf_size, 'disk_entries': len(self.disk.index),
+                              'disk_hits': self.disk.hits, 'disk_evictions': self.disk.evictions})
+        return stats
@@ -0,0 +1,28 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+""" Modules of the server are imported by their names like the server does it, so the server folder is added to the path. """
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class Fake_Pipe():
+    """ Pipe connection of Scheduler which saves sent messages. """
+
+    def __init__(self):
+        self.sent = list()
+
+    def send(self, message):
+        self.sent.append(message)
+
+    def notifications(self, method):
+        """ Returns payloads of sent notifications of the method. """
+        return [message[2] for message in self.sent if message[0] is None and message[1] == method.value]
+
+@pytest.fixture
+def pipe():
+    return Fake_Pipe()
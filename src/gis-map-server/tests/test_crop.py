@@ -0,0 +1,52 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+""" Orders cropped from rendered images. """
+from utils import Request_Status, canonical_params
+from rpc import Rpc_Method
+from scheduler import Scheduler
+from spatial_index import Spatial_Index, pixel_degrees
+
+def window(lat, lon, size, fmt='png'):
+    return canonical_params({'lat': lat, 'lon': lon, 'scale': '100000', 'w': size, 'h': size, 'format': fmt})
+
+def cropping_scheduler(pipe):
+    """ Returns Scheduler with a rendered 1024x1024 image and the id of a 256x256 order inside it which is being cropped. """
+    scheduler = Scheduler({'CROP_REUSE': 1})
+    source, _ = scheduler.add_order(window(55, 37, 1024), Request_Status.READY.value)
+    scheduler.spatial.add(source, scheduler.orders[source][0])
+    dlat, dlon = pixel_degrees(100000, 55)
+    fields = {'lat': str(55 + 100 * dlat), 'lon': str(37 + 50 * dlon), 'scale': '100000', 'w': '256', 'h': '256', 'format': 'jpeg'}
+    scheduler.handle_request(pipe, (1, Rpc_Method.NEW_ORDER.value, (fields, 'client')))
+    (orderId, pincode), code = pipe.sent[-1][1]
+    assert code == 1
+    return scheduler, source, orderId
+
+def test_crop_box(pipe):
+    scheduler, source, orderId = cropping_scheduler(pipe)
+    assert pipe.notifications(Rpc_Method.TRANSCODE_ORDER) == [(orderId, source, scheduler.orders[orderId][0], (434, 284, 690, 540))]
+    assert not scheduler.queue and scheduler.crop_count == 1
+
+def test_crop_of_evicted_source_is_rendered(pipe):
+    scheduler, source, orderId = cropping_scheduler(pipe)
+    scheduler.handle_request(pipe, (None, Rpc_Method.ORDER_TRANSCODED.value, (orderId, Request_Status.NOMEM.value)))
+    assert scheduler.orders[orderId][1] == Request_Status.PROCESSING.value
+    assert orderId in scheduler.queue
+    assert pipe.notifications(Rpc_Method.ORDER_FINISHED) == []
+    # the source is not used for crops any more
+    assert scheduler.spatial.find(scheduler.orders[orderId][0]) is None
+
+def test_crop_is_finished(pipe):
+    scheduler, source, orderId = cropping_scheduler(pipe)
+    scheduler.handle_request(pipe, (None, Rpc_Method.ORDER_TRANSCODED.value, (orderId, Request_Status.READY.value)))
+    assert scheduler.orders[orderId][1] == Request_Status.READY.value
+    assert pipe.notifications(Rpc_Method.ORDER_FINISHED) == [(orderId, Request_Status.READY.value)]
+
+def test_misaligned_window_is_not_cropped():
+    index = Spatial_Index(max_shift=0.25)
+    index.add(1, window(55, 37, 1024))
+    dlat, dlon = pixel_degrees(100000, 55)
+    assert index.find(window(55 + 0.5 * dlat, 37, 256)) is None
+    assert index.find(window(55, 37, 2048)) is None
+    assert index.find(window(55, 37, 256)) == (1, (384, 384, 640, 640))
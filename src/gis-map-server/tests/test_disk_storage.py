@@ -0,0 +1,26 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+""" The disk tier of Storage. """
+import os
+
+from disk_storage import Disk_Storage, DISK_TIER_FOLDER
+
+def test_only_own_folder_is_cleared(tmp_path):
+    (tmp_path / 'user-file').write_bytes(b'data')
+    storage = Disk_Storage(str(tmp_path), 1024)
+    assert storage.push(1, b'image', 'image/png', None, 1.0) == []
+    assert sorted(os.listdir(tmp_path)) == [DISK_TIER_FOLDER, 'user-file']
+    Disk_Storage(str(tmp_path), 1024)
+    assert sorted(os.listdir(tmp_path)) == [DISK_TIER_FOLDER, 'user-file']
+    assert os.listdir(tmp_path / DISK_TIER_FOLDER) == []
+
+def test_buffers_are_evicted(tmp_path):
+    storage = Disk_Storage(str(tmp_path), 10)
+    storage.push(1, b'12345', 'image/png', None, 1.0)
+    storage.push(2, b'12345', 'image/png', None, 1.0)
+    assert storage.push(3, b'12345', 'image/png', None, 1.0) == [1]
+    (data, img_format), expired = storage.get(3)
+    assert data.read() == b'12345' and img_format == 'image/png' and expired == []
+    data.close()
@@ -0,0 +1,36 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+""" Eviction policies of Storage. """
+import pytest
+
+from eviction import Eviction_Policy, Lru_Policy, Gdsf_Policy
+
+def test_incomplete_policy_can_not_be_created():
+    class No_Victim_Policy(Eviction_Policy):
+        def insert(self, id, size, cost):
+            pass
+
+        def access(self, id):
+            pass
+
+        def remove(self, id):
+            pass
+
+    with pytest.raises(TypeError):
+        No_Victim_Policy()
+
+def test_lru_victim():
+    policy = Lru_Policy()
+    for id in (1, 2, 3):
+        policy.insert(id, 100, 1.0)
+    policy.access(1)
+    policy.remove(2)
+    assert policy.victim() == 3
+
+def test_gdsf_keeps_expensive_buffers():
+    policy = Gdsf_Policy()
+    policy.insert(1, 100, 10.0)
+    policy.insert(2, 100, 0.1)
+    assert policy.victim() == 2
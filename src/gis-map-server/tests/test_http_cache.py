@@ -0,0 +1,45 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+""" Conditional requests of images. """
+import io
+from email.message import Message
+
+from net_interface import Handler
+from http_cache import Response_Cache
+
+class Fake_Events():
+    def trace(self, orderId, stage):
+        pass
+
+class Image_Handler(Handler):
+    """ Handler which writes the response into memory. """
+
+    def __init__(self, headers):
+        self.events = Fake_Events()
+        self.http_cache = Response_Cache(1 << 20)
+        self.settings = {'COMPRESS_TYPES': 'image/bmp', 'COMPRESS_MIN_SIZE': 16, 'CACHE_MAX_AGE': 60}
+        self.headers = Message()
+        for key, value in headers.items():
+            self.headers[key] = value
+        self.request_version = 'HTTP/1.1'
+        self.requestline = 'GET /'
+        self.command = 'GET'
+        self.client_address = ('127.0.0.1', 0)
+        self.wfile = io.BytesIO()
+
+    def log_message(self, format, *args):
+        pass
+
+def response_headers(headers):
+    handler = Image_Handler(headers)
+    handler.send_image(1, (bytes(4096), 'image/bmp'))
+    head = handler.wfile.getvalue().split(b'\r\n\r\n')[0].decode().split('\r\n')
+    return head[0], dict(line.split(': ', 1) for line in head[1:])
+
+def test_not_modified_has_vary_of_full_response():
+    status, headers = response_headers({'Accept-Encoding': 'gzip'})
+    assert status.endswith('200 OK') and headers['Vary'] == 'Accept-Encoding' and headers['Content-Encoding'] == 'gzip'
+    status, not_modified = response_headers({'Accept-Encoding': 'gzip', 'If-None-Match': headers['ETag']})
+    assert ' 304 ' in status and not_modified['Vary'] == 'Accept-Encoding' and not_modified['ETag'] == headers['ETag']
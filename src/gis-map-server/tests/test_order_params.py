@@ -0,0 +1,58 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+""" Validation and canonical form of order parameters. """
+import pytest
+
+from utils import Request_Status, canonical_params, is_decimal, is_finite
+from rpc import Rpc_Method
+from scheduler import Scheduler
+
+def order(**fields):
+    params = {'lat': '55.75', 'lon': '37.62', 'scale': '100000', 'w': '256', 'h': '256', 'format': 'png'}
+    params.update(fields)
+    return params
+
+def new_order(scheduler, fields, pipe):
+    pipe.sent.clear()
+    scheduler.handle_request(pipe, (1, Rpc_Method.NEW_ORDER.value, (fields, 'client')))
+    answers = [message for message in pipe.sent if message[0] == 1]
+    assert len(answers) == 1
+    return answers[0][1]
+
+def test_helpers():
+    assert is_decimal('100') and not is_decimal('²') and not is_decimal('-1') and not is_decimal('')
+    assert is_finite('55.5') and is_finite('-1e3')
+    assert not is_finite('nan') and not is_finite('inf') and not is_finite('-Infinity') and not is_finite('abc')
+
+@pytest.mark.parametrize('fields', [{'lat': 'nan'}, {'lon': 'inf'}, {'lat': '-infinity'}, {'scale': '²'}, {'w': '٣'},
+                                    {'scale': '0'}, {'w': '0'}, {'h': '0'}, {'deadline': 'nan'}, {'lat': 'x'}])
+@pytest.mark.parametrize('quantum', [0, 16])
+def test_bad_params_are_rejected(fields, quantum, pipe):
+    scheduler = Scheduler({'KEY_QUANTUM_PIXELS': quantum, 'CROP_REUSE': 1})
+    assert not scheduler.validator(order(**fields))
+    (orderId, pincode), code = new_order(scheduler, order(**fields), pipe)
+    assert code == 0 and not scheduler.orders
+
+def test_valid_order_is_queued(pipe):
+    scheduler = Scheduler({'KEY_QUANTUM_PIXELS': 16})
+    (orderId, pincode), code = new_order(scheduler, order(lat='55.750001', deadline='10'), pipe)
+    assert code == 1 and scheduler.orders[orderId][1] == Request_Status.PROCESSING.value
+    # an order of the same quantised window is deduplicated
+    assert new_order(scheduler, order(), pipe)[0][0] == orderId
+
+def test_canonical_params():
+    params = canonical_params(order(lat='55.7500000001', w='0256', format=' PNG ', quality='0'))
+    assert params == {'lat': '55.7500000', 'lon': '37.6200000', 'scale': '100000', 'w': '256', 'h': '256', 'format': 'png'}
+
+def test_request_error_is_answered(pipe):
+    scheduler = Scheduler()
+    requests = [(1, Rpc_Method.NEW_ORDER.value, None), (2, Rpc_Method.CHECK_ORDER.value, None), (None, Rpc_Method.ORDER_TRACE.value, None),
+                (3, Rpc_Method.NEW_ORDER.value, (order(), 'client'))]
+    pipe.poll = lambda: bool(requests)
+    pipe.recv = lambda: requests.pop(0)
+    scheduler.serve_requests(pipe)
+    assert pipe.sent[0] == (1, ((0, 0), 0))
+    assert pipe.sent[1] == (2, Request_Status.REQUEST_FAILED.value)
+    assert pipe.sent[2][0] == 3 and pipe.sent[2][1][1] == 1
@@ -0,0 +1,120 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+""" Prefetch renders of windows adjacent to rendered ones. """
+import pytest
+
+from utils import Request_Status, canonical_params, render_key
+from rpc import Rpc_Method
+import scheduler as scheduler_module
+from scheduler import Scheduler, Worker
+
+def window(lat, size=256):
+    return canonical_params({'lat': lat, 'lon': 37, 'scale': '100000', 'w': size, 'h': size, 'format': 'png'})
+
+class Stub_Child():
+    """ Renderer process which runs until it is killed. """
+
+    def __init__(self, args):
+        self.args = args
+        self.returncode = None
+        self.killed = False
+
+    def poll(self):
+        return self.returncode
+
+    def kill(self):
+        self.killed = True
+        self.returncode = -9
+
+    def wait(self):
+        return self.returncode
+
+@pytest.fixture
+def children(monkeypatch):
+    """ Renderer processes started by Scheduler. """
+    started = list()
+    def popen(args):
+        started.append(Stub_Child(args))
+        return started[-1]
+    monkeypatch.setattr(scheduler_module.subprocess, 'Popen', popen)
+    return started
+
+def prefetching_scheduler(budget, slots=1, candidates=4, slots_num=4):
+    """ Returns Scheduler with candidate windows for prefetching and its Worker. """
+    scheduler = Scheduler({'PREFETCH_BUDGET': budget, 'PREFETCH_SLOTS': slots})
+    scheduler.util_path = 'gis-buffer-renderer'
+    scheduler.common_args = list()
+    for i in range(candidates):
+        scheduler.candidates.append(window(50 + i))
+    worker = Worker(slots_num)
+    scheduler.worker = worker
+    return scheduler, worker
+
+def test_prefetch_slots_limit(pipe, children):
+    scheduler, worker = prefetching_scheduler(budget=10, slots=2)
+    scheduler.prefetch_orders(pipe, worker)
+    assert len(children) == 2 and len(scheduler.prefetching) == 2 and scheduler.prefetch_count == 2
+    assert all(scheduler.orders[id][0] in (window(53), window(52)) for id in scheduler.prefetching)
+    # a finished prefetch render frees its prefetch slot
+    scheduler.finish_order(pipe, min(scheduler.prefetching), Request_Status.READY.value)
+    scheduler.prefetch_orders(pipe, worker)
+    assert len(children) == 3 and len(scheduler.prefetching) == 2
+
+def test_prefetch_budget(pipe, children, monkeypatch):
+    scheduler, worker = prefetching_scheduler(budget=2, slots=4)
+    scheduler.prefetch_orders(pipe, worker)
+    assert len(children) == 2 and len(scheduler.candidates) == 2
+    for id in list(scheduler.prefetching):
+        scheduler.finish_order(pipe, id, Request_Status.READY.value)
+    scheduler.prefetch_orders(pipe, worker)
+    assert len(children) == 2
+    # the budget is renewed after a minute
+    now = scheduler_module.time.monotonic() + 61
+    monkeypatch.setattr(scheduler_module.time, 'monotonic', lambda: now)
+    scheduler.prefetch_orders(pipe, worker)
+    assert len(children) == 4 and scheduler.prefetch_count == 4
+
+def test_cached_windows_are_not_prefetched(pipe, children):
+    scheduler, worker = prefetching_scheduler(budget=10, slots=4, candidates=2)
+    scheduler.add_order(window(51), Request_Status.READY.value)
+    scheduler.prefetch_orders(pipe, worker)
+    assert len(children) == 1 and [scheduler.orders[id][0] for id in scheduler.prefetching] == [window(50)]
+
+def test_prefetch_waits_for_client_orders(pipe, children):
+    scheduler, worker = prefetching_scheduler(budget=10, slots=4)
+    scheduler.add_order(window(10), client='client')
+    scheduler.prefetch_orders(pipe, worker)
+    assert not children and not scheduler.prefetching
+
+def test_prefetch_is_cancelled_for_client_order(pipe, children):
+    scheduler, worker = prefetching_scheduler(budget=10, slots=4, slots_num=2)
+    scheduler.prefetch_orders(pipe, worker)
+    assert len(children) == 2 and worker.size == 2
+    prefetched = sorted(scheduler.prefetching)
+    clientId, _ = scheduler.add_order(window(10), client='client')
+    scheduler.cancel_prefetch(pipe, worker)
+    # one slot is enough for the client order
+    cancelled = [id for id in prefetched if scheduler.orders[id][1] == Request_Status.EXPIRED.value]
+    assert len(cancelled) == 1 and scheduler.prefetch_cancelled == 1 and worker.size == 1
+    assert [child.killed for child in children].count(True) == 1
+    assert (cancelled[0], Request_Status.EXPIRED.value) in pipe.notifications(Rpc_Method.ORDER_FINISHED)
+    assert render_key(scheduler.orders[cancelled[0]][0]) not in scheduler.cached and cancelled[0] not in scheduler.prefetching
+    scheduler.dispatch_orders(pipe, worker)
+    assert worker.size == 2 and children[-1].args[1] == f'-o{clientId}'
+
+def test_requested_prefetch_order_is_kept(pipe, children):
+    scheduler, worker = prefetching_scheduler(budget=10, slots=4, candidates=1, slots_num=1)
+    scheduler.prefetch_orders(pipe, worker)
+    [prefetchId] = scheduler.prefetching
+    assert scheduler.orders[prefetchId][0] == window(50)
+    fields = {'lat': '50', 'lon': '37', 'scale': '100000', 'w': '256', 'h': '256', 'format': 'png'}
+    scheduler.handle_request(pipe, (1, Rpc_Method.NEW_ORDER.value, (fields, 'client')))
+    (orderId, pincode), code = pipe.sent[-1][1]
+    assert code == 1 and orderId == prefetchId and not scheduler.prefetching
+    # a queued client order does not cancel the render which the client waits for
+    scheduler.add_order(window(10), client='client')
+    scheduler.cancel_prefetch(pipe, worker)
+    assert not children[0].killed and scheduler.orders[prefetchId][1] == Request_Status.PROCESSING.value
+    assert scheduler.prefetch_cancelled == 0
@@ -0,0 +1,31 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+""" Byte ranges of images. """
+from email.message import Message
+
+import pytest
+
+from net_interface import Handler
+
+class Range_Handler(Handler):
+    """ Handler with request headers only. """
+
+    def __init__(self, headers):
+        self.headers = Message()
+        for key, value in headers.items():
+            self.headers[key] = value
+
+@pytest.mark.parametrize('value, result', [
+    ('bytes=0-99', (0, 100)), ('bytes=10-', (10, 90)), ('bytes=90-200', (90, 10)), ('bytes=-30', (70, 30)), ('bytes=-300', (0, 100)),
+    # not satisfiable
+    ('bytes=100-', (0, 0)), ('bytes=100-200', (0, 0)), ('bytes=-0', (0, 0)),
+    # not valid, the whole image is sent
+    ('bytes=5-3', None), ('bytes=a-3', None), ('bytes=0-1,5-6', None), ('items=0-1', None)])
+def test_range(value, result):
+    assert Range_Handler({'Range': value}).parse_range(100, '"etag"') == result
+
+def test_if_range():
+    assert Range_Handler({'Range': 'bytes=0-9', 'If-Range': '"etag"'}).parse_range(100, '"etag"') == (0, 10)
+    assert Range_Handler({'Range': 'bytes=0-9', 'If-Range': '"old"'}).parse_range(100, '"etag"') is None
@@ -0,0 +1,18 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+""" Routing keys of gis-map-router. """
+import pytest
+
+from router import region_key
+
+@pytest.mark.parametrize('fields', [{'lat': 'inf'}, {'lat': 'nan'}, {'scale': '²'}, {'scale': '0'}])
+def test_bad_params_are_routed_by_text(fields):
+    params = {'lat': '55', 'lon': '37', 'scale': '100000', 'w': '256', 'h': '256', 'format': 'png'}
+    params.update(fields)
+    assert region_key(params, 16) == '&'.join(f'{key}={val}' for key, val in sorted(params.items()))
+
+def test_formats_of_one_region_have_one_key():
+    params = {'lat': '55', 'lon': '37', 'scale': '100000', 'w': '256', 'h': '256'}
+    assert region_key(dict(params, format='png')) == region_key(dict(params, format='jpeg', quality='50'))
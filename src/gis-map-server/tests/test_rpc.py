@@ -0,0 +1,69 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+""" Scheduler side of RPC channels when a front-end worker exits. """
+from multiprocessing import Pipe, Process
+import time
+
+from rpc import Rpc_Hub, Rpc_Method
+from scheduler import Scheduler
+import server
+
+def hub_pipes(count):
+    pipes = [Pipe() for i in range(count)]
+    return Rpc_Hub(sched_conn for sched_conn, serv_conn in pipes), [serv_conn for sched_conn, serv_conn in pipes]
+
+def test_closed_connection_is_dropped_on_send():
+    hub, workers = hub_pipes(3)
+    workers[1].close()
+    hub.send((None, Rpc_Method.ORDERS_DELETED.value, [1]))
+    assert len(hub.connections) == 2
+    assert workers[0].recv() == workers[2].recv() == (None, Rpc_Method.ORDERS_DELETED.value, [1])
+    # unicast notifications go to workers which are alive
+    for i in range(4):
+        hub.send((None, Rpc_Method.TRANSCODE_ORDER.value, i))
+    assert [workers[0].recv()[2], workers[0].recv()[2]] == [0, 2] and [workers[2].recv()[2], workers[2].recv()[2]] == [1, 3]
+
+def test_unicast_goes_to_next_worker():
+    hub, workers = hub_pipes(2)
+    workers[0].close()
+    hub.send((None, Rpc_Method.STITCH_ORDER.value, 1))
+    assert hub.connections and workers[1].recv() == (None, Rpc_Method.STITCH_ORDER.value, 1)
+
+def test_closed_connection_is_dropped_on_recv():
+    hub, workers = hub_pipes(3)
+    workers[0].close()
+    workers[2].send((5, Rpc_Method.GET_METRICS.value, None))
+    assert hub.poll()
+    assert hub.recv() == (5, Rpc_Method.GET_METRICS.value, None)
+    assert len(hub.connections) == 2
+    hub.send((5, 'metrics'))
+    assert workers[2].recv() == (5, 'metrics')
+    assert not hub.poll()
+
+def test_scheduler_serves_other_workers():
+    hub, workers = hub_pipes(2)
+    scheduler = Scheduler({})
+    workers[1].close()
+    scheduler.serve_requests(hub)
+    assert len(hub.connections) == 1
+    workers[0].send((1, Rpc_Method.CHECK_ORDER.value, (7, 0)))
+    scheduler.serve_requests(hub)
+    assert workers[0].poll(1) and workers[0].recv()[0] == 1
+    # the scheduler has no worker to serve when the last one exits
+    workers[0].close()
+    hub.send((None, Rpc_Method.ORDERS_DELETED.value, [7]))
+    assert not hub.connections and not hub.poll()
+
+def test_exited_process_stops_server(monkeypatch):
+    interrupted = list()
+    monkeypatch.setattr(server._thread, 'interrupt_main', lambda: interrupted.append(True))
+    exiting = Process(target=int, name='worker 1')
+    sleeping = Process(target=time.sleep, args=(60,), name='scheduler')
+    exiting.start()
+    sleeping.start()
+    new_server = server.Server('localhost', 0, 1, 1024, '', 0)
+    new_server.watch_processes([sleeping, exiting])
+    assert new_server.exited == 'worker 1' and interrupted
+    assert not sleeping.is_alive()
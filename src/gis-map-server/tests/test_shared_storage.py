@@ -0,0 +1,50 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+""" Pins of images of the storage shared by front-end worker processes. """
+import gc
+
+import pytest
+
+from utils import Request_Status
+from shared_storage import Shared_Storage, SLOT_USED
+from net_interface import Handler
+
+def full_storage():
+    storage = Shared_Storage(4096, index_size=16)
+    for id in (1, 2):
+        assert storage.push(id, bytes(2048), 'image/png', 2048)[0] == Request_Status.READY.value
+    return storage
+
+def test_pinned_image_is_not_evicted():
+    storage = full_storage()
+    buffers = [storage.pop_by_id(id)[0] for id in (1, 2)]
+    assert storage.push(3, bytes(2048), 'image/png', 2048) == (Request_Status.NOMEM.value, [])
+    buffers[0].close()
+    buffers[0].close()
+    assert storage.push(3, bytes(2048), 'image/png', 2048) == (Request_Status.READY.value, [1])
+    assert storage.find(2).pins == 1
+
+def test_collected_buffer_is_unpinned():
+    storage = full_storage()
+    buffers = [storage.pop_by_id(id)[0] for id in (1, 2)]
+    assert bytes(buffers[0].read()) == bytes(2048)
+    del buffers
+    gc.collect()
+    assert storage.push(3, bytes(2048), 'image/png', 2048)[0] == Request_Status.READY.value
+    assert [slot.pins for slot in storage.slots if slot.state == SLOT_USED] == [0, 0]
+
+class Reset_Handler():
+    """ Handler whose client resets the connection while the image is sent. """
+
+    def send_entry(self, orderId, output_data, img_format):
+        raise ConnectionResetError
+
+def test_image_is_released_when_client_resets():
+    storage = full_storage()
+    for i in range(3):
+        with pytest.raises(ConnectionResetError):
+            Handler.send_image(Reset_Handler(), 1, storage.pop_by_id(1))
+    assert storage.find(1).pins == 0
+    assert storage.push(3, bytes(2048), 'image/png', 2048)[0] == Request_Status.READY.value
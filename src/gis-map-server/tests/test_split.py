@@ -0,0 +1,136 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+""" Large orders split into parts and stitched from their images. """
+import io
+
+import pytest
+
+from utils import Request_Status, render_key
+from rpc import Rpc_Method
+
+Image = pytest.importorskip('PIL.Image')
+
+from scheduler import Scheduler
+from transcoder import Transcoder, mosaic_mode
+
+def encoded(mode, color, size=(2, 2), fmt='PNG'):
+    output = io.BytesIO()
+    Image.new(mode, size, color).save(output, fmt)
+    return output.getvalue()
+
+class Fake_Rpc():
+    """ RPC channel of Transcoder which saves sent notifications. """
+
+    def __init__(self):
+        self.sent = list()
+
+    def subscribe(self, method, handler):
+        pass
+
+    def notify(self, method, payload):
+        self.sent.append((method, payload))
+
+class Fake_Events():
+    """ Order events of orders without keys and traces. """
+
+    def order_key(self, id):
+        return None
+
+    def render_cost(self, id):
+        return None
+
+    def trace(self, id, stage):
+        pass
+
+class Fake_Buffer():
+    """ Buffer which keeps entries in a dictionary. """
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    def pop_by_id(self, id):
+        return self.entries.get(id)
+
+    def push(self, id, data, img_format, img_length, ttl=None, cost=None):
+        self.entries[id] = (data, img_format)
+        return Request_Status.READY.value, list()
+
+def stitched(parts, fmt='png'):
+    """ Stitches 4x2 image of order 10 from two 2x2 parts with ids 1 and 2 and returns it decoded. """
+    rpc = Fake_Rpc()
+    buffer = Fake_Buffer({id: (data, 'image/png') for id, data in parts.items()})
+    transcoder = Transcoder(rpc, Fake_Events(), buffer, None, 1)
+    transcoder.stitch(10, {'w': '4', 'h': '2', 'format': fmt}, [(1, 0, 0), (2, 2, 0)])
+    assert rpc.sent == [(Rpc_Method.ORDER_TRANSCODED, (10, Request_Status.READY.value))]
+    return Image.open(io.BytesIO(buffer.entries[10][0]))
+
+def test_mosaic_mode():
+    assert mosaic_mode([Image.new('RGB', (1, 1)), Image.new('RGB', (1, 1))]) == 'RGB'
+    assert mosaic_mode([Image.new('RGB', (1, 1)), Image.new('RGBA', (1, 1))]) == 'RGBA'
+    assert mosaic_mode([Image.new('P', (1, 1))]) == 'RGBA'
+
+def test_parts_of_different_modes_are_stitched():
+    image = stitched({1: encoded('RGB', (255, 0, 0)), 2: encoded('RGBA', (0, 0, 255, 0))})
+    assert image.mode == 'RGBA'
+    # transparency of the second part is kept
+    assert image.getpixel((0, 0)) == (255, 0, 0, 255) and image.getpixel((3, 1)) == (0, 0, 255, 0)
+
+def test_parts_of_one_mode_are_stitched():
+    image = stitched({1: encoded('RGB', (255, 0, 0)), 2: encoded('RGB', (0, 255, 0))}, fmt='jpeg')
+    assert image.format == 'JPEG' and image.mode == 'RGB' and image.size == (4, 2)
+
+def test_paletted_parts_are_stitched():
+    image = stitched({1: encoded('P', 1), 2: encoded('RGB', (0, 255, 0))})
+    assert image.mode == 'RGBA' and image.getpixel((3, 0)) == (0, 255, 0, 255)
+
+def splitting_scheduler(pipe):
+    """ Returns Scheduler with a 512x256 order split into two 256x256 parts, the id of the order and ids of its parts. """
+    scheduler = Scheduler({'SPLIT_MIN_PIXELS': 1, 'SPLIT_PART_SIZE': 256})
+    fields = {'lat': '55', 'lon': '37', 'scale': '100000', 'w': '512', 'h': '256', 'format': 'jpeg'}
+    scheduler.handle_request(pipe, (1, Rpc_Method.NEW_ORDER.value, (fields, 'client')))
+    (orderId, pincode), code = pipe.sent[-1][1]
+    assert code == 1 and scheduler.mosaic_count == 1
+    parts = [part_id for part_id, left, upper in scheduler.mosaics[orderId]]
+    assert len(parts) == 2 and all(part_id in scheduler.queue for part_id in parts)
+    return scheduler, orderId, parts
+
+def test_mosaic_is_stitched_when_parts_are_ready(pipe):
+    scheduler, orderId, parts = splitting_scheduler(pipe)
+    scheduler.finish_order(pipe, parts[0], Request_Status.READY.value)
+    assert pipe.notifications(Rpc_Method.STITCH_ORDER) == []
+    scheduler.finish_order(pipe, parts[1], Request_Status.READY.value)
+    assert pipe.notifications(Rpc_Method.STITCH_ORDER) == [(orderId, scheduler.orders[orderId][0], scheduler.mosaics[orderId])]
+    assert [(left, upper) for part_id, left, upper in scheduler.mosaics[orderId]] == [(0, 0), (256, 0)]
+    scheduler.handle_request(pipe, (None, Rpc_Method.ORDER_TRANSCODED.value, (orderId, Request_Status.READY.value)))
+    assert scheduler.orders[orderId][1] == Request_Status.READY.value
+
+@pytest.mark.parametrize('status', [Request_Status.RENDER_FAILED.value, Request_Status.EXPIRED.value])
+def test_failed_part_fails_mosaic(pipe, status):
+    scheduler, orderId, parts = splitting_scheduler(pipe)
+    scheduler.finish_order(pipe, parts[0], Request_Status.READY.value)
+    scheduler.finish_order(pipe, parts[1], status)
+    assert scheduler.orders[orderId][1] == status
+    assert (orderId, status) in pipe.notifications(Rpc_Method.ORDER_FINISHED)
+    assert pipe.notifications(Rpc_Method.STITCH_ORDER) == []
+    # a new request for the window does not get the failed order
+    assert orderId not in scheduler.mosaics and render_key(scheduler.orders[orderId][0]) not in scheduler.cached
+
+def test_evicted_part_fails_mosaic(pipe):
+    scheduler, orderId, parts = splitting_scheduler(pipe)
+    scheduler.finish_order(pipe, parts[0], Request_Status.READY.value)
+    scheduler.handle_request(pipe, (None, Rpc_Method.DELETE_IDS.value, [parts[0]]))
+    scheduler.finish_order(pipe, parts[1], Request_Status.READY.value)
+    assert scheduler.orders[orderId][1] == Request_Status.NOMEM.value
+    assert pipe.notifications(Rpc_Method.STITCH_ORDER) == []
+
+def test_ready_parts_are_reused(pipe):
+    scheduler, orderId, parts = splitting_scheduler(pipe)
+    for part_id in parts:
+        scheduler.finish_order(pipe, part_id, Request_Status.READY.value)
+    fields = {'lat': '55', 'lon': '37', 'scale': '100000', 'w': '512', 'h': '256', 'format': 'png'}
+    scheduler.handle_request(pipe, (2, Rpc_Method.NEW_ORDER.value, (fields, 'client')))
+    (pngId, pincode), code = pipe.sent[-1][1]
+    assert [part_id for part_id, left, upper in scheduler.mosaics[pngId]] == parts
+    assert pipe.notifications(Rpc_Method.STITCH_ORDER)[-1][0] == pngId
@@ -0,0 +1,39 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+""" Server-side waiting for orders. """
+import pytest
+
+from utils import Request_Status
+from net_interface import Handler
+
+class Waiting_Handler(Handler):
+    """ Handler which records waits and answers instead of sending them. """
+
+    def __init__(self):
+        self.settings = {'MAX_WAIT_TIMEOUT': 60}
+        self.timeouts = list()
+        self.answers = list()
+
+    def wait_order(self, orderId, pincode, timeout):
+        self.timeouts.append(timeout)
+        return Request_Status.TIMEOUT.value
+
+    def bad_request(self, code, exc=""):
+        self.answers.append((code, exc))
+
+    def send_order(self, orderId, pincode, gis_agent, code=Request_Status.READY.value):
+        self.answers.append((code, None))
+
+@pytest.mark.parametrize('wait', ['nan', 'NaN', 'inf', '-inf', 'abc', ''])
+def test_bad_wait_is_rejected(wait):
+    handler = Waiting_Handler()
+    handler.send_waited(1, 'pin', wait, True)
+    assert handler.timeouts == [] and handler.answers == [(Request_Status.INVALID_PARAM.value, 'Bad wait value')]
+
+@pytest.mark.parametrize('wait, timeout', [('5', 5.0), ('-1', 0), ('1000', 60)])
+def test_wait_is_limited(wait, timeout):
+    handler = Waiting_Handler()
+    handler.send_waited(1, 'pin', wait, True)
+    assert handler.timeouts == [timeout] and handler.answers == [(Request_Status.PROCESSING.value, None)]
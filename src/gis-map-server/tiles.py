@@ -0,0 +1,43 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+#!/usr/bin/python3 -uB
+import math
+import re
+
+from utils import PIXEL_SIZE
+
+# /tiles/{z}/{x}/{y}.{fmt}
+TILE_PATH = re.compile(r'^/tiles/(\d+)/(\d+)/(\d+)\.(\w+)$')
+
+# ground resolution of zoom level 0 at the equator in metres per pixel of a 256 pixels tile (Web Mercator)
+EQUATOR_RESOLUTION = 156543.03392804097
+
+# maximum supported zoom level
+MAX_ZOOM = 24
+
+def parse_tile_path(path):
+    """Function returns (z, x, y, fmt) for a valid tile path or None."""
+    match = TILE_PATH.match(path)
+    if match is None:
+        return None
+    z, x, y = int(match.group(1)), int(match.group(2)), int(match.group(3))
+    if z > MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        return None
+    return z, x, y, match.group(4).lower()
+
+def tile_center(z, x, y):
+    """Function returns (lat, lon) of the center of the XYZ tile in degrees."""
+    n = 2 ** z
+    lon = (x + 0.5) / n * 360.0 - 180.0
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 0.5) / n))))
+    return lat, lon
+
+def tile_params(z, x, y, fmt, tile_size=256):
+    """Function returns order parameters for gis-buffer-renderer which render the XYZ tile:
+    the image of tile_size pixels centered on the tile with the scale of Web Mercator zoom level z at the tile latitude."""
+    lat, lon = tile_center(z, x, y)
+    resolution = EQUATOR_RESOLUTION * 256 / tile_size * math.cos(math.radians(lat)) / 2 ** z
+    scale = max(1, round(resolution / PIXEL_SIZE))
+    return {'lat': f'{lat:.7f}', 'lon': f'{lon:.7f}', 'scale': str(scale), 'w': str(tile_size), 'h': str(tile_size), 'format': fmt}
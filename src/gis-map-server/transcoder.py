@@ -0,0 +1,246 @@
+###############################################################################
+# (c) 2011-2022, SWD Embedded Systems Limited, http://www.kpda.ru
+###############################################################################
+
+#!/usr/bin/python3 -uB
+import io
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import Request_Status
+from rpc import Rpc_Method
+from disk_storage import Disk_Buffer
+from result_channel import store_result
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# formats which can be derived from the base image: order format -> Pillow format
+TRANSCODE_FORMATS = {'png': 'PNG', 'jpeg': 'JPEG', 'jpg': 'JPEG', 'bmp': 'BMP', 'gif': 'GIF', 'tiff': 'TIFF', 'webp': 'WEBP'}
+
+# number of decoded images kept for cropping, panning clients crop one image many times
+DECODED_CACHE_SIZE = 4
+
+def transcode_base_format(settings):
+    """Function returns the format of base images which derivative images are made from, or None if transcoding is disabled."""
+    fmt = settings.get('TRANSCODE_BASE_FORMAT', '').strip().lower()
+    if not fmt:
+        return None
+    if Image is None:
+        logging.warning('Transcoding is disabled, Pillow is not installed')
+        return None
+    if fmt not in TRANSCODE_FORMATS:
+        logging.warning('Transcoding is disabled, base format %s is not supported', fmt)
+        return None
+    return fmt
+
+def crop_enabled(settings):
+    """Function checks if orders can be cropped from rendered images which contain them."""
+    if not settings.get('CROP_REUSE'):
+        return False
+    if Image is None:
+        logging.warning('Cropping is disabled, Pillow is not installed')
+        return False
+    return True
+
+def split_enabled(settings):
+    """Function checks if large orders are split into parts rendered in parallel and stitched."""
+    if settings.get('SPLIT_MIN_PIXELS', 0) <= 0:
+        return False
+    if Image is None:
+        logging.warning('Splitting of large orders is disabled, Pillow is not installed')
+        return False
+    return True
+
+def transcode(data, fmt, quality=0, thumb=0, box=None):
+    """Function converts the image into format fmt.
+
+    Parameters:
+    __________
+    data : byte str or PIL.Image.Image
+        Encoded or decoded source image.
+    fmt : str
+        Order format of the result, a key of TRANSCODE_FORMATS.
+    quality : int
+        Quality of lossy formats from 1 to 100, 0 means the encoder default.
+    thumb : int
+        Maximum side of the result in pixels, the image is downscaled keeping its aspect ratio. 0 means the source size.
+    box : tuple
+        (left, upper, right, lower) window of the source image in pixels which is cropped before downscaling, None means the whole image.
+
+    Returns
+    -------
+    data
+        Encoded result image
+    """
+    image = data if isinstance(data, Image.Image) else Image.open(io.BytesIO(data))
+    if box is not None:
+        image = image.crop(box)
+    if thumb:
+        image.thumbnail((thumb, thumb))
+    pil_format = TRANSCODE_FORMATS[fmt]
+    if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    options = dict()
+    if quality:
+        options['quality'] = quality
+    output = io.BytesIO()
+    image.save(output, pil_format, **options)
+    return output.getvalue()
+
+def mosaic_mode(images):
+    """Function returns the mode of the image stitched from images. Parts have their own palettes and a renderer may give parts
+    in different modes (e.g. RGB ones and RGBA ones with transparent areas), so such parts are pasted in RGBA."""
+    modes = set(image.mode for image in images)
+    if len(modes) == 1 and 'P' not in modes:
+        return modes.pop()
+    return 'RGBA'
+
+class Transcoder():
+    """
+    A class used to make derivative images (other formats, quality levels, thumbnails, crops) from base images in the buffer
+    and to stitch images of large orders from their parts.
+    Scheduler sends TRANSCODE_ORDER notification when the base image of a derivative order is ready, the derivative is made
+    in a thread pool and saved into the buffer as a separate entry, the result is sent back with ORDER_TRANSCODED notification. Stitching is requested with STITCH_ORDER notification.
+    Pillow releases GIL while decoding and encoding, so threads run in parallel. Images which are cropped are kept decoded.
+
+    Attributes:
+    __________
+    rpc : Rpc_Client instance
+        RPC channel for interacting with Scheduler.
+    events : Order_Events instance
+        Orders execution events obtained from Scheduler.
+    buffer : Storage_Class instance
+        Buffer with base and derivative images.
+    persistent : Persistent_Cache instance
+        Images saved by previous server runs, None if the persistent cache is not used.
+    pool : ThreadPoolExecutor instance
+        Threads making derivative images.
+    decoded : OrderedDict
+        Decoded images for cropping in LRU order. Key: id of the order, val: PIL.Image.Image.
+
+    Methods:
+    ________
+    on_transcode(payload)
+        Handles TRANSCODE_ORDER notification.
+    on_stitch(payload)
+        Handles STITCH_ORDER notification.
+    on_deleted(ids)
+        Drops decoded images of deleted orders.
+    run(id, source_id, params, box)
+        Makes the derivative image and reports the result to Scheduler.
+    stitch(id, params, parts)
+        Pastes images of parts into the image of the order and reports the result to Scheduler.
+    source_data(source_id)
+        Returns encoded base image.
+    source_image(source_id)
+        Returns decoded base image for cropping.
+    """
+
+    def __init__(self, rpc, events, buffer, persistent, workers):
+        self.rpc = rpc
+        self.events = events
+        self.buffer = buffer
+        self.persistent = persistent
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='transcoder')
+        self.decoded = OrderedDict()
+        self.lock = threading.Lock()
+        rpc.subscribe(Rpc_Method.TRANSCODE_ORDER, self.on_transcode)
+        rpc.subscribe(Rpc_Method.STITCH_ORDER, self.on_stitch)
+        rpc.subscribe(Rpc_Method.ORDERS_DELETED, self.on_deleted)
+
+    def on_transcode(self, payload):
+        """ Handles TRANSCODE_ORDER notification, payload is (id, id of the base order, canonical parameters, crop box or None). """
+        self.pool.submit(self.run, *payload)
+
+    def on_stitch(self, payload):
+        """ Handles STITCH_ORDER notification, payload is (id, canonical parameters, list of (id of the part, left, upper)). """
+        self.pool.submit(self.stitch, *payload)
+
+    def on_deleted(self, ids):
+        """ Drops decoded images of deleted orders. """
+        with self.lock:
+            for id in ids:
+                self.decoded.pop(id, None)
+
+    def source_data(self, source_id):
+        """ Returns encoded base image from the buffer or the persistent cache, None if it has been evicted. """
+        entry = self.buffer.pop_by_id(source_id)
+        if entry is None:
+            key = self.events.order_key(source_id)
+            if self.persistent is None or key is None:
+                return None
+            entry = self.persistent.get(key)
+            if entry is None:
+                return None
+        data = entry[0]
+        if isinstance(data, Disk_Buffer):
+            try:
+                return bytes(data.read())
+            finally:
+                data.close()
+        return data
+
+    def source_image(self, source_id):
+        """ Returns decoded base image for cropping, None if it has been evicted. Decoded images are shared by threads, they are only read. """
+        with self.lock:
+            image = self.decoded.get(source_id)
+            if image is not None:
+                self.decoded.move_to_end(source_id)
+                return image
+        data = self.source_data(source_id)
+        if data is None:
+            return None
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        with self.lock:
+            self.decoded[source_id] = image
+            while len(self.decoded) > DECODED_CACHE_SIZE:
+                self.decoded.popitem(last=False)
+        return image
+
+    def run(self, id, source_id, params, box=None):
+        """ Makes the derivative image and reports the result to Scheduler. """
+        status = Request_Status.RENDER_FAILED.value
+        try:
+            data = self.source_data(source_id) if box is None else self.source_image(source_id)
+            if data is None:
+                status = Request_Status.NOMEM.value
+            else:
+                fmt = params['format']
+                result = transcode(data, fmt, int(params.get('quality', 0)), int(params.get('thumb', 0)), box)
+                mime = 'image/jpeg' if TRANSCODE_FORMATS[fmt] == 'JPEG' else f'image/{fmt}'
+                status = store_result(self.buffer, self.events, self.persistent, id, result, mime)
+        except Exception as exc:
+            logging.warning('Transcoding of order %s from order %s failed: %s', id, source_id, exc)
+        logging.debug('Order %s is transcoded from order %s, status %s', id, source_id, status)
+        self.rpc.notify(Rpc_Method.ORDER_TRANSCODED, (id, status))
+
+    def stitch(self, id, params, parts):
+        """ Pastes images of parts into the image of the order and reports the result to Scheduler. """
+        status = Request_Status.RENDER_FAILED.value
+        try:
+            images = list()
+            for part_id, left, upper in parts:
+                data = self.source_data(part_id)
+                if data is None:
+                    status = Request_Status.NOMEM.value
+                    break
+                images.append((Image.open(io.BytesIO(data)), left, upper))
+            else:
+                mode = mosaic_mode(image for image, left, upper in images)
+                mosaic = Image.new(mode, (int(params['w']), int(params['h'])))
+                for image, left, upper in images:
+                    mosaic.paste(image if image.mode == mode else image.convert(mode), (left, upper))
+                fmt = params['format']
+                result = transcode(mosaic, fmt, int(params.get('quality', 0)), int(params.get('thumb', 0)))
+                mime = 'image/jpeg' if TRANSCODE_FORMATS[fmt] == 'JPEG' else f'image/{fmt}'
+                status = store_result(self.buffer, self.events, self.persistent, id, result, mime)
+        except Exception as exc:
+            logging.warning('Stitching of order %s failed: %s', id, exc)
+        logging.debug('Order %s is stitched from %s parts, status %s', id, len(parts), status)
+        self.rpc.notify(Rpc_Method.ORDER_TRANSCODED, (id, status))
@@ -4,6 +4,7 @@
 
 #!/usr/bin/python3 -uB
 from enum import Enum, unique
+import math
 import os
 
 @unique
@@ -15,6 +16,7 @@ class Request_Status(Enum):
     DONE = 410
     NOMEM = 418
     RENDER_FAILED = 500
+    EXPIRED = 504
     
     # codes below are used only to responde to the client
     TIMEOUT = 408
@@ -34,6 +36,8 @@ def get_status_desc(status):
         return 'Request is not ready - not enough memory on server'
     elif status == Request_Status.RENDER_FAILED.value:
         return 'Request is failed - renderer did not finish successfully'
+    elif status == Request_Status.EXPIRED.value:
+        return 'Request is dropped - its deadline has passed before rendering'
     elif status == Request_Status.TIMEOUT.value:
         return 'Request status is unknown, timeout error'
     elif status == Request_Status.REQUEST_FAILED.value:
@@ -41,6 +45,73 @@ def get_status_desc(status):
     else:
         return 'Unknown Error'
 
+# order parameters which define the rendered image
+RENDER_PARAMS = ('lat', 'lon', 'scale', 'w', 'h', 'format')
+
+# order parameters of derivative images made from the rendered image by the server: quality of lossy formats and thumbnail size
+DERIVATIVE_PARAMS = ('quality', 'thumb')
+
+# length of one degree of latitude in metres and size of a rendered pixel in metres, used to convert pixels to degrees
+DEGREE_LENGTH = 111320.0
+PIXEL_SIZE = 0.00028
+
+# coordinates precision without quantisation, in degrees
+COORD_PRECISION = 1e-7
+
+def is_decimal(value):
+    """Function checks if the string is a non-negative integer written with ASCII digits, str.isdigit() accepts digits like '²' which int() rejects."""
+    return value.isascii() and value.isdigit()
+
+def is_finite(value):
+    """Function checks if the string is a finite float number, float() accepts 'nan' and 'inf'."""
+    try:
+        return math.isfinite(float(value))
+    except ValueError:
+        return False
+
+def coord_step(scale, quantum=0):
+    """Function returns the step of coordinates grid in degrees: quantum pixels of the map with such scale, or COORD_PRECISION if quantum is 0."""
+    if quantum > 0:
+        return quantum * scale * PIXEL_SIZE / DEGREE_LENGTH
+    return COORD_PRECISION
+
+def canonical_params(params, quantum=0):
+    """Function returns order parameters in canonical form: only RENDER_PARAMS and DERIVATIVE_PARAMS, numbers are parsed and formatted in one way,
+    coordinates are snapped to the grid with coord_step(scale, quantum). Parameters have to be validated before."""
+    scale = int(params['scale'])
+    step = coord_step(scale, quantum)
+    lat = round(float(params['lat']) / step) * step
+    lon = round(float(params['lon']) / step) * step
+    canonical = {'lat': f'{lat:.7f}', 'lon': f'{lon:.7f}', 'scale': str(scale), 'w': str(int(params['w'])), 'h': str(int(params['h'])),
+                 'format': params['format'].strip().lower()}
+    for par in DERIVATIVE_PARAMS:
+        if par in params and int(params[par]):
+            canonical[par] = str(int(params[par]))
+    return canonical
+
+def base_params(params, fmt):
+    """Function returns canonical parameters of the image rendered in format fmt which the derivative image is made from."""
+    base = {par: params[par] for par in RENDER_PARAMS}
+    base['format'] = fmt
+    return base
+
+def is_derivative(params, base_format):
+    """Function checks if the image with canonical parameters is made from the image rendered in base_format."""
+    return params['format'] != base_format or any(par in params for par in DERIVATIVE_PARAMS)
+
+def render_key(params):
+    """Function returns a compact hashable key which identifies the image rendered with canonical order parameters.
+    Derivative parameters are added only if they are used, so keys of rendered images do not change."""
+    key = (round(float(params['lat']) / COORD_PRECISION), round(float(params['lon']) / COORD_PRECISION),
+           int(params['scale']), int(params['w']), int(params['h']), params['format'])
+    if any(par in params for par in DERIVATIVE_PARAMS):
+        key += tuple(int(params.get(par, 0)) for par in DERIVATIVE_PARAMS)
+    return key
+
+def key_text(key):
+    """Function returns a string form of the render key, it is used to save keys outside of the process."""
+    return '/'.join(str(k) for k in key)
+
 def get_log_path():
     """Function returns the log path for gis-map-server."""
     try: